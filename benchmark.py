@@ -0,0 +1,830 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark for youtube2mp3.py
+Runs reproducible download scenarios against a local stand-in media server,
+with fake yt-dlp extractors and a fake search backend, and reports jobs/s,
+MB/s, peak RSS and per-stage latency.
+"""
+
+import os
+import sys
+import json
+import logging
+import time
+import shutil
+import socket
+import struct
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, List, Optional, Iterator, Tuple
+from argparse import ArgumentParser, RawTextHelpFormatter, SUPPRESS
+
+from yt_dlp.extractor.common import InfoExtractor, SearchInfoExtractor
+
+from youtube2mp3 import (AsyncDownloader, DownloadService, JobScheduler, JobStore, LibraryRetagger, Logger,
+                         MetadataManager, MetadataPrefetcher, PipelinedDownloader, PlaylistExpander, RetryPolicy,
+                         StageMetrics, ThreadedDownloader, ThumbnailFetcher, YouTubeDownloader, YouTubeSearcher)
+
+# Every scenario is deterministic: same jobs, same sizes, same injected failures
+SCENARIOS = {
+    'short': {'jobs': 200, 'seconds': 10, 'threads': 8,
+              'help': 'many short clips, dominated by per-job overhead and tagging'},
+    'long': {'jobs': 4, 'seconds': 1200, 'threads': 4,
+             'help': 'few long files, dominated by download and encode throughput'},
+    'playlist': {'playlists': 4, 'entries': 25, 'seconds': 30, 'threads': 4,
+                 'help': 'playlists fanned out into their entries'},
+    'mixed': {'playlists': 1, 'entries': 40, 'seconds': 10, 'long_every': 10, 'long_seconds': 300,
+              'threads': 4, 'link_rate': 1024 * 1024,
+              'help': 'a playlist of short clips where every 10th entry is a long mix'},
+    'throttled': {'jobs': 40, 'seconds': 10, 'threads': 8, 'fail_every': 4,
+                  'help': 'every 4th video answers HTTP 429 once before it resolves'},
+    'cancel': {'jobs': 8, 'seconds': 10, 'threads': 4, 'fail_every': 1, 'fail_times': 100, 'cancel_after': 1.0,
+               'help': 'every video answers HTTP 429, the async engine is cancelled during the backoff'},
+    'metadata': {'jobs': 40, 'seconds': 30, 'threads': 4, 'info_delay': 0.5, 'link_rate': 1024 * 1024,
+                 'help': 'videos take 0.5s to resolve and about as long to download'},
+    'slow': {'jobs': 16, 'seconds': 60, 'threads': 8, 'link_rate': 256 * 1024,
+             'help': 'every connection is capped at 256KB/s'},
+    'pipelined': {'jobs': 40, 'seconds': 30, 'threads': 4, 'engine': 'pipelined', 'encoders': 2, 'ffmpeg': True,
+                  'help': 'the pipelined engine, 4 download and 2 encode workers (needs ffmpeg)'},
+    'async': {'jobs': 200, 'seconds': 10, 'threads': 8, 'engine': 'async', 'ffmpeg': True,
+              'help': 'many short clips through the asyncio engine (needs ffmpeg)'},
+    'serve': {'jobs': 200, 'seconds': 10, 'threads': 8, 'clients': 4,
+              'help': 'batches from 4 clients through the HTTP API of --serve'},
+    'shared': {'jobs': 200, 'seconds': 10, 'threads': 4, 'processes': 4, 'lease': 2, 'kill_after': 1.0,
+               'help': '4 worker processes sharing a job store, one of them is killed midway'},
+    'retag': {'files': 2000, 'seconds': 1, 'threads': 8,
+              'help': 'a library of 2000 files, every other one with stale tags and no album art'},
+    'search': {'searches': 200, 'results': 5,
+               'help': 'search queries through YouTubeSearcher'},
+    'startup': {'runs': 20,
+                'help': 'CLI startup: import, --help and a rejected argument'},
+}
+
+# Dependencies that must not be imported before they are needed
+LAZY_MODULES = ('yt_dlp', 'requests', 'mutagen', 'tqdm', 'validators', 'inquirer', 'asyncio')
+
+# Silent MPEG-1 Layer III frame, 128kbps 44.1kHz mono
+MP3_FRAME = b'\xff\xfb\x90\xc4' + bytes(413)
+MP3_FRAMES_PER_SECOND = 44100 / 1152
+
+# 16-bit mono PCM at 8kHz, the same byte rate as the MP3 stream
+WAV_RATE = 8000
+WAV_BYTES_PER_SECOND = WAV_RATE * 2
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaServer(ThreadingHTTPServer):
+    """Local stand-in for the YouTube API, media and thumbnail hosts
+
+    Paths are prefixed with the scenario, e.g. /short/info/<id>, so the same
+    server serves every scenario. Failures are injected per path, so a retried
+    request succeeds like it would on a real host after a 429.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, encode: bool = False):
+        super().__init__(('127.0.0.1', port), MediaHandler)
+        self.encode = encode
+        self.thumbnail = self._thumbnail()
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @staticmethod
+    def _thumbnail(size: int = 32 * 1024) -> bytes:
+        """Build a JPEG-framed blob of a typical thumbnail size"""
+        data = b'\xff\xd8'
+        while len(data) < size:
+            payload = bytes(range(256)) * 64
+            data += b'\xff\xfe' + struct.pack('>H', len(payload) + 2) + payload
+        return data + b'\xff\xd9'
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients hang up mid-response when a job is cancelled or a scenario ends
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def should_fail(self, path: str, times: int) -> bool:
+        """Fail the first times requests of a path"""
+        with self._lock:
+            count = self._failures.get(path, 0)
+            self._failures[path] = count + 1
+            return count < times
+
+    @staticmethod
+    def seconds(scenario: str, video_id: str) -> int:
+        """Get the length of a video, long_every videos are long_seconds long"""
+        config = SCENARIOS[scenario]
+        long_every = config.get('long_every')
+        if long_every and int(video_id[-6:]) % long_every == long_every - 1:
+            return config['long_seconds']
+        return config['seconds']
+
+    def media_size(self, seconds: int) -> int:
+        if self.encode:
+            return 44 + seconds * WAV_BYTES_PER_SECOND
+        return int(seconds * MP3_FRAMES_PER_SECOND) * len(MP3_FRAME)
+
+    def media_chunks(self, seconds: int) -> Iterator[bytes]:
+        """Generate a silent audio file of the given length"""
+        if self.encode:
+            size = seconds * WAV_BYTES_PER_SECOND
+            yield (b'RIFF' + struct.pack('<I', 36 + size) + b'WAVEfmt ' +
+                   struct.pack('<IHHIIHH', 16, 1, 1, WAV_RATE, WAV_BYTES_PER_SECOND, 2, 16) +
+                   b'data' + struct.pack('<I', size))
+            chunk = bytes(CHUNK_SIZE)
+        else:
+            size = int(seconds * MP3_FRAMES_PER_SECOND) * len(MP3_FRAME)
+            chunk = MP3_FRAME * (CHUNK_SIZE // len(MP3_FRAME))
+
+        while size > 0:
+            yield chunk[:size]
+            size -= len(chunk)
+
+    def video_info(self, scenario: str, video_id: str) -> Dict[str, Any]:
+        seconds = self.seconds(scenario, video_id)
+        ext = 'wav' if self.encode else 'mp3'
+        return {
+            'id': video_id,
+            'title': f"Benchmark {scenario} {video_id}",
+            'uploader': 'youtube2mp3 benchmark',
+            'duration': seconds,
+            'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+            'thumbnails': [{'id': '0', 'url': f"{self.url}/{scenario}/thumb/{video_id}.jpg"}],
+            'formats': [{
+                'format_id': 'audio',
+                # Signed like YouTube media URLs, which expire after six hours
+                'url': f"{self.url}/{scenario}/media/{video_id}.{ext}?expire={int(time.time()) + 6 * 3600}",
+                'ext': ext,
+                'vcodec': 'none',
+                'acodec': 'pcm_s16le' if self.encode else 'mp3',
+                'abr': 128,
+                'filesize': self.media_size(seconds),
+            }],
+        }
+
+    def playlist_info(self, scenario: str, playlist_id: str) -> Dict[str, Any]:
+        entries = SCENARIOS[scenario]['entries']
+        return {
+            'id': playlist_id,
+            'title': f"Benchmark playlist {playlist_id}",
+            'entries': [{**BenchVideoIE.video_url(video_id), 'duration': self.seconds(scenario, video_id)}
+                        for video_id in (f"{playlist_id[2:6]}{i:07d}" for i in range(entries))],
+        }
+
+    def search_results(self, query: str, count: int) -> List[Dict[str, Any]]:
+        return [{'id': f"srch{i:07d}", 'title': f"{query} #{i}", 'uploader': 'youtube2mp3 benchmark',
+                 'duration': 60 + i} for i in range(count)]
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves the JSON metadata, media files and thumbnails of MediaServer"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self) -> None:
+        super().setup()
+        # Headers and body are separate writes, Nagle would delay the body
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes = b'', content_type: str = 'application/json') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data: Any) -> None:
+        self._send(200, json.dumps(data).encode())
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) < 2 or parts[0] not in SCENARIOS:
+            return self._send(404)
+
+        scenario, kind = parts[0], parts[1]
+        config = SCENARIOS[scenario]
+        name = parts[2] if len(parts) > 2 else ''
+
+        if kind == 'info':
+            fail_every = config.get('fail_every')
+            if (fail_every and int(name[-6:]) % fail_every == 0 and
+                    self.server.should_fail(url.path, config.get('fail_times', 1))):
+                return self._send(429, b'Too Many Requests', 'text/plain')
+            time.sleep(config.get('info_delay', 0))
+            return self._send_json(self.server.video_info(scenario, name))
+        if kind == 'playlist':
+            return self._send_json(self.server.playlist_info(scenario, name))
+        if kind == 'search':
+            query = parse_qs(url.query)
+            return self._send_json(self.server.search_results(query['q'][0], int(query['n'][0])))
+        if kind == 'thumb':
+            return self._send(200, self.server.thumbnail, 'image/jpeg')
+        if kind == 'media':
+            return self._send_media(config, self.server.seconds(scenario, name.split('.')[0]))
+        return self._send(404)
+
+    def _send_media(self, config: Dict[str, Any], seconds: int) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/wav' if self.server.encode else 'audio/mpeg')
+        self.send_header('Content-Length', str(self.server.media_size(seconds)))
+        self.end_headers()
+
+        link_rate = config.get('link_rate')
+        try:
+            for chunk in self.server.media_chunks(seconds):
+                self.wfile.write(chunk)
+                if link_rate:
+                    time.sleep(len(chunk) / link_rate)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class BenchVideoIE(InfoExtractor):
+    """Resolves YouTube watch URLs through the benchmark server"""
+
+    _VALID_URL = r'https?://(?:www\.)?youtube\.com/watch\?v=(?P<id>[0-9A-Za-z_-]{11})'
+    SERVER = None
+    SCENARIO = None
+    requests = 0  # extraction attempts, counted by the cancel scenario
+
+    @classmethod
+    def video_url(cls, video_id: str) -> Dict[str, Any]:
+        return {'_type': 'url', 'url': f"https://www.youtube.com/watch?v={video_id}",
+                'ie_key': cls.ie_key(), 'id': video_id}
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        BenchVideoIE.requests += 1
+        return self._download_json(f"{self.SERVER}/{self.SCENARIO}/info/{video_id}", video_id)
+
+
+class BenchPlaylistIE(InfoExtractor):
+    """Resolves YouTube playlist URLs through the benchmark server"""
+
+    _VALID_URL = r'https?://(?:www\.)?youtube\.com/playlist\?list=(?P<id>[0-9A-Za-z_-]+)'
+
+    def _real_extract(self, url):
+        playlist_id = self._match_id(url)
+        info = self._download_json(f"{BenchVideoIE.SERVER}/{BenchVideoIE.SCENARIO}/playlist/{playlist_id}",
+                                   playlist_id)
+        return self.playlist_result(info['entries'], playlist_id, info['title'])
+
+
+class BenchSearchIE(SearchInfoExtractor):
+    """Answers ytsearch queries from the benchmark server"""
+
+    _SEARCH_KEY = 'ytsearch'
+
+    def _get_n_results(self, query, n):
+        results = self._download_json(
+            f"{BenchVideoIE.SERVER}/search/search?q={quote(query)}&n={n}", query)
+        entries = [{**BenchVideoIE.video_url(result['id']), 'title': result['title'],
+                    'uploader': result['uploader'], 'duration': result['duration'],
+                    'duration_string': f"{result['duration'] // 60}:{result['duration'] % 60:02d}"}
+                   for result in results]
+        return self.playlist_result(entries, query, query)
+
+
+class Benchmark:
+    """Runs one scenario in this process and measures it"""
+
+    def __init__(self, scenario: str, server: str, encode: bool, threads: Optional[int] = None,
+                 backoff_scale: float = 0.01, verbose: bool = False, prefetch: int = 0,
+                 schedule: str = 'fifo'):
+        self.scenario = scenario
+        self.config = SCENARIOS[scenario]
+        self.server = server
+        self.encode = encode
+        self.threads = threads or self.config.get('threads', 1)
+        self.backoff_scale = backoff_scale
+        self.prefetch = prefetch
+        self.schedule = schedule
+        self.logger = Logger(logging.DEBUG if verbose else logging.WARNING)
+
+        BenchVideoIE.SERVER = server
+        BenchVideoIE.SCENARIO = scenario
+        YouTubeDownloader.INFO_EXTRACTORS = [BenchVideoIE, BenchPlaylistIE, BenchSearchIE]
+
+    def _urls(self) -> List[str]:
+        if 'playlists' in self.config:
+            return [f"https://www.youtube.com/playlist?list=PL{i:04d}bench"
+                    for i in range(self.config['playlists'])]
+        return [f"https://www.youtube.com/watch?v=bench{i:06d}" for i in range(self.config['jobs'])]
+
+    def _retry_policy(self) -> RetryPolicy:
+        """Retry like the CLI does, with the backoff scaled down"""
+        retry = RetryPolicy(max_retries=3)
+        retry.BACKOFF = {failure: (base * self.backoff_scale, cap * self.backoff_scale)
+                         for failure, (base, cap) in RetryPolicy.BACKOFF.items()}
+        return retry
+
+    @staticmethod
+    def peak_rss() -> int:
+        """Peak resident set size of this process in bytes"""
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def run(self) -> Dict[str, Any]:
+        if self.scenario == 'search':
+            return self._run_search()
+        if self.scenario == 'startup':
+            return self._run_startup()
+        if self.scenario == 'serve':
+            return self._run_serve()
+        if self.scenario == 'shared':
+            return self._run_shared()
+        if self.scenario == 'retag':
+            return self._run_retag()
+        if self.scenario == 'cancel':
+            return self._run_cancel()
+
+        metrics = StageMetrics()
+        urls = iter(self._urls())
+        playlists = None
+        if 'playlists' in self.config:
+            playlists = PlaylistExpander(self.logger)
+            urls = playlists.expand(urls)
+        if self.schedule != 'fifo':
+            urls = JobScheduler(self.schedule, playlists=playlists).schedule(urls)
+
+        output_dir = Path(tempfile.mkdtemp(prefix=f"youtube2mp3-bench-{self.scenario}-"))
+        prefetcher = None
+        if self.prefetch:
+            prefetcher = MetadataPrefetcher(
+                lambda: YouTubeDownloader(output_dir, logger=self.logger, add_metadata=False),
+                lookahead=self.prefetch, workers=min(self.prefetch, 4), logger=self.logger, metrics=metrics)
+            urls = prefetcher.watch(urls)
+        options = dict(
+            urls=urls,
+            output_dir=output_dir,
+            skip_playlist='playlists' not in self.config,
+            logger=self.logger,
+            retry=self._retry_policy(),
+            metrics=metrics,
+            playlists=playlists,
+            prefetcher=prefetcher
+        )
+        # The pipelined and async engines always encode, an MP3 source is converted to MP3 again
+        engine = self.config.get('engine')
+        if engine == 'pipelined':
+            downloader = PipelinedDownloader(download_workers=self.threads,
+                                             encode_workers=self.config['encoders'], **options)
+        elif engine == 'async':
+            downloader = AsyncDownloader(concurrency=self.threads, **options)
+        else:
+            downloader = ThreadedDownloader(num_threads=self.threads, extract_audio=self.encode, **options)
+        try:
+            started = time.perf_counter()
+            downloader.start()
+            elapsed = time.perf_counter() - started
+
+            files = list(output_dir.glob('*.mp3'))
+            tagged = sum(1 for path in files if MetadataManager.read_video_id(path))
+        finally:
+            if prefetcher:
+                prefetcher.close()
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+        report = metrics.report()
+        downloaded = report['stages'].get('download', {}).get('bytes', 0)
+        return {
+            'scenario': self.scenario,
+            'threads': self.threads,
+            'prefetch': self.prefetch,
+            'schedule': self.schedule,
+            'encode': self.encode,
+            'elapsed': elapsed,
+            'jobs': report['jobs'],
+            'files': len(files),
+            'tagged': tagged,
+            'jobs_per_second': len(files) / elapsed,
+            'mb_per_second': downloaded / 1024 / 1024 / elapsed,
+            'peak_rss': self.peak_rss(),
+            'stages': {stage: {key: data[key] for key in ('count', 'mean', 'p50', 'p95')}
+                       for stage, data in report['stages'].items()},
+        }
+
+    def _run_serve(self) -> Dict[str, Any]:
+        """Submit the jobs over HTTP, follow one event stream and wait for the queue to drain"""
+        from urllib.request import Request, urlopen
+
+        metrics = StageMetrics()
+        output_dir = Path(tempfile.mkdtemp(prefix=f"youtube2mp3-bench-{self.scenario}-"))
+        clients = self.config['clients']
+        service = DownloadService(output_dir, workers=self.threads, client_jobs=self.threads // clients,
+                                  logger=self.logger, retry=self._retry_policy(), metrics=metrics,
+                                  extract_audio=self.encode)
+        server = service.listen('127.0.0.1', 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api = f"http://127.0.0.1:{server.server_address[1]}"
+
+        try:
+            started = time.perf_counter()
+            service.start()
+            urls = self._urls()
+            job_ids = []
+            for i in range(clients):
+                request = Request(f"{api}/jobs", json.dumps({'urls': urls[i::clients]}).encode(),
+                                  {'Content-Type': 'application/json', 'X-Client-Id': f"client-{i}"})
+                with urlopen(request) as response:
+                    job_ids += [job['id'] for job in json.load(response)['jobs']]
+
+            with urlopen(f"{api}/jobs/{job_ids[-1]}/events") as response:
+                events = [json.loads(line) for line in response]
+            while True:
+                with urlopen(f"{api}/status") as response:
+                    status = json.load(response)
+                if not status['queued'] and not status['running']:
+                    break
+                time.sleep(0.05)
+            elapsed = time.perf_counter() - started
+
+            files = list(output_dir.glob('*.mp3'))
+            tagged = sum(1 for path in files if MetadataManager.read_video_id(path))
+        finally:
+            server.shutdown()
+            service.stop()
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+        report = metrics.report()
+        downloaded = report['stages'].get('download', {}).get('bytes', 0)
+        return {
+            'scenario': self.scenario,
+            'threads': self.threads,
+            'encode': self.encode,
+            'elapsed': elapsed,
+            'jobs': status['jobs'],
+            'files': len(files),
+            'tagged': tagged,
+            'events': len(events),
+            'jobs_per_second': len(files) / elapsed,
+            'mb_per_second': downloaded / 1024 / 1024 / elapsed,
+            'peak_rss': self.peak_rss(),
+            'stages': {stage: {key: data[key] for key in ('count', 'mean', 'p50', 'p95')}
+                       for stage, data in report['stages'].items()},
+        }
+
+    def work(self, store_path: Path, output_dir: Path) -> None:
+        """Work on a job store like a youtube2mp3.py --worker process"""
+        store = JobStore(store_path, lease=self.config['lease'], poll_interval=0.1)
+        store.start(output_dir)
+        try:
+            ThreadedDownloader(
+                urls=store.claims(),
+                output_dir=output_dir,
+                num_threads=self.threads,
+                logger=self.logger,
+                retry=self._retry_policy(),
+                journal=store,
+                extract_audio=self.encode
+            ).start()
+        finally:
+            store.close()
+
+    def _run_shared(self) -> Dict[str, Any]:
+        """Spread the jobs over worker processes through a job store and kill one of them"""
+        output_dir = Path(tempfile.mkdtemp(prefix=f"youtube2mp3-bench-{self.scenario}-"))
+        store_path = output_dir / 'jobs.db'
+        try:
+            store = JobStore(store_path)
+            store.add(self._urls())
+
+            started = time.perf_counter()
+            context = multiprocessing.get_context('spawn')
+            workers = [context.Process(target=_shared_worker, args=(self.scenario, self.server, self.encode,
+                                                                    self.threads, store_path, output_dir))
+                       for _ in range(self.config['processes'])]
+            for worker in workers:
+                worker.start()
+            time.sleep(self.config['kill_after'])
+            workers[0].kill()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+
+            summary = store.summary()
+            store.close()
+            files = list(output_dir.glob('*.mp3'))
+            tagged = sum(1 for path in files if MetadataManager.read_video_id(path))
+            written = sum(path.stat().st_size for path in files)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+        return {
+            'scenario': self.scenario,
+            'threads': self.threads,
+            'processes': self.config['processes'],
+            'encode': self.encode,
+            'elapsed': elapsed,
+            'jobs': summary,
+            'files': len(files),
+            'tagged': tagged,
+            'jobs_per_second': len(files) / elapsed,
+            'mb_per_second': written / 1024 / 1024 / elapsed,
+            'peak_rss': self.peak_rss(),
+            'stages': {},
+        }
+
+    def _run_retag(self) -> Dict[str, Any]:
+        """Retag a sharded library in place, resolving every video through the server"""
+        metrics = StageMetrics()
+        output_dir = Path(tempfile.mkdtemp(prefix=f"youtube2mp3-bench-{self.scenario}-"))
+        thumbnails = ThumbnailFetcher(workers=self.threads, logger=self.logger)
+        audio = MP3_FRAME * int(self.config['seconds'] * MP3_FRAMES_PER_SECOND)
+        try:
+            for i in range(self.config['files']):
+                video_id = f"bench{i:06d}"
+                path = output_dir / video_id[-2:] / f"Old title {i} [{video_id}].mp3"
+                path.parent.mkdir(exist_ok=True)
+                path.write_bytes(audio)
+                if i % 2:
+                    MetadataManager.add_metadata(path, f"Old title {i}")
+                else:
+                    MetadataManager.add_metadata(path, f"Benchmark {self.scenario} {video_id}",
+                                                 'youtube2mp3 benchmark', video_id=video_id,
+                                                 thumbnail_data=MediaServer._thumbnail())
+
+            started = time.perf_counter()
+            stats = LibraryRetagger(
+                output_dir,
+                threads=self.threads,
+                thumbnails=thumbnails,
+                create_downloader=lambda: YouTubeDownloader(output_dir, logger=self.logger, add_metadata=False),
+                logger=self.logger,
+                metrics=metrics
+            ).run()
+            elapsed = time.perf_counter() - started
+
+            files = list(output_dir.rglob('*.mp3'))
+            size = sum(path.stat().st_size for path in files)
+            tagged = sum(1 for path in files if (MetadataManager.read_tags(path) or {}).get('cover'))
+        finally:
+            thumbnails.close()
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+        report = metrics.report()
+        return {
+            'scenario': self.scenario,
+            'threads': self.threads,
+            'elapsed': elapsed,
+            'jobs': report['jobs'],
+            'files': stats['files'],
+            'tagged': tagged,
+            'jobs_per_second': stats['files'] / elapsed,
+            'mb_per_second': size / 1024 / 1024 / elapsed,
+            'peak_rss': self.peak_rss(),
+            'stages': {stage: {key: data[key] for key in ('count', 'mean', 'p50', 'p95')}
+                       for stage, data in report['stages'].items()},
+        }
+
+    def _run_cancel(self) -> Dict[str, Any]:
+        """Cancel the async engine while its jobs back off and check that it exits without retrying"""
+        import asyncio
+
+        output_dir = Path(tempfile.mkdtemp(prefix=f"youtube2mp3-bench-{self.scenario}-"))
+        # Unscaled, so the engine would otherwise sleep for half a minute or more
+        engine = AsyncDownloader(self._urls(), output_dir, self.threads, logger=self.logger,
+                                 retry=RetryPolicy(max_retries=3), add_metadata=False)
+
+        async def run() -> Tuple[float, int]:
+            task = asyncio.create_task(engine.run())
+            await asyncio.sleep(self.config['cancel_after'])
+            engine.cancel()
+            cancelled, attempts = time.perf_counter(), BenchVideoIE.requests
+            await task
+            return time.perf_counter() - cancelled, BenchVideoIE.requests - attempts
+
+        started = time.perf_counter()
+        try:
+            latency, attempts = asyncio.run(run())
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        elapsed = time.perf_counter() - started
+
+        if attempts:
+            raise RuntimeError(f"{attempts} attempts started after the engine was cancelled")
+        if latency > 2.0:
+            raise RuntimeError(f"The engine took {latency:.1f}s to exit after it was cancelled")
+
+        return {
+            'scenario': self.scenario,
+            'elapsed': elapsed,
+            'jobs': {'cancelled': self.config['jobs']},
+            'jobs_per_second': self.config['jobs'] / elapsed,
+            'peak_rss': self.peak_rss(),
+            'stages': {'cancel': {'count': 1, 'mean': latency, 'p50': latency, 'p95': latency}},
+        }
+
+    def _run_search(self) -> Dict[str, Any]:
+        latencies = []
+        started = time.perf_counter()
+        for i in range(self.config['searches']):
+            query_started = time.perf_counter()
+            results = YouTubeSearcher.search(f"benchmark query {i}", self.config['results'])
+            if len(results) != self.config['results']:
+                raise RuntimeError(f"Search returned {len(results)} results")
+            latencies.append(time.perf_counter() - query_started)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            'scenario': self.scenario,
+            'elapsed': elapsed,
+            'jobs': {'ok': len(latencies)},
+            'jobs_per_second': len(latencies) / elapsed,
+            'peak_rss': self.peak_rss(),
+            'stages': {'search': {'count': len(latencies), 'mean': sum(latencies) / len(latencies),
+                                  'p50': latencies[len(latencies) // 2],
+                                  'p95': latencies[int(len(latencies) * 0.95)]}},
+        }
+
+    def _run_startup(self) -> Dict[str, Any]:
+        script = str(Path(__file__).with_name('youtube2mp3.py'))
+        commands = {
+            'import': [sys.executable, '-c', 'import youtube2mp3'],
+            'help': [sys.executable, script, '--help'],
+            'bad-args': [sys.executable, script, '-u', 'not-a-url'],
+        }
+
+        stages = {}
+        started = time.perf_counter()
+        for stage, command in commands.items():
+            latencies = []
+            for _ in range(self.config['runs']):
+                command_started = time.perf_counter()
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               cwd=os.path.dirname(script))
+                latencies.append(time.perf_counter() - command_started)
+            latencies.sort()
+            stages[stage] = {'count': len(latencies), 'mean': sum(latencies) / len(latencies),
+                             'p50': latencies[len(latencies) // 2],
+                             'p95': latencies[int(len(latencies) * 0.95)]}
+        elapsed = time.perf_counter() - started
+
+        check = subprocess.run(
+            [sys.executable, '-c', 'import sys, youtube2mp3; '
+                                   f'print(" ".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'],
+            stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(script), check=True)
+
+        runs = sum(data['count'] for data in stages.values())
+        return {
+            'scenario': self.scenario,
+            'elapsed': elapsed,
+            'jobs': {'ok': runs},
+            'jobs_per_second': runs / elapsed,
+            'peak_rss': self.peak_rss(),
+            'eager_imports': check.stdout.split(),
+            'stages': stages,
+        }
+
+
+def _shared_worker(scenario: str, server: str, encode: bool, threads: int, store_path: Path,
+                   output_dir: Path) -> None:
+    Benchmark(scenario, server, encode, threads).work(store_path, output_dir)
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    jobs = ', '.join(f"{count} {outcome}" for outcome, count in sorted(result['jobs'].items()))
+    line = (f"{result['scenario']:>9}: {result['elapsed']:.2f}s, {result['jobs_per_second']:.1f} jobs/s, "
+            f"peak RSS {result['peak_rss'] / 1024 / 1024:.0f}MB, jobs: {jobs}")
+    if 'files' in result:
+        line += (f", {result['mb_per_second']:.1f}MB/s, "
+                 f"{result['files']} files ({result['tagged']} tagged) with {result['threads']} threads")
+    if 'eager_imports' in result:
+        line += f", eagerly imported: {', '.join(result['eager_imports']) or 'nothing heavy'}"
+    print(line)
+    for stage, data in result['stages'].items():
+        print(f"{'':>11}{stage:>8}: {data['count']} runs, mean {data['mean'] * 1000:.1f}ms, "
+              f"p50 {StageMetrics.format_quantile(data['p50'])}, p95 {StageMetrics.format_quantile(data['p95'])}")
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Get the regressions of results against a baseline written by --json"""
+    previous = {result['scenario']: result for result in baseline}
+    regressions = []
+    for result in results:
+        base = previous.get(result['scenario'])
+        if base is None:
+            continue
+        if result['jobs_per_second'] < base['jobs_per_second'] * (1 - tolerance):
+            regressions.append(f"{result['scenario']}: {result['jobs_per_second']:.1f} jobs/s, "
+                               f"baseline {base['jobs_per_second']:.1f} jobs/s")
+        if result['peak_rss'] > base['peak_rss'] * (1 + tolerance):
+            regressions.append(f"{result['scenario']}: peak RSS {result['peak_rss'] / 1024 / 1024:.0f}MB, "
+                               f"baseline {base['peak_rss'] / 1024 / 1024:.0f}MB")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(
+        description="Offline benchmark for youtube2mp3.py\n\n" +
+                    "\n".join(f"  {name:<10}{config['help']}" for name, config in SCENARIOS.items()),
+        formatter_class=RawTextHelpFormatter
+    )
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help='Scenarios to run (default: all)')
+    parser.add_argument('-t', '--threads', type=int, help='Override the number of download threads')
+    parser.add_argument('--encode', action='store_true', default=None,
+                        help='Serve WAV and encode it to MP3 (default: when ffmpeg is installed)')
+    parser.add_argument('--no-encode', dest='encode', action='store_false',
+                        help='Serve MP3 that is tagged without re-encoding')
+    parser.add_argument('--backoff-scale', type=float, default=0.01,
+                        help='Scale of the retry backoff delays (default: 0.01)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Resolve the metadata of up to N queued URLs ahead (default: 0)')
+    parser.add_argument('--schedule', choices=JobScheduler.POLICIES, default='fifo',
+                        help='Job order within the download scenarios (default: fifo)')
+    parser.add_argument('--json', type=Path, help='Write the results to a JSON file')
+    parser.add_argument('--baseline', type=Path,
+                        help='Compare against the results of an earlier --json run and exit\n'
+                             'with an error on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction by which jobs/s may drop or peak RSS may grow\n'
+                             'before --baseline reports a regression (default: 0.2)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the scenarios')
+    # Internal: run one scenario in a child process, so that peak RSS is per scenario
+    parser.add_argument('--run', choices=list(SCENARIOS), help=SUPPRESS)
+    parser.add_argument('--server', help=SUPPRESS)
+    args = parser.parse_args()
+
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    scenarios = args.scenarios or list(SCENARIOS)
+
+    if args.encode is None:
+        args.encode = shutil.which('ffmpeg') is not None
+
+    if args.run:
+        result = Benchmark(args.run, args.server, args.encode, args.threads,
+                           args.backoff_scale, args.verbose, args.prefetch,
+                           args.schedule).run()
+        print(json.dumps(result))
+        return
+
+    server = MediaServer(encode=args.encode)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if not args.encode:
+        print("Encoding disabled (no ffmpeg found), the encode stage is not measured")
+
+    results = []
+    try:
+        for scenario in scenarios:
+            if SCENARIOS[scenario].get('ffmpeg') and not shutil.which('ffmpeg'):
+                print(f"{scenario:>9}: skipped, its engine always encodes and needs ffmpeg")
+                continue
+
+            command = [sys.executable, os.path.abspath(__file__), '--run', scenario, '--server', server.url,
+                       '--encode' if args.encode else '--no-encode',
+                       '--backoff-scale', str(args.backoff_scale), '--prefetch', str(args.prefetch),
+                       '--schedule', args.schedule]
+            if args.threads:
+                command += ['--threads', str(args.threads)]
+            if args.verbose:
+                command.append('--verbose')
+
+            child = subprocess.run(command, stdout=subprocess.PIPE,
+                                   stderr=None if args.verbose else subprocess.DEVNULL, text=True)
+            if child.returncode != 0:
+                print(f"{scenario:>9}: failed with exit code {child.returncode}")
+                continue
+
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print_result(result)
+    finally:
+        server.shutdown()
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), encoding='utf-8')
+
+    regressions = []
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text(encoding='utf-8')), args.tolerance)
+        for regression in regressions:
+            print(f"Regression in {regression}")
+        if not regressions:
+            print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+    sys.exit(0 if len(results) == len(scenarios) and not regressions else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,29 +6,44 @@ YouTube to MP3 Converter = v2.0.0
 A tool to download and convert YouTube videos to MP3 format.
 """
 
+from __future__ import annotations
+
 import re
 import os
+import io
 import sys
+import gzip
+import base64
 import time
 import queue
 import logging
+import random
+import shutil
+import glob
 import threading
+import cProfile
+import itertools
+import heapq
+import collections
 import json
+import sqlite3
+import zlib
+import socket
+import errno
 from pathlib import Path
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse
 from datetime import datetime
-from typing import List, Optional, Set, Union, Dict, Any
+from typing import TYPE_CHECKING, Callable, List, Optional, Set, Union, Dict, Any, Iterable, Iterator, Tuple
 from argparse import ArgumentParser, RawTextHelpFormatter, ArgumentTypeError
 
-import yt_dlp
-import validators
 import colorama
-import requests
-import inquirer
-from inquirer import themes
 from colorama import Fore, Style
-from tqdm import tqdm
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, APIC
-from mutagen.mp3 import MP3
+
+# yt_dlp, requests, mutagen, tqdm, validators, inquirer and asyncio are
+# imported where they are used, so --help and argument errors start fast
+if TYPE_CHECKING:
+    import yt_dlp
 
 # Initialize colorama
 colorama.init(autoreset=True)
@@ -53,8 +68,15 @@ class ColoredFormatter(logging.Formatter):
 class ConsoleHandler(logging.StreamHandler):
     """Custom handler that clears the line before printing"""
 
+    # While a dashboard is drawn, it is the only writer to the terminal
+    dashboard = None
+
     def emit(self, record):
         try:
+            if ConsoleHandler.dashboard is not None:
+                ConsoleHandler.dashboard.write(self.format(record))
+                return
+
             # Clear the current line
             sys.stdout.write("\033[K")
             msg = self.format(record)
@@ -103,87 +125,364 @@ class Logger:
 
 
 class MetadataManager:
-    """Manages metadata for MP3 files"""
+    """Manages metadata for audio files
+
+    MP3 files get ID3 frames, M4A files MP4 atoms and Opus, Ogg Vorbis and
+    FLAC files Vorbis comments.
+    """
+
+    VIDEO_ID_DESC = 'YouTube ID'
+    MP4_VIDEO_ID_KEY = f'----:com.apple.iTunes:{VIDEO_ID_DESC}'
+    VORBIS_VIDEO_ID_KEY = 'YOUTUBE_ID'
+
+    # Settings key of the run that wrote the file, see OutputFormat.settings_key
+    SETTINGS_DESC = 'youtube2mp3 settings'
+    MP4_SETTINGS_KEY = f'----:com.apple.iTunes:{SETTINGS_DESC}'
+    VORBIS_SETTINGS_KEY = 'YOUTUBE2MP3_SETTINGS'
+
+    # Free space reserved in new tags, so later edits don't move the audio
+    TAG_PADDING = 16 * 1024
 
     @staticmethod
-    def add_metadata(mp3_file: Path, title: str, artist: str = "YouTube", album: str = "YouTube to MP3") -> None:
-        """Add metadata to an MP3 file"""
-        try:
-            audio = MP3(mp3_file, ID3=ID3)
+    def _open(audio_file: Path):
+        """Open an audio file with mutagen, adding an empty tag if it has none"""
+        import mutagen
 
-            # Create ID3 tag if it doesn't exist
-            try:
-                audio.add_tags()
-            except:
-                pass
+        audio = mutagen.File(audio_file)
+        if audio is None:
+            raise ValueError(f"Unsupported audio file: {audio_file}")
+        if audio.tags is None:
+            audio.add_tags()
+        return audio
+
+    @staticmethod
+    def _padding(info) -> int:
+        """mutagen padding policy: reuse the existing padding, reserve TAG_PADDING when growing"""
+        return info.padding if info.padding >= 0 else MetadataManager.TAG_PADDING
+
+    @staticmethod
+    def _add_cover(audio, thumbnail_data: bytes, mime: str) -> None:
+        from mutagen.id3 import ID3, APIC
+        from mutagen.mp4 import MP4Tags, MP4Cover
+        from mutagen.flac import FLAC, Picture
 
-            # Set the title
-            audio.tags.add(TIT2(encoding=3, text=title))
+        tags = audio.tags
+        if isinstance(tags, ID3):
+            tags.setall('APIC', [
+                APIC(
+                    encoding=3,  # UTF-8
+                    mime=mime,
+                    type=3,  # Cover (front)
+                    desc='Cover',
+                    data=thumbnail_data
+                )
+            ])
+        elif isinstance(tags, MP4Tags):
+            # MP4 covers can only be JPEG or PNG
+            formats = {'image/jpeg': MP4Cover.FORMAT_JPEG, 'image/png': MP4Cover.FORMAT_PNG}
+            if mime in formats:
+                tags['covr'] = [MP4Cover(thumbnail_data, imageformat=formats[mime])]
+        else:
+            picture = Picture()
+            picture.type = 3  # Cover (front)
+            picture.mime = mime
+            picture.desc = 'Cover'
+            picture.data = thumbnail_data
+            if isinstance(audio, FLAC):
+                audio.clear_pictures()
+                audio.add_picture(picture)
+            else:
+                tags['METADATA_BLOCK_PICTURE'] = [base64.b64encode(picture.write()).decode('ascii')]
+
+    @staticmethod
+    def add_metadata(audio_file: Path, title: str, artist: str = "YouTube", album: str = "YouTube to MP3",
+                     video_id: Optional[str] = None, thumbnail_data: Optional[bytes] = None,
+                     thumbnail_mime: str = 'image/jpeg', track: Optional[Tuple[int, int]] = None,
+                     settings: Optional[str] = None) -> bool:
+        """Write the tags and album art of an audio file in a single save"""
+        from mutagen.id3 import ID3, TIT2, TPE1, TALB, TRCK, TXXX
+        from mutagen.mp4 import MP4Tags, MP4FreeForm
+
+        try:
+            audio = MetadataManager._open(audio_file)
+            tags = audio.tags
 
-            # Set the artist
-            audio.tags.add(TPE1(encoding=3, text=artist))
+            if isinstance(tags, ID3):
+                tags.add(TIT2(encoding=3, text=title))
+                tags.add(TPE1(encoding=3, text=artist))
+                tags.add(TALB(encoding=3, text=album))
+                if track:
+                    tags.add(TRCK(encoding=3, text=f"{track[0]}/{track[1]}"))
+                # Record the source video so the archive can be rebuilt from tags
+                if video_id:
+                    tags.add(TXXX(encoding=3, desc=MetadataManager.VIDEO_ID_DESC, text=video_id))
+                if settings:
+                    tags.add(TXXX(encoding=3, desc=MetadataManager.SETTINGS_DESC, text=settings))
+            elif isinstance(tags, MP4Tags):
+                tags['\xa9nam'] = [title]
+                tags['\xa9ART'] = [artist]
+                tags['\xa9alb'] = [album]
+                if track:
+                    tags['trkn'] = [track]
+                if video_id:
+                    tags[MetadataManager.MP4_VIDEO_ID_KEY] = [MP4FreeForm(video_id.encode('utf-8'))]
+                if settings:
+                    tags[MetadataManager.MP4_SETTINGS_KEY] = [MP4FreeForm(settings.encode('utf-8'))]
+            else:
+                tags['TITLE'] = [title]
+                tags['ARTIST'] = [artist]
+                tags['ALBUM'] = [album]
+                if track:
+                    tags['TRACKNUMBER'] = [str(track[0])]
+                    tags['TRACKTOTAL'] = [str(track[1])]
+                if video_id:
+                    tags[MetadataManager.VORBIS_VIDEO_ID_KEY] = [video_id]
+                if settings:
+                    tags[MetadataManager.VORBIS_SETTINGS_KEY] = [settings]
 
-            # Set the album
-            audio.tags.add(TALB(encoding=3, text=album))
+            if thumbnail_data:
+                MetadataManager._add_cover(audio, thumbnail_data, thumbnail_mime)
 
-            # Save the changes
-            audio.save()
+            audio.save(padding=MetadataManager._padding)
             return True
         except Exception as e:
             print(f"Error adding metadata: {e}")
             return False
 
     @staticmethod
-    def download_thumbnail(video_info: Dict[str, Any]) -> Optional[bytes]:
-        """Download the video thumbnail"""
+    def read_stream_info(audio_file: Path) -> Tuple[Optional[float], Optional[int]]:
+        """Read the duration in seconds and the bitrate in bits/s of an audio file"""
+        import mutagen
+
         try:
-            if 'thumbnails' in video_info and video_info['thumbnails']:
-                # Get the highest quality thumbnail
-                thumbnail_url = video_info['thumbnails'][-1]['url']
-                response = requests.get(thumbnail_url)
-                if response.status_code == 200:
-                    return response.content
-            return None
+            audio = mutagen.File(audio_file)
+        except Exception:
+            return None, None
+        if audio is None:
+            return None, None
+        return getattr(audio.info, 'length', None), getattr(audio.info, 'bitrate', None) or None
+
+    @staticmethod
+    def read_tags(audio_file: Path) -> Optional[Dict[str, Any]]:
+        """Read the title, artist, album, video ID, settings key and album art presence of an audio file, None when unreadable"""
+        import mutagen
+        from mutagen.id3 import ID3
+        from mutagen.mp4 import MP4Tags
+
+        try:
+            audio = mutagen.File(audio_file)
         except Exception:
             return None
+        if audio is None:
+            return None
+
+        def first(values) -> Optional[str]:
+            return str(values[0]) if values else None
+
+        tags = audio.tags
+        if not tags:
+            return {'title': None, 'artist': None, 'album': None, 'video_id': None, 'settings': None,
+                    'cover': False}
+
+        if isinstance(tags, ID3):
+            frames = tags.getall(f"TXXX:{MetadataManager.VIDEO_ID_DESC}")
+            settings = tags.getall(f"TXXX:{MetadataManager.SETTINGS_DESC}")
+            return {
+                'title': first(tags['TIT2'].text) if 'TIT2' in tags else None,
+                'artist': first(tags['TPE1'].text) if 'TPE1' in tags else None,
+                'album': first(tags['TALB'].text) if 'TALB' in tags else None,
+                'video_id': first(frames[0].text) if frames else None,
+                'settings': first(settings[0].text) if settings else None,
+                'cover': bool(tags.getall('APIC')),
+            }
+        if isinstance(tags, MP4Tags):
+            return {
+                'title': first(tags.get('\xa9nam')),
+                'artist': first(tags.get('\xa9ART')),
+                'album': first(tags.get('\xa9alb')),
+                'video_id': first([bytes(value).decode('utf-8')
+                                   for value in tags.get(MetadataManager.MP4_VIDEO_ID_KEY, [])]),
+                'settings': first([bytes(value).decode('utf-8')
+                                   for value in tags.get(MetadataManager.MP4_SETTINGS_KEY, [])]),
+                'cover': bool(tags.get('covr')),
+            }
+        return {
+            'title': first(tags.get('TITLE')),
+            'artist': first(tags.get('ARTIST')),
+            'album': first(tags.get('ALBUM')),
+            'video_id': first(tags.get(MetadataManager.VORBIS_VIDEO_ID_KEY)),
+            'settings': first(tags.get(MetadataManager.VORBIS_SETTINGS_KEY)),
+            'cover': bool(getattr(audio, 'pictures', None) or tags.get('METADATA_BLOCK_PICTURE')),
+        }
+
+    @staticmethod
+    def read_video_id(audio_file: Path) -> Optional[str]:
+        """Read the source video ID stored by add_metadata"""
+        tags = MetadataManager.read_tags(audio_file)
+        return tags['video_id'] if tags else None
+
+
+class ThumbnailFetcher:
+    """Fetches, shrinks and caches the album art of videos
+
+    The smallest thumbnail whose short side is at least size pixels is
+    fetched over a pooled HTTP session on a small thread pool, so the fetch
+    overlaps the download and never blocks a worker until tagging needs it.
+    Images are downscaled to size and re-encoded as JPEG of at most max_bytes
+    when Pillow is installed. Without Pillow they are embedded as they are,
+    with their real MIME type, and a warning is logged once. Results are cached by URL, so retried jobs
+    don't fetch again.
+    """
+
+    SIGNATURES = (
+        (b'\xff\xd8\xff', 'image/jpeg'),
+        (b'\x89PNG\r\n\x1a\n', 'image/png'),
+        (b'GIF8', 'image/gif'),
+    )
+
+    def __init__(self, size: int = 300, max_bytes: int = 100 * 1024, workers: int = 2,
+                 cache_size: int = 256, logger: Optional[Logger] = None):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.cache_size = cache_size
+        self.logger = logger or Logger()
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._executor = None
+        self._session = None
+        self._warned = False
 
     @staticmethod
-    def add_thumbnail(mp3_file: Path, thumbnail_data: bytes) -> bool:
-        """Add thumbnail as album art to MP3 file"""
+    def detect_mime(data: bytes) -> Optional[str]:
+        """Get the MIME type of an image from its magic bytes"""
+        for signature, mime in ThumbnailFetcher.SIGNATURES:
+            if data.startswith(signature):
+                return mime
+        if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+            return 'image/webp'
+        return None
+
+    def select(self, thumbnails: List[Dict[str, Any]]) -> Optional[str]:
+        """Get the URL of the smallest thumbnail meeting the configured size"""
+        candidates = [t for t in thumbnails or [] if t.get('url')]
+        if not candidates:
+            return None
+
+        sized = [t for t in candidates if t.get('width') and t.get('height')]
+        if not sized:
+            # yt-dlp sorts thumbnails from worst to best
+            return candidates[-1]['url']
+
+        def cost(t: Dict[str, Any]) -> Tuple[int, bool]:
+            # JPEGs can be embedded without re-encoding
+            return t['width'] * t['height'], not urlparse(t['url']).path.endswith(('.jpg', '.jpeg'))
+
+        large_enough = [t for t in sized if min(t['width'], t['height']) >= self.size]
+        if large_enough:
+            return min(large_enough, key=cost)['url']
+        return max(sized, key=cost)['url']
+
+    def _shrink(self, data: bytes, mime: str) -> Tuple[bytes, str]:
+        """Downscale and re-encode an image to a size-capped JPEG"""
         try:
-            audio = MP3(mp3_file, ID3=ID3)
+            from PIL import Image
+        except ImportError:
+            with self._lock:
+                if not self._warned:
+                    self._warned = True
+                    self.logger.warning(
+                        f"Pillow is not installed, thumbnails are embedded without being shrunk "
+                        f"to {self.size}px and {self.max_bytes // 1024}KB"
+                    )
+            return data, mime
 
-            # Create ID3 tag if it doesn't exist
-            try:
-                audio.add_tags()
-            except:
-                pass
+        image = Image.open(io.BytesIO(data))
+        scale = self.size / min(image.size)
+        if mime == 'image/jpeg' and scale >= 1 and len(data) <= self.max_bytes:
+            return data, mime
 
-            # Add the album art
-            audio.tags.add(
-                APIC(
-                    encoding=3,  # UTF-8
-                    mime='image/jpeg',
-                    type=3,  # Cover (front)
-                    desc='Cover',
-                    data=thumbnail_data
-                )
-            )
+        if scale < 1:
+            image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+        image = image.convert('RGB')
 
-            # Save the changes
-            audio.save()
-            return True
+        for quality in (90, 80, 70, 60, 50):
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=quality, optimize=True)
+            if output.tell() <= self.max_bytes:
+                break
+        return output.getvalue(), 'image/jpeg'
+
+    def _fetch(self, url: str) -> Optional[Tuple[bytes, str]]:
+        response = self._session.get(url, timeout=30)
+        if response.status_code != 200:
+            return None
+
+        mime = self.detect_mime(response.content)
+        if mime is None:
+            self.logger.debug(f"Ignoring thumbnail of unknown type: {url}")
+            return None
+        return self._shrink(response.content, mime)
+
+    def prefetch(self, info_dict: Dict[str, Any]):
+        """Start fetching the thumbnail of a video, returning its future"""
+        import requests
+        from concurrent.futures import ThreadPoolExecutor
+
+        url = self.select(info_dict.get('thumbnails'))
+        if url is None:
+            return None
+
+        with self._lock:
+            future = self._cache.pop(url, None)
+            if future is None or (future.done() and (future.exception() or future.result() is None)):
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix='youtube2mp3-thumbnail')
+                    self._session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers)
+                    self._session.mount('http://', adapter)
+                    self._session.mount('https://', adapter)
+                future = self._executor.submit(self._fetch, url)
+
+            # Most recently used last, the oldest entry is evicted first
+            self._cache[url] = future
+            if len(self._cache) > self.cache_size:
+                del self._cache[next(iter(self._cache))]
+        return future
+
+    def get(self, info_dict: Dict[str, Any], timeout: float = 60.0) -> Optional[Tuple[bytes, str]]:
+        """Get the (data, MIME type) of a video's thumbnail, None when there is none"""
+        future = self.prefetch(info_dict)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
         except Exception as e:
-            print(f"Error adding thumbnail: {e}")
-            return False
+            self.logger.warning(f"Could not fetch thumbnail: {e}")
+            return None
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
 
 class YouTubeSearcher:
     """Searches for YouTube videos"""
 
     @staticmethod
-    def search(query: str, max_results: int = 5) -> List[Dict[str, str]]:
+    def search(query: str, max_results: int = 5, cache: Optional['MetadataCache'] = None) -> List[Dict[str, str]]:
         """Search for YouTube videos using yt-dlp"""
+        key = f"ytsearch{max_results}:{query}"
+        if cache:
+            results = cache.get(key)
+            if results is not None:
+                return results
+
         try:
             ydl_opts = {
                 'quiet': True,
@@ -193,7 +492,7 @@ class YouTubeSearcher:
                 'max_downloads': max_results,
             }
 
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            with YouTubeDownloader.create_ydl(ydl_opts) as ydl:
                 search_results = ydl.extract_info(f"ytsearch{max_results}:{query}", download=False)
 
                 if not search_results or 'entries' not in search_results:
@@ -210,6 +509,9 @@ class YouTubeSearcher:
                             'uploader': entry.get('uploader', 'Unknown Uploader')
                         })
 
+                if cache:
+                    cache.put(key, results)
+
                 return results
         except Exception as e:
             print(f"Error searching YouTube: {e}")
@@ -231,6 +533,7 @@ class ProgressBar:
                     if total is None:
                         total = d.get('total_bytes_estimate', 0)
 
+                    from tqdm import tqdm
                     self.pbar = tqdm(
                         total=total,
                         unit='B',
@@ -253,251 +556,3574 @@ class ProgressBar:
             self.pbar = None
 
 
-class YouTubeDownloader:
-    """Handles downloading and converting YouTube videos to MP3"""
+class StageMetrics:
+    """Duration, byte and outcome histograms for each stage of a job
 
-    def __init__(self, output_dir: Path, skip_playlist: bool = True, 
-                logger: Optional[Logger] = None, rate_limit: Optional[int] = None,
-                add_metadata: bool = True):
-        self.output_dir = output_dir
-        self.skip_playlist = skip_playlist
-        self.logger = logger or Logger()
-        self.rate_limit = rate_limit
-        self.add_metadata = add_metadata
+    The stages are extract (metadata resolution and yt-dlp overhead), download,
+    encode and tag, plus prefetch when metadata is resolved ahead. The metrics
+    can be printed as a summary, written as a JSON report, or exported
+    periodically in the Prometheus textfile format. When profile_dir is set,
+    worker threads wrapped with profiled() dump their cProfile stats there.
+    """
 
-        # Ensure output directory exists
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
 
-    def _get_download_options(self) -> dict:
-        """Get the options for yt-dlp"""
-        options = {
-            'format': 'bestaudio/best',
-            'noplaylist': self.skip_playlist,
-            'outtmpl': str(self.output_dir / '%(title)s.%(ext)s'),
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'logger': self.logger.logger,
-            'progress_hooks': [ProgressBar()],
-            'writethumbnail': self.add_metadata,
-            'writeinfojson': self.add_metadata,
-        }
+    def __init__(self, profile_dir: Optional[Path] = None):
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._jobs = {}
+        self._started = time.time()
+        self._export_stop = threading.Event()
+        self._export_thread = None
 
-        # Add rate limit if specified
-        if self.rate_limit:
-            options['ratelimit'] = self.rate_limit * 1024  # Convert to bytes
+        if self.profile_dir:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
 
-        return options
+    def record(self, stage: str, seconds: float, nbytes: int = 0, outcome: str = 'ok') -> None:
+        """Record one run of a stage"""
+        with self._lock:
+            data = self._stages.get(stage)
+            if data is None:
+                data = self._stages[stage] = {
+                    'count': 0, 'sum': 0.0, 'bytes': 0, 'outcomes': {}, 'buckets': [0] * len(self.BUCKETS)
+                }
+            data['count'] += 1
+            data['sum'] += seconds
+            data['bytes'] += nbytes
+            data['outcomes'][outcome] = data['outcomes'].get(outcome, 0) + 1
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    data['buckets'][i] += 1
+                    break
 
-    def _process_metadata(self, info_dict: Dict[str, Any], filename: str) -> None:
-        """Process metadata for the downloaded file"""
-        if not self.add_metadata:
-            return
+    def record_job(self, outcome: str) -> None:
+        with self._lock:
+            self._jobs[outcome] = self._jobs.get(outcome, 0) + 1
 
+    @contextmanager
+    def time(self, stage: str):
+        """Time the body of a with statement as one run of a stage"""
+        started = time.perf_counter()
+        outcome = 'failed'
         try:
-            # Get the base filename without extension
-            base_filename = os.path.splitext(filename)[0]
-            mp3_file = Path(f"{base_filename}.mp3")
+            yield
+            outcome = 'ok'
+        finally:
+            self.record(stage, time.perf_counter() - started, outcome=outcome)
 
-            if not mp3_file.exists():
-                self.logger.warning(f"MP3 file not found: {mp3_file}")
-                return
+    def _quantile(self, data: Dict[str, Any], q: float) -> Optional[float]:
+        """Estimate a quantile as the upper bound of the bucket it falls in, None past the last finite bound"""
+        target = q * data['count']
+        seen = 0
+        for bound, count in zip(self.BUCKETS, data['buckets']):
+            seen += count
+            if seen >= target:
+                break
+        # Infinity is not valid JSON
+        return None if bound == float('inf') else bound
 
-            # Add basic metadata
-            title = info_dict.get('title', os.path.basename(base_filename))
-            artist = info_dict.get('uploader', 'YouTube')
-            album = info_dict.get('album', 'YouTube to MP3')
+    @classmethod
+    def format_quantile(cls, value: Optional[float]) -> str:
+        """Format a quantile estimated by report()"""
+        return f"<= {value:.3g}s" if value is not None else f"> {cls.BUCKETS[-2]:.3g}s"
 
-            MetadataManager.add_metadata(mp3_file, title, artist, album)
+    def report(self) -> Dict[str, Any]:
+        """Get all metrics as a JSON-serializable dict"""
+        with self._lock:
+            stages = {}
+            for stage, data in self._stages.items():
+                stages[stage] = {
+                    'count': data['count'],
+                    'seconds': data['sum'],
+                    'mean': data['sum'] / data['count'],
+                    'p50': self._quantile(data, 0.5),
+                    'p95': self._quantile(data, 0.95),
+                    'bytes': data['bytes'],
+                    'outcomes': dict(data['outcomes']),
+                    'buckets': dict(zip(map(str, self.BUCKETS), data['buckets'])),
+                }
+            return {'elapsed': time.time() - self._started, 'jobs': dict(self._jobs), 'stages': stages}
 
-            # Try to add thumbnail
-            thumbnail_file = Path(f"{base_filename}.jpg")
-            if thumbnail_file.exists():
-                with open(thumbnail_file, 'rb') as f:
-                    thumbnail_data = f.read()
-                MetadataManager.add_thumbnail(mp3_file, thumbnail_data)
-                # Clean up thumbnail file
-                thumbnail_file.unlink(missing_ok=True)
+    def summary(self) -> List[str]:
+        """Get a human readable summary, one line per stage"""
+        from tqdm import tqdm
 
-            # Clean up info JSON file
-            info_json = Path(f"{base_filename}.info.json")
-            if info_json.exists():
-                info_json.unlink(missing_ok=True)
+        report = self.report()
+        jobs = ', '.join(f"{count} {outcome}" for outcome, count in sorted(report['jobs'].items()))
+        lines = [f"Jobs: {jobs or 'none'} in {tqdm.format_interval(report['elapsed'])}"]
+        for stage, data in report['stages'].items():
+            line = (f"{stage:>8}: {data['count']} runs, {data['seconds']:.1f}s total, "
+                    f"mean {data['mean']:.2f}s, p50 {self.format_quantile(data['p50'])}, "
+                    f"p95 {self.format_quantile(data['p95'])}")
+            if data['bytes']:
+                line += f", {tqdm.format_sizeof(data['bytes'], 'B', 1024)}"
+            lines.append(line)
+        return lines
 
-            self.logger.info(f"Added metadata to {mp3_file.name}")
+    def write_json(self, path: Path) -> None:
+        self._write_atomic(path, json.dumps(self.report(), indent=2))
 
-        except Exception as e:
-            self.logger.error(f"Error processing metadata: {e}")
+    def write_prometheus(self, path: Path) -> None:
+        """Write the metrics for the node_exporter textfile collector"""
+        report = self.report()
+        lines = [
+            '# HELP youtube2mp3_stage_seconds Duration of each job stage.',
+            '# TYPE youtube2mp3_stage_seconds histogram',
+        ]
+        for stage, data in report['stages'].items():
+            cumulative = 0
+            for bound, count in data['buckets'].items():
+                cumulative += count
+                le = '+Inf' if bound == 'inf' else bound
+                lines.append(f'youtube2mp3_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'youtube2mp3_stage_seconds_sum{{stage="{stage}"}} {data["seconds"]}')
+            lines.append(f'youtube2mp3_stage_seconds_count{{stage="{stage}"}} {data["count"]}')
 
-    def download(self, url: str) -> bool:
-        """Download and convert a YouTube video to MP3"""
-        options = self._get_download_options()
+        lines += ['# HELP youtube2mp3_stage_bytes_total Bytes handled by each job stage.',
+                  '# TYPE youtube2mp3_stage_bytes_total counter']
+        for stage, data in report['stages'].items():
+            lines.append(f'youtube2mp3_stage_bytes_total{{stage="{stage}"}} {data["bytes"]}')
 
-        try:
-            with yt_dlp.YoutubeDL(options) as ydl:
-                self.logger.info(f"Processing URL: {url}")
-                info_dict = ydl.extract_info(url, download=True)
+        lines += ['# HELP youtube2mp3_jobs_total Finished jobs by outcome.',
+                  '# TYPE youtube2mp3_jobs_total counter']
+        for outcome, count in report['jobs'].items():
+            lines.append(f'youtube2mp3_jobs_total{{outcome="{outcome}"}} {count}')
 
-                if info_dict:
-                    filename = ydl.prepare_filename(info_dict)
-                    self._process_metadata(info_dict, filename)
+        self._write_atomic(path, '\n'.join(lines) + '\n')
 
-                return True
-        except yt_dlp.utils.DownloadError as error:
-            self.logger.error(f"Download failed: {error}")
-            return False
+    @staticmethod
+    def _write_atomic(path: Path, content: str) -> None:
+        # The collector must never read a half-written file
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(content, encoding='utf-8')
+        os.replace(tmp, path)
 
+    def start_export(self, path: Path, interval: float = 15.0) -> None:
+        """Rewrite the Prometheus file every interval seconds until stop_export"""
+        def export() -> None:
+            while not self._export_stop.wait(interval):
+                self.write_prometheus(path)
 
-class ThreadedDownloader:
-    """Handles multi-threaded downloading"""
+        self._export_thread = threading.Thread(target=export)
+        self._export_thread.daemon = True
+        self._export_thread.start()
 
-    def __init__(self, urls: List[str], output_dir: Path, num_threads: int, 
-                skip_playlist: bool = True, logger: Optional[Logger] = None,
-                rate_limit: Optional[int] = None, add_metadata: bool = True):
-        self.urls = urls
-        self.output_dir = output_dir
-        self.num_threads = num_threads
-        self.skip_playlist = skip_playlist
-        self.logger = logger or Logger()
-        self.rate_limit = rate_limit
-        self.add_metadata = add_metadata
-        self.url_queue = queue.Queue()
+    def stop_export(self) -> None:
+        self._export_stop.set()
+        if self._export_thread:
+            self._export_thread.join()
 
-        # Add URLs to queue
-        for url in self.urls:
-            self.url_queue.put(url)
+    def profiled(self, target, name: str):
+        """Wrap a thread target so it runs under cProfile when profiling is enabled"""
+        if not self.profile_dir:
+            return target
 
-    def _worker(self) -> None:
-        """Worker function for threaded downloads"""
-        downloader = YouTubeDownloader(
-            output_dir=self.output_dir,
-            skip_playlist=self.skip_playlist,
-            logger=self.logger,
-            rate_limit=self.rate_limit,
-            add_metadata=self.add_metadata
+        def run(*args, **kwargs):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profile.disable()
+                profile.dump_stats(str(self.profile_dir / f"{name}.prof"))
+
+        return run
+
+
+class ProgressDashboard:
+    """Aggregated progress display for the multi-worker engines
+
+    yt-dlp hooks only put events on a queue. A single render thread drains it
+    and redraws a compact dashboard at a fixed rate, with totals and one line
+    per busy worker, and prints log records above it. When the output is not
+    a terminal, a summary line is printed every summary_interval seconds.
+    """
+
+    def __init__(self, stream=None, refresh: float = 0.5, summary_interval: float = 30.0,
+                queue_depth=None):
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.refresh = refresh
+        self.summary_interval = summary_interval
+        self.queue_depth = queue_depth  # callable returning the encode backlog
+
+        self._events = queue.SimpleQueue()
+        self._workers = {}
+        self._names = {}
+        self._done = 0
+        self._failed = 0
+        self._bytes = 0
+        self._rate = 0.0
+        self._sampled_bytes = 0
+        self._sampled_at = self._started = time.monotonic()
+        self._summary_at = self._sampled_at
+        self._height = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # Producers, called from the worker threads
+
+    def progress_hook(self, d: Dict[str, Any]) -> None:
+        if d['status'] == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+            title = (d.get('info_dict') or {}).get('title') or os.path.basename(d.get('filename') or '')
+            self._events.put(('progress', threading.get_ident(), (title, d.get('downloaded_bytes') or 0, total)))
+
+    def postprocessor_hook(self, d: Dict[str, Any]) -> None:
+        if d['postprocessor'] == 'ExtractAudio' and d['status'] == 'started':
+            title = (d.get('info_dict') or {}).get('title') or ''
+            self._events.put(('encoding', threading.get_ident(), title))
+
+    def job_finished(self, succeeded: Optional[bool]) -> None:
+        """Mark the calling worker idle, counting the job unless succeeded is None"""
+        self._events.put(('job', threading.get_ident(), succeeded))
+
+    def write(self, line: str) -> None:
+        self._events.put(('log', None, line))
+
+    # Rendering, only done by the render thread
+
+    def _drain(self) -> List[str]:
+        logs = []
+        while True:
+            try:
+                kind, ident, data = self._events.get_nowait()
+            except queue.Empty:
+                return logs
+
+            if kind == 'log':
+                logs.append(data)
+                continue
+
+            name = self._names.setdefault(ident, f"#{len(self._names) + 1}")
+            if kind == 'progress':
+                title, downloaded, total = data
+                worker = self._workers.get(name)
+                if worker is None or worker['title'] != title or downloaded < worker['downloaded']:
+                    worker = self._workers[name] = {'title': title, 'downloaded': 0, 'state': 'download'}
+                self._bytes += downloaded - worker['downloaded']
+                worker.update(downloaded=downloaded, total=total)
+            elif kind == 'encoding':
+                self._workers.setdefault(name, {'title': data, 'downloaded': 0, 'total': 0})['state'] = 'encode'
+            elif kind == 'job':
+                self._workers.pop(name, None)
+                if data is True:
+                    self._done += 1
+                elif data is False:
+                    self._failed += 1
+
+    def _summary(self, final: bool = False) -> str:
+        from tqdm import tqdm
+
+        now = time.monotonic()
+        elapsed = now - self._sampled_at
+        if final:
+            self._rate = self._bytes / max(now - self._started, 1e-6)
+        elif elapsed > 0:
+            rate = (self._bytes - self._sampled_bytes) / elapsed
+            self._rate = rate if not self._rate else 0.7 * self._rate + 0.3 * rate
+        self._sampled_bytes, self._sampled_at = self._bytes, now
+
+        remaining = sum(
+            max(0, w.get('total', 0) - w['downloaded']) for w in self._workers.values() if w['state'] == 'download'
         )
+        eta = tqdm.format_interval(remaining / self._rate) if self._rate > 0 else '--:--'
+        encoding = (self.queue_depth() if self.queue_depth else
+                    sum(1 for w in self._workers.values() if w['state'] == 'encode'))
+
+        return (f"{self._done} done, {self._failed} failed, {len(self._workers)} active | "
+                f"{tqdm.format_sizeof(self._rate, 'B/s', 1024)} | ETA {eta} | encode queue {encoding}")
+
+    def _render(self, logs: List[str], final: bool = False) -> None:
+        if not self.tty:
+            for line in logs:
+                self.stream.write(line + '\n')
+            if final or time.monotonic() - self._summary_at >= self.summary_interval:
+                self._summary_at = time.monotonic()
+                self.stream.write(self._summary(final) + '\n')
+            self.stream.flush()
+            return
 
-        while not self.url_queue.empty():
-            url = self.url_queue.get()
-            downloader.download(url)
-            self.url_queue.task_done()
+        from tqdm import tqdm
+
+        width = shutil.get_terminal_size().columns - 1
+        lines = [self._summary(final)]
+        for name, worker in sorted(self._workers.items()):
+            if worker['state'] == 'encode':
+                status = 'encoding'
+            elif worker.get('total'):
+                status = f"{worker['downloaded'] * 100 // worker['total']:3d}% of {tqdm.format_sizeof(worker['total'], 'B', 1024)}"
+            else:
+                status = tqdm.format_sizeof(worker['downloaded'], 'B', 1024)
+            lines.append(f"  {name:>4} {status:<16} {worker['title']}")
+
+        out = [f"\033[{self._height}F"] if self._height else []
+        out += [f"\033[K{line}\n" for line in logs]
+        out += [f"\033[K{line[:width]}\n" for line in lines]
+        out.append("\033[J")
+        self._height = len(lines)
+        self.stream.write(''.join(out))
+        self.stream.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.refresh):
+            self._render(self._drain())
 
     def start(self) -> None:
-        """Start the threaded download process"""
-        self.logger.info(f"Starting {self.num_threads} download threads")
+        ConsoleHandler.dashboard = self
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
 
-        threads = []
-        for i in range(self.num_threads):
-            thread = threading.Thread(target=self._worker)
-            thread.daemon = True
-            threads.append(thread)
-            thread.start()
+    def stop(self) -> None:
+        """Stop redrawing and print the final totals"""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        ConsoleHandler.dashboard = None
 
-        # Wait for all threads to complete
-        for thread in threads:
-            thread.join()
+        logs = self._drain()
+        self._workers.clear()
+        self._render(logs, final=True)
 
-        self.logger.info("All downloads completed")
 
+class BandwidthLimiter:
+    """Token bucket shared by every download of the process
 
-class URLExtractor:
-    """Extracts YouTube URLs from a file"""
-    
-    @staticmethod
-    def extract_from_file(file_path: Path) -> Set[str]:
-        """Extract YouTube URLs from a file"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # URL pattern regexp
-        url_pattern = re.compile(
-            r"(http|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:\/~+#-]*[\w@?^=%&\/~+#-])?"
-        )
-        
-        # Detect YouTube URLs
-        matches = re.finditer(url_pattern, content)
-        return {url.group() for url in matches if 'youtu' in url.group()}
+    Downloads draw tokens from their progress hooks and sleep when the bucket
+    runs dry, so the configured rate is an aggregate budget no matter how many
+    workers are running. Tokens are reserved in arrival order, which shares the
+    budget evenly between the active downloads.
+    """
 
+    def __init__(self, rate: int, burst: float = 1.0, control_file: Optional[Path] = None,
+                logger: Optional[Logger] = None):
+        self.rate = rate  # bytes per second, 0 means unlimited
+        self.burst = burst  # seconds worth of tokens that may be spent at once
+        self.control_file = control_file
+        self.logger = logger or Logger()
+        self._lock = threading.Lock()
+        self._tokens = rate * burst
+        self._updated = time.monotonic()
+        self._control_mtime = None
+        self._control_checked = 0.0
+
+        if self.control_file:
+            self._check_control_file(self._updated)
+
+    def set_rate(self, rate: int) -> None:
+        """Change the limit (bytes/s) while downloads are running"""
+        if rate != self.rate:
+            limit = f"{rate / 1024:g} KB/s" if rate else 'unlimited'
+            self.logger.info(f"Rate limit set to {limit}")
+        self.rate = rate
+        self._tokens = min(self._tokens, rate * self.burst)
+
+    def _check_control_file(self, now: float) -> None:
+        """Pick up a new limit (KB/s) written to the control file"""
+        if now - self._control_checked < 1.0:
+            return
+        self._control_checked = now
 
-class ArgumentValidator:
-    """Validates command line arguments"""
-    
-    @staticmethod
-    def validate_url(url: str) -> str:
-        """Validate a YouTube URL"""
-        if not validators.url(url):
-            raise ArgumentTypeError(f"Invalid URL: {url}")
-        
-        if 'youtu' not in url:
-            raise ArgumentTypeError(f"Not a YouTube URL: {url}")
-        
-        return url
-    
-    @staticmethod
-    def validate_file(file_path: str) -> Path:
-        """Validate that a file exists and is readable"""
-        path = Path(file_path)
-        
-        if not path.is_file():
-            raise ArgumentTypeError(f"File does not exist: {file_path}")
-        
-        if not os.access(path, os.R_OK):
-            raise ArgumentTypeError(f"File is not readable: {file_path}")
-        
-        return path
-    
-    @staticmethod
-    def validate_directory(dir_path: str) -> Path:
-        """Validate that a directory exists and is writable"""
-        path = Path(dir_path)
-        
-        if not path.is_dir():
-            raise ArgumentTypeError(f"Directory does not exist: {dir_path}")
-        
-        if not os.access(path, os.W_OK):
-            raise ArgumentTypeError(f"Directory is not writable: {dir_path}")
-        
-        return path
-    
-    @staticmethod
-    def validate_rate_limit(rate: str) -> int:
-        """Validate rate limit (in KB/s)"""
         try:
-            rate_int = int(rate)
-            if rate_int <= 0:
-                raise ArgumentTypeError("Rate limit must be a positive integer")
-            return rate_int
+            mtime = self.control_file.stat().st_mtime
+            if mtime == self._control_mtime:
+                return
+            self._control_mtime = mtime
+            self.set_rate(int(self.control_file.read_text().strip()) * 1024)
+        except FileNotFoundError:
+            pass
         except ValueError:
-            raise ArgumentTypeError("Rate limit must be a positive integer")
+            self.logger.warning(f"Ignoring invalid rate limit in {self.control_file}")
 
+    def consume(self, nbytes: int) -> None:
+        """Take tokens for nbytes, sleeping until the budget allows it"""
+        with self._lock:
+            now = time.monotonic()
+            if self.control_file:
+                self._check_control_file(now)
+            if self.rate <= 0:
+                return
 
-class YouTubeToMP3:
-    """Main application class"""
-    
-    def __init__(self):
-        self.logger = Logger()
-        self.args = self._parse_arguments()
-    
-    def _parse_arguments(self):
-        """Parse command line arguments"""
-        parser = ArgumentParser(
-            description=f"{Fore.RED}YouTube{Style.RESET_ALL} to {Fore.GREEN}MP3{Style.RESET_ALL} Converter",
-            formatter_class=RawTextHelpFormatter
+            elapsed = now - self._updated
+            self._tokens = min(self.rate * self.burst, self._tokens + elapsed * self.rate)
+            self._updated = now
+            self._tokens -= nbytes
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+    def progress_hook(self):
+        """Create a yt-dlp progress hook that charges downloaded bytes"""
+        seen = {}
+
+        def hook(d: Dict[str, Any]) -> None:
+            if d['status'] != 'downloading':
+                seen.pop(d.get('filename'), None)
+                return
+            downloaded = d.get('downloaded_bytes') or 0
+            delta = downloaded - seen.get(d.get('filename'), 0)
+            seen[d.get('filename')] = downloaded
+            if delta > 0:
+                self.consume(delta)
+
+        return hook
+
+
+class DownloadArchive:
+    """Persistent index of videos that have already been converted"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS archive ("
+            "video_id TEXT NOT NULL, settings TEXT NOT NULL, path TEXT, added REAL, "
+            "PRIMARY KEY (video_id, settings))"
         )
-        
-        input_group = parser.add_mutually_exclusive_group(required=True)
-        input_group.add_argument(
-            '-u', '--url',
-            type=ArgumentValidator.validate_url,
+        self._conn.commit()
+
+        # Keep the keys in memory so lookups never touch the disk
+        self._entries = set(self._conn.execute("SELECT video_id, settings FROM archive"))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def contains(self, video_id: str, settings: str) -> bool:
+        """Check whether a video was already converted with the given settings"""
+        return (video_id, settings) in self._entries
+
+    def add(self, video_id: str, settings: str, path: Optional[Path] = None) -> None:
+        """Record a converted video"""
+        with self._lock:
+            self._entries.add((video_id, settings))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?)",
+                (video_id, settings, str(path) if path else None, time.time())
+            )
+            self._conn.commit()
+
+    def _replace(self, root: Path, rows: List[Tuple[str, str, str, float]]) -> int:
+        """Replace the entries of the files below root, keeping those of other directories"""
+        root = root.resolve()
+        with self._lock:
+            stale = [(video_id, settings)
+                     for video_id, settings, path in self._conn.execute("SELECT video_id, settings, path FROM archive")
+                     if path and Path(path).resolve().is_relative_to(root)]
+            self._conn.executemany("DELETE FROM archive WHERE video_id = ? AND settings = ?", stale)
+            self._conn.executemany("INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._entries = set(self._conn.execute("SELECT video_id, settings FROM archive"))
+
+        return len(self._entries)
+
+    def rebuild(self, directory: Path, settings: Optional[str] = None) -> int:
+        """Rebuild the archive entries of a directory from the tags of its audio files
+
+        Files without a settings tag are matched against settings, the key of
+        the current output settings.
+        """
+        rows = []
+        for audio_file in directory.rglob('*'):
+            if audio_file.suffix.lstrip('.').lower() not in OutputFormat.EXTENSIONS:
+                continue
+            # Files written with -n have no tags, only the ID in their name
+            tags = MetadataManager.read_tags(audio_file) or {}
+            video_id = tags.get('video_id')
+            if not video_id:
+                match = LibraryRetagger.NAME_ID_PATTERN.search(audio_file.stem)
+                video_id = match.group(1) if match else None
+            if not video_id:
+                continue
+            try:
+                key = tags.get('settings') or OutputFormat.settings_key_of(audio_file, settings)
+            except Exception:
+                continue
+            if key:
+                rows.append((video_id, key, str(audio_file), audio_file.stat().st_mtime))
+
+        return self._replace(directory, rows)
+
+    def rebuild_from(self, manifest: Manifest) -> int:
+        """Rebuild the archive entries of a manifest's tree, without opening the audio files"""
+        rows = [(record['id'], record['settings'], str(record['path']), record['time'])
+                for record in manifest.records() if record['path'].exists()]
+        return self._replace(manifest.root, rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class Manifest:
+    """Append-only JSON lines index of the files in the output tree
+
+    Every written file adds a line with its video ID, path, output settings,
+    size, duration, bitrate and whether it was tagged; the last line of an ID
+    wins. Paths below the manifest's directory are stored relative to it, so
+    the tree can be mounted elsewhere. Lines are short single writes to a file
+    opened for appending, so several processes can share a manifest.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.root = path.parent
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._entries = None
+
+    def _relative(self, path: Path) -> str:
+        try:
+            return str(path.resolve().relative_to(self.root.resolve()))
+        except ValueError:
+            return str(path.resolve())
+
+    @staticmethod
+    def stream_info(path: Path) -> Dict[str, Any]:
+        """Read the size, duration and bitrate of a file, as stored in a record"""
+        duration, bitrate = MetadataManager.read_stream_info(path)
+        return {'size': path.stat().st_size, 'duration': round(duration, 3) if duration else None,
+                'bitrate': bitrate}
+
+    def add(self, video_id: str, path: Path, settings: str, tagged: bool,
+            stream: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Record a written file, with its stream info when it was read before the file was moved"""
+        record = {
+            'id': video_id, 'path': self._relative(path), 'settings': settings,
+            **(stream or self.stream_info(path)), 'tagged': tagged, 'time': time.time(),
+        }
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self._entries is not None:
+                self._entries[video_id] = record
+        return record
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        """Read the latest record of every ID, once"""
+        with self._lock:
+            if self._entries is None:
+                entries = {}
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # Torn write from a crash
+                            continue
+                        entries[record['id']] = record
+                self._entries = entries
+            return self._entries
+
+    def lookup(self, video_id: str) -> Optional[Dict[str, Any]]:
+        """Get the latest record of a video, with its path made absolute"""
+        record = self._load().get(video_id)
+        if record is None:
+            return None
+        return {**record, 'path': self.root / record['path']}
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """Iterate over the latest record of every video"""
+        for video_id in list(self._load()):
+            yield self.lookup(video_id)
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class StagingArea:
+    """Scratch directory where jobs are written before they are published
+
+    Partial downloads, source media and converted files all live in the
+    staging directory, e.g. on tmpfs or a local disk, so a slow or network
+    output tree only sees finished files. A tagged file is published with a
+    rename, or with copy, fsync and rename when the output tree is on another
+    filesystem, so readers never see a partial file. The files of a download
+    that fails are deleted, so the reserved space matches the disk usage.
+    With max_bytes set, a job waits before its first download until enough staged space is
+    published or released; a download larger than the cap still runs, alone.
+    Later downloads of a job that already holds space, e.g. the entries of a
+    playlist, are never held back, because the space they would wait for is
+    only freed by the same job.
+    """
+
+    def __init__(self, staging_dir: Path, output_dir: Path, max_bytes: Optional[int] = None,
+                 logger: Optional[Logger] = None):
+        self.staging_dir = staging_dir.resolve()
+        self.output_dir = output_dir
+        self.max_bytes = max_bytes
+        self.logger = logger or Logger()
+        self._condition = threading.Condition()
+        self._reserved = {}  # key -> (job, bytes)
+        self._held = {}  # job -> bytes
+        self._stems = {}  # key -> staged path without extension
+        self._used = 0
+
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+
+    def reserve(self, key: str, nbytes: int, job: Optional[str] = None, stem: Optional[str] = None) -> None:
+        """Reserve staging space for a download of a job, waiting while the directory is full
+
+        stem is the path of the download without its extension, its files are
+        deleted when the download is discarded.
+        """
+        with self._condition:
+            if stem:
+                self._stems[key] = stem
+            if self.max_bytes and not self._held.get(job) and self._used and self._used + nbytes > self.max_bytes:
+                self.logger.debug(f"Waiting for {nbytes // 1024}KB of staging space for {key}")
+                self._condition.wait_for(lambda: not self._used or self._used + nbytes <= self.max_bytes)
+            job, reserved = self._reserved.get(key, (job, 0))
+            self._reserved[key] = (job, reserved + nbytes)
+            self._held[job] = self._held.get(job, 0) + nbytes
+            self._used += nbytes
+
+    def release(self, key: Optional[str]) -> None:
+        """Free the space reserved for a download"""
+        with self._condition:
+            self._stems.pop(key, None)
+            job, nbytes = self._reserved.pop(key, (None, 0))
+            if nbytes:
+                self._held[job] -= nbytes
+                if not self._held[job]:
+                    del self._held[job]
+            self._used -= nbytes
+            self._condition.notify_all()
+
+    def discard(self, key: Optional[str]) -> None:
+        """Delete the staged files of a download that will not be published and free its space"""
+        with self._condition:
+            stem = self._stems.get(key)
+        if stem:
+            # Partial (.part) and source files, fragments and the converted file
+            stem = Path(stem)
+            for path in stem.parent.glob(f"{glob.escape(stem.name)}.*"):
+                try:
+                    path.unlink()
+                except OSError as e:
+                    self.logger.warning(f"Could not delete staged file {path}: {e}")
+        self.release(key)
+
+    def target(self, path: Path) -> Path:
+        """Get the path a staged file is published to"""
+        return self.output_dir / path.relative_to(self.staging_dir)
+
+    @staticmethod
+    def _fsync(path: Path) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def publish(self, path: Path, key: Optional[str] = None) -> Path:
+        """Move a finished file into the output tree and free its staging space
+
+        A file that cannot be published keeps its space until it is discarded.
+        """
+        target = self.target(path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Copy next to the target first, so the rename stays atomic
+            partial = target.with_name(f".{target.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+            try:
+                shutil.copyfile(path, partial)
+                self._fsync(partial)
+                os.replace(partial, target)
+            except OSError:
+                partial.unlink(missing_ok=True)
+                raise
+            self._fsync(target.parent)
+            path.unlink()
+        self.release(key)
+        return target
+
+
+class MetadataCache:
+    """On-disk cache of extract_info results with TTL and LRU eviction
+
+    Entries are the sanitized info dicts, stored as compressed JSON. They expire
+    after ttl seconds because the format URLs they contain do, and the least
+    recently used entries are evicted once the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, cache_dir: Path, ttl: int = 4 * 3600, max_size: int = 128 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(cache_dir / 'metadata.db'), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "key TEXT PRIMARY KEY, data BLOB NOT NULL, created REAL NOT NULL, "
+            "accessed REAL NOT NULL, size INTEGER NOT NULL, duration REAL)"
+        )
+        # Caches written before the duration column have it added, their
+        # entries have no duration until they are stored again
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(metadata)")]
+        if 'duration' not in columns:
+            self._conn.execute("ALTER TABLE metadata ADD COLUMN duration REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM metadata").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Any]:
+        """Get a cached entry, or None if it is missing or expired"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT data, created, size FROM metadata WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            data, created, size = row
+            if now - created > self.ttl:
+                self._conn.execute("DELETE FROM metadata WHERE key = ?", (key,))
+                self._conn.commit()
+                self._size -= size
+                return None
+
+            self._conn.execute("UPDATE metadata SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+
+        return json.loads(zlib.decompress(data))
+
+    def duration(self, key: str) -> Optional[float]:
+        """Get the duration of a cached entry without decoding it or touching its recency"""
+        with self._lock:
+            row = self._conn.execute("SELECT duration, created FROM metadata WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return row[0]
+
+    def put(self, key: str, value: Any) -> None:
+        """Store an entry, evicting the least recently used ones if needed"""
+        data = zlib.compress(json.dumps(value).encode('utf-8'))
+        duration = value.get('duration') if isinstance(value, dict) else None
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM metadata WHERE key = ?", (key,)).fetchone()
+            if old:
+                self._size -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, data, created, accessed, size, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, data, now, now, len(data), duration)
+            )
+            self._size += len(data)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """Drop expired entries, then the least recently used until under max_size"""
+        if self._size <= self.max_size:
+            return
+
+        self._conn.execute("DELETE FROM metadata WHERE created < ?", (time.time() - self.ttl,))
+        rows = self._conn.execute("SELECT key, size FROM metadata ORDER BY accessed").fetchall()
+        total = sum(size for _, size in rows)
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            self._conn.execute("DELETE FROM metadata WHERE key = ?", (key,))
+            total -= size
+        self._size = total
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RetryPolicy:
+    """Classifies failed jobs and retries the transient ones with backoff
+
+    Every failure class has its own exponential backoff with jitter. Throttling
+    (HTTP 429) also puts the host on a cooldown that every worker sharing the
+    policy respects. Jobs that finally fail are appended to the dead-letter
+    file, which can be passed back to -f as it is.
+    """
+
+    THROTTLED = 'throttled'
+    NETWORK = 'network'
+    BLOCKED = 'blocked'
+    REMOVED = 'removed'
+    POSTPROCESSOR = 'postprocessor'
+    UNKNOWN = 'unknown'
+
+    PATTERNS = [
+        (THROTTLED, re.compile(r"HTTP Error 429|Too Many Requests|not a bot|rate.?limit", re.I)),
+        (BLOCKED, re.compile(
+            r"not available in your country|geo.?restrict|confirm your age|age.?restrict|"
+            r"members.only|private video|sign in to", re.I)),
+        (REMOVED, re.compile(
+            r"video unavailable|has been removed|no longer available|account .*terminated|"
+            r"does not exist|HTTP Error (404|410)|Unsupported URL", re.I)),
+        (NETWORK, re.compile(
+            r"timed? ?out|connection (reset|refused|aborted)|remote end closed|name resolution|"
+            r"IncompleteRead|HTTP Error (5\d\d|403)|Unable to download|SSL|network", re.I)),
+    ]
+
+    # Base delay and cap in seconds; classes without an entry are not retried
+    BACKOFF = {
+        THROTTLED: (30.0, 900.0),
+        NETWORK: (2.0, 60.0),
+        POSTPROCESSOR: (1.0, 10.0),
+        UNKNOWN: (5.0, 60.0),
+    }
+
+    def __init__(self, max_retries: int = 3, dead_letter: Optional[Path] = None):
+        self.max_retries = max_retries
+        self.dead_letter = dead_letter
+        self._lock = threading.Lock()
+        self._cooldowns = {}
+
+    @staticmethod
+    def classify(error: Exception) -> str:
+        """Get the failure class of an exception raised by yt-dlp or ffmpeg"""
+        import yt_dlp
+
+        if isinstance(error, yt_dlp.utils.PostProcessingError):
+            return RetryPolicy.POSTPROCESSOR
+
+        message = str(error)
+        for failure, pattern in RetryPolicy.PATTERNS:
+            if pattern.search(message):
+                return failure
+
+        cause = getattr(error, 'exc_info', None)
+        cause = cause[1] if cause else error
+        if isinstance(cause, yt_dlp.utils.PostProcessingError):
+            return RetryPolicy.POSTPROCESSOR
+        if isinstance(cause, (OSError, yt_dlp.networking.exceptions.TransportError)):
+            return RetryPolicy.NETWORK
+        return RetryPolicy.UNKNOWN
+
+    def backoff(self, failure: str, attempt: int) -> float:
+        """Get the jittered delay before the next attempt"""
+        base, cap = self.BACKOFF[failure]
+        return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def _sleep(delay: float, cancelled: Optional[threading.Event] = None) -> None:
+        """Sleep for delay seconds, raising DownloadCancelled as soon as cancelled is set"""
+        if cancelled is None:
+            time.sleep(delay)
+        elif cancelled.wait(delay):
+            import yt_dlp
+            raise yt_dlp.utils.DownloadCancelled()
+
+    def wait_for_host(self, url: str, cancelled: Optional[threading.Event] = None) -> None:
+        """Sleep while the host of a URL is cooling down after throttling"""
+        with self._lock:
+            until = self._cooldowns.get(urlparse(url).hostname, 0)
+        delay = until - time.monotonic()
+        if delay > 0:
+            self._sleep(delay, cancelled)
+
+    def _cool_down(self, url: str, delay: float) -> None:
+        host = urlparse(url).hostname
+        with self._lock:
+            self._cooldowns[host] = max(self._cooldowns.get(host, 0), time.monotonic() + delay)
+
+    def _add_dead_letter(self, url: str, failure: str) -> None:
+        if not self.dead_letter:
+            return
+        with self._lock:
+            with open(self.dead_letter, 'a', encoding='utf-8') as f:
+                f.write(f"{url}\t# {failure}\n")
+
+    def run(self, url: str, operation, logger: Logger, on_failure=None,
+            cancelled: Optional[threading.Event] = None) -> Tuple[bool, Any]:
+        """Call operation until it succeeds or fails permanently
+
+        Returns (True, result) on success and (False, None) once the job is
+        given up. on_failure is called after every failed attempt. Setting
+        cancelled interrupts the backoff with DownloadCancelled.
+        """
+        import yt_dlp
+
+        attempt = 0
+        while True:
+            self.wait_for_host(url, cancelled)
+            try:
+                return True, operation()
+            except yt_dlp.utils.DownloadCancelled:
+                raise
+            except Exception as error:
+                if on_failure:
+                    on_failure()
+
+                failure = self.classify(error)
+                if failure in self.BACKOFF and attempt < self.max_retries:
+                    delay = self.backoff(failure, attempt)
+                    if failure == self.THROTTLED:
+                        self._cool_down(url, delay)
+                    logger.warning(f"Retrying {url} in {delay:.0f}s ({failure}, attempt {attempt + 1})")
+                    self._sleep(delay, cancelled)
+                    attempt += 1
+                    continue
+
+                logger.error(f"Download failed ({failure}): {error}")
+                self._add_dead_letter(url, failure)
+                return False, None
+
+
+class JobJournal:
+    """Append-only journal of job state transitions, used to resume batches
+
+    Every record is a JSON line. Records are buffered and written by a
+    background thread, with one fsync per batch, so the workers never wait
+    on the disk.
+    """
+
+    STATES = ('queued', 'downloading', 'encoding', 'tagging', 'done', 'failed')
+
+    # Leftovers of an interrupted job that are removed on resume. Partial
+    # downloads (.part) and complete source files are kept for yt-dlp to reuse.
+    SIDECAR_SUFFIXES = ('.info.json', '.jpg', '.jpeg', '.png', '.webp')
+
+    def __init__(self, path: Path, flush_interval: float = 1.0, batch_size: int = 256):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._file = open(path, 'a+', encoding='utf-8')
+        self._pending = []
+
+        # Terminate a line torn by a crash so the next record stays readable
+        if self._file.tell() > 0:
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != '\n':
+                self._file.write('\n')
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._flusher)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record)
+        with self._condition:
+            self._pending.append(line)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def start(self, output_dir: Path) -> None:
+        """Record the start of a run"""
+        self._write({'event': 'start', 'output_dir': str(output_dir), 'time': time.time()})
+
+    def record(self, url: str, state: str, path: Optional[str] = None,
+               entry: Optional[Dict[str, Any]] = None) -> None:
+        """Record a state transition of a job"""
+        record = {'url': url, 'state': state, 'time': time.time()}
+        if path:
+            record['path'] = path
+        if entry:
+            record['entry'] = entry
+        self._write(record)
+
+    def track(self, urls: Iterable[str], playlists: Optional[PlaylistExpander] = None) -> Iterator[str]:
+        """Record every URL of an iterable as queued while passing it on
+
+        The playlist position of an entry is recorded with it, so a resumed
+        job is tagged with the same album and track number.
+        """
+        for url in urls:
+            entry = playlists.lookup(URLExtractor.video_id(url)) if playlists else None
+            self.record(url, 'queued', entry=entry)
+            yield url
+
+    def _flusher(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or len(self._pending) >= self.batch_size,
+                    timeout=self.flush_interval
+                )
+                lines, self._pending = self._pending, []
+                closed = self._closed
+
+            if lines:
+                self._file.write('\n'.join(lines) + '\n')
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+            if closed:
+                return
+
+    def close(self) -> None:
+        """Flush the remaining records and close the journal"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._file.close()
+
+    @staticmethod
+    def load(path: Path) -> Tuple[Optional[Path], Dict[str, Dict[str, Any]]]:
+        """Read a journal, returning the output directory and the last state of each URL"""
+        output_dir = None
+        jobs = {}
+
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash
+                    continue
+
+                if record.get('event') == 'start':
+                    output_dir = Path(record['output_dir'])
+                    continue
+
+                job = jobs.setdefault(record['url'], {})
+                job['state'] = record['state']
+                if record.get('path'):
+                    job['path'] = record['path']
+                if record.get('entry'):
+                    job['entry'] = record['entry']
+
+        return output_dir, jobs
+
+    @staticmethod
+    def clean_partial(job: Dict[str, Any]) -> None:
+        """Remove the leftovers of an unfinished job"""
+        if not job.get('path'):
+            return
+
+        base = job['path']
+        for suffix in JobJournal.SIDECAR_SUFFIXES:
+            Path(base + suffix).unlink(missing_ok=True)
+
+        # The output of an interrupted ffmpeg run is truncated
+        if job['state'] == 'encoding':
+            for extension in OutputFormat.EXTENSIONS:
+                Path(f"{base}.{extension}").unlink(missing_ok=True)
+                Path(f"{base}.temp.{extension}").unlink(missing_ok=True)
+
+
+class JobStore:
+    """SQLite job queue shared by worker processes, on one host or several
+
+    Jobs are claimed with a lease that a heartbeat thread renews while the
+    worker lives. When a worker dies its leases expire and other workers
+    reclaim the jobs, giving up on a job after max_attempts claims. Workers
+    report state transitions through the JobJournal interface (record and
+    track), so the results of every worker end up in the store.
+
+    The store runs in WAL mode, which needs all workers on one host. With
+    shared=True it uses a rollback journal instead, for a store on a
+    filesystem shared between hosts that supports POSIX locks.
+    """
+
+    TERMINAL = ('done', 'failed')
+
+    def __init__(self, path: Path, lease: float = 300.0, max_attempts: int = 3,
+                 shared: bool = False, poll_interval: float = 5.0):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute(f"PRAGMA journal_mode={'DELETE' if shared else 'WAL'}")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE, meta TEXT, "
+            "state TEXT NOT NULL DEFAULT 'pending', stage TEXT, path TEXT, worker TEXT, "
+            "lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, updated REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            "worker TEXT PRIMARY KEY, output_dir TEXT, started REAL, heartbeat REAL)"
+        )
+
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+    @contextmanager
+    def _transaction(self):
+        """Run a block in an immediate transaction, so claims never race"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def start(self, output_dir: Path) -> None:
+        """Register this worker"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)",
+                         (self.worker, str(output_dir), now, now))
+
+    def add(self, urls: Iterable[str], playlists: Optional[PlaylistExpander] = None,
+            batch_size: int = 1000) -> int:
+        """Queue URLs that are not in the store yet and return how many were added
+
+        The playlist position of an entry is stored with it, so it is tagged
+        the same by whichever worker claims it.
+        """
+        added = 0
+        urls = iter(urls)
+        for batch in iter(lambda: list(itertools.islice(urls, batch_size)), []):
+            rows = []
+            for url in batch:
+                entry = playlists.lookup(URLExtractor.video_id(url)) if playlists else None
+                rows.append((url, json.dumps(entry) if entry else None, time.time()))
+            with self._transaction() as conn:
+                before = conn.total_changes
+                conn.executemany("INSERT OR IGNORE INTO jobs (url, meta, updated) VALUES (?, ?, ?)", rows)
+                added += conn.total_changes - before
+        return added
+
+    def claim(self) -> Optional[Tuple[str, Optional[Dict[str, Any]]]]:
+        """Lease the oldest pending or expired job, returns its URL and playlist entry"""
+        now = time.time()
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute(
+                    "SELECT id, url, meta, stage, path, attempts FROM jobs WHERE state = 'pending' "
+                    "OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1", (now,)
+                ).fetchone()
+                if row is None:
+                    return None
+
+                job_id, url, meta, stage, path, attempts = row
+                if attempts >= self.max_attempts:
+                    conn.execute("UPDATE jobs SET state = 'failed', lease_until = NULL, updated = ? "
+                                 "WHERE id = ?", (now, job_id))
+                    continue
+
+                conn.execute(
+                    "UPDATE jobs SET state = 'leased', stage = NULL, path = NULL, worker = ?, "
+                    "lease_until = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                    (self.worker, now + self.lease, now, job_id)
+                )
+                break
+
+        # A reclaimed job may have left partial files behind
+        if path and stage:
+            JobJournal.clean_partial({'path': path, 'state': stage})
+        return url, json.loads(meta) if meta else None
+
+    def claims(self, playlists: Optional[PlaylistExpander] = None) -> Iterator[str]:
+        """Yield claimed URLs until the jobs of the other workers have finished too
+
+        While other workers hold leases this waits instead of returning, so
+        the jobs of a worker that dies are picked up.
+        """
+        self._start_heartbeat()
+        while not self._stopped.is_set():
+            claimed = self.claim()
+            if claimed:
+                url, entry = claimed
+                if entry and playlists:
+                    playlists.remember(URLExtractor.video_id(url), entry)
+                yield url
+                continue
+
+            with self._lock:
+                unfinished = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE state = 'pending' OR (state = 'leased' AND worker != ?)",
+                    (self.worker,)
+                ).fetchone()[0]
+            if not unfinished:
+                return
+            self._stopped.wait(self.poll_interval)
+
+    def record(self, url: str, state: str, path: Optional[str] = None) -> None:
+        """Record a state transition of a claimed job"""
+        now = time.time()
+        with self._transaction() as conn:
+            if state in self.TERMINAL:
+                conn.execute(
+                    "UPDATE jobs SET state = ?, stage = ?, path = COALESCE(?, path), worker = ?, "
+                    "lease_until = NULL, updated = ? WHERE url = ? AND state != 'done'",
+                    (state, state, path, self.worker, now, url)
+                )
+            elif state != 'queued':
+                conn.execute("UPDATE jobs SET stage = ?, path = COALESCE(?, path), updated = ? WHERE url = ?",
+                             (state, path, now, url))
+
+    def track(self, urls: Iterable[str], playlists: Optional[PlaylistExpander] = None) -> Iterator[str]:
+        """Pass claimed URLs on, they are already recorded in the store"""
+        yield from urls
+
+    def _start_heartbeat(self) -> None:
+        if self._heartbeat:
+            return
+        self._heartbeat = threading.Thread(target=self._renew)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def _renew(self) -> None:
+        """Extend the leases of this worker until it stops"""
+        while not self._stopped.wait(self.lease / 3):
+            now = time.time()
+            with self._transaction() as conn:
+                conn.execute("UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = 'leased'",
+                             (now + self.lease, self.worker))
+                conn.execute("UPDATE workers SET heartbeat = ? WHERE worker = ?", (now, self.worker))
+
+    def summary(self) -> Dict[str, int]:
+        """Count the jobs in each state"""
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        """Stop the heartbeat and hand the unfinished claims of this worker back"""
+        self._stopped.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET state = 'pending', worker = NULL, lease_until = NULL, "
+                         "attempts = MAX(attempts - 1, 0) WHERE worker = ? AND state = 'leased' "
+                         "AND stage IS NULL", (self.worker,))
+            conn.execute("UPDATE jobs SET lease_until = 0 WHERE worker = ? AND state = 'leased'", (self.worker,))
+        self._conn.close()
+
+
+class OutputFormat:
+    """Output codec and quality, and the source formats that need the least conversion
+
+    Sources that already use the output codec are preferred, so ffmpeg only
+    remuxes them into the audio container instead of transcoding. The copy
+    codec never transcodes: the source audio stream is kept as it is.
+    """
+
+    COPY = 'copy'
+
+    # Output codec -> (file extension, yt-dlp filter of sources that are copied as they are)
+    CODECS = {
+        'mp3': ('mp3', '[acodec^=mp3]'),
+        'm4a': ('m4a', '[acodec^=mp4a]'),
+        'opus': ('opus', '[acodec=opus]'),
+        'vorbis': ('ogg', '[acodec=vorbis]'),
+        'flac': ('flac', '[acodec=flac]'),
+    }
+    LOSSLESS = ('flac',)
+
+    # Every extension a converted or copied file can have
+    EXTENSIONS = ('mp3', 'm4a', 'opus', 'ogg', 'flac')
+
+    def __init__(self, codec: str = 'mp3', quality: str = '192'):
+        self.codec = codec
+        self.quality = quality
+
+    @property
+    def extension(self) -> Optional[str]:
+        """Extension of the output files, None when the source stream is copied"""
+        return self.CODECS[self.codec][0] if self.codec != self.COPY else None
+
+    @property
+    def settings_key(self) -> str:
+        """Key describing the output settings, used by the download archive"""
+        if self.codec == self.COPY or self.codec in self.LOSSLESS:
+            return self.codec
+        return f"{self.codec}-{self.quality}"
+
+    @staticmethod
+    def settings_key_of(audio_file: Path, expected: Optional[str] = None) -> Optional[str]:
+        """Get the settings key an existing file was created with
+
+        Tagged files carry the key. For the others it is guessed: the bitrate
+        of an MP3 tells its quality, but copied streams and the VBR output of
+        the other codecs can only be told apart by codec, so they match the
+        expected key when their codec does.
+        """
+        import mutagen
+
+        tags = MetadataManager.read_tags(audio_file)
+        if tags and tags['settings']:
+            return tags['settings']
+
+        codecs = {extension: codec for codec, (extension, _) in OutputFormat.CODECS.items()}
+        codec = codecs.get(audio_file.suffix.lstrip('.').lower())
+        if codec is None:
+            return None
+        if expected and expected.split('-')[0] in (OutputFormat.COPY, codec) and codec != 'mp3':
+            return expected
+        if codec in OutputFormat.LOSSLESS:
+            return codec
+
+        audio = mutagen.File(audio_file)
+        if audio is None or not getattr(audio.info, 'bitrate', 0):
+            return None
+        return f"{codec}-{round(audio.info.bitrate / 1000)}"
+
+    @property
+    def format_selector(self) -> str:
+        """yt-dlp format selector preferring the sources that need the least conversion"""
+        if self.codec == self.COPY:
+            return 'bestaudio/best'
+        return f"bestaudio{self.CODECS[self.codec][1]}/bestaudio/best"
+
+    @property
+    def postprocessor(self) -> Dict[str, Any]:
+        """yt-dlp postprocessor options that convert (or remux) the download"""
+        if self.codec == self.COPY:
+            return {'key': 'FFmpegExtractAudio', 'preferredcodec': 'best'}
+        return {'key': 'FFmpegExtractAudio', 'preferredcodec': self.codec, 'preferredquality': self.quality}
+
+
+class YouTubeDownloader:
+    """Handles downloading and converting YouTube videos to audio files"""
+
+    # Extractor classes registered instead of yt-dlp's own, see benchmark.py
+    INFO_EXTRACTORS: Optional[List[type]] = None
+
+    # Output templates under output_dir. The video ID keeps equal titles apart,
+    # the sharded layout also spreads the files over up to 4096 directories
+    # named after the first two characters of the (random) ID
+    LAYOUTS = {
+        'flat': '%(title)s.%(ext)s',
+        'id': '%(title)s [%(id)s].%(ext)s',
+        'sharded': '%(id.0:2)s/%(title)s [%(id)s].%(ext)s',
+    }
+
+    def __init__(self, output_dir: Path, skip_playlist: bool = True,
+                logger: Optional[Logger] = None, rate_limit: Optional[int] = None,
+                add_metadata: bool = True, archive: Optional[DownloadArchive] = None,
+                extract_audio: bool = True, limiter: Optional[BandwidthLimiter] = None,
+                progress_hooks: Optional[List] = None, postprocessor_hooks: Optional[List] = None,
+                session_jobs: int = 50,
+                cache: Optional[MetadataCache] = None,
+                journal: Optional[JobJournal] = None,
+                retry: Optional[RetryPolicy] = None, dashboard: Optional[ProgressDashboard] = None,
+                metrics: Optional[StageMetrics] = None, output_format: Optional[OutputFormat] = None,
+                thumbnails: Optional[ThumbnailFetcher] = None,
+                playlists: Optional[PlaylistExpander] = None,
+                prefetcher: Optional[MetadataPrefetcher] = None,
+                layout: str = 'id', manifest: Optional[Manifest] = None,
+                staging: Optional[StagingArea] = None, cancelled: Optional[threading.Event] = None,
+                converted: Optional[bool] = None):
+        self.output_dir = output_dir
+        self.skip_playlist = skip_playlist
+        self.output_format = output_format or OutputFormat()
+        self.thumbnails = thumbnails or (ThumbnailFetcher(logger=logger) if add_metadata else None)
+        self.playlists = playlists
+        self.prefetcher = prefetcher
+        self.layout = layout
+        self.manifest = manifest
+        self.staging = staging
+        # Whether a download is converted into a second staged file, by
+        # yt-dlp or by a later stage of the pipelined engine
+        self.converted = extract_audio if converted is None else converted
+        self.logger = logger or Logger()
+        self.rate_limit = rate_limit
+        self.limiter = limiter
+        self.progress_hooks = progress_hooks or []
+        self.postprocessor_hooks = postprocessor_hooks or []
+        self.dashboard = dashboard
+        self.metrics = metrics
+        self.session_jobs = session_jobs
+        self.cache = cache
+        self.journal = journal
+        self.retry = retry or RetryPolicy(max_retries=0)
+        # Set to cut a retry backoff short, progress hooks stop the transfers
+        self.cancelled = cancelled
+        self._job_url = None
+        self._timing = {}
+        self._encode_started = None
+        self._journal_filename = None
+        # Last journalled (state, path) of every unfinished URL, the pipelined
+        # engine journals from several threads through one downloader
+        self._journal_last = {}
+        self._journal_lock = threading.Lock()
+        self._thumbnail_id = None
+        self.files = []  # written by the last job
+        self._staged = set()  # IDs holding staging space
+
+        # Warm session, recycled after session_jobs jobs or after an error
+        self._ydl = None
+        self._jobs = 0
+        self.add_metadata = add_metadata
+        self.archive = archive
+        self.extract_audio = extract_audio
+
+        # Ensure output directory exists
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def settings_key(self) -> str:
+        """Key describing the output settings, used by the download archive"""
+        return self.output_format.settings_key
+
+    def _archive_filter(self, info_dict: Dict[str, Any], *args, **kwargs) -> Optional[str]:
+        """yt-dlp match filter that skips archived playlist entries"""
+        video_id = info_dict.get('id')
+        if video_id and self.archive.contains(video_id, self.settings_key):
+            return f"{video_id} is already in the archive"
+        return None
+
+    def _get_download_options(self) -> dict:
+        """Get the options for yt-dlp"""
+        options = {
+            'format': self.output_format.format_selector,
+            'noplaylist': self.skip_playlist,
+            'outtmpl': str((self.staging.staging_dir if self.staging else self.output_dir) / self.LAYOUTS[self.layout]),
+            'postprocessors': [self.output_format.postprocessor] if self.extract_audio else [],
+            'logger': self.logger.logger,
+            'progress_hooks': [self.dashboard.progress_hook if self.dashboard else ProgressBar(),
+                               *self.progress_hooks],
+            'postprocessor_hooks': [*([self.dashboard.postprocessor_hook] if self.dashboard else []),
+                                    *self.postprocessor_hooks],
+        }
+
+        # Add rate limit if specified, the shared limiter takes precedence
+        if self.limiter:
+            options['progress_hooks'].append(self.limiter.progress_hook())
+        elif self.rate_limit:
+            options['ratelimit'] = self.rate_limit * 1024  # Convert to bytes
+
+        # Skip archived entries before they are downloaded
+        if self.archive is not None:
+            options['match_filter'] = self._archive_filter
+
+        if self.journal:
+            options['progress_hooks'].append(self._journal_progress_hook)
+            options['postprocessor_hooks'].append(self._journal_postprocessor_hook)
+
+        # Fetch the album art while the media downloads
+        if self.add_metadata and self.thumbnails:
+            options['progress_hooks'].append(self._thumbnail_progress_hook)
+
+        if self.metrics:
+            options['progress_hooks'].append(self._metrics_progress_hook)
+            options['postprocessor_hooks'].append(self._metrics_postprocessor_hook)
+
+        return options
+
+    def _add_staging_preprocessor(self, ydl: yt_dlp.YoutubeDL) -> None:
+        """Reserve staging space for every download after its format is selected
+
+        The reservation runs before the transfer is opened, so a download that
+        waits for space does not hold a connection.
+        """
+        from yt_dlp.postprocessor.common import PostProcessor
+
+        downloader = self
+
+        class StagingReservationPP(PostProcessor):
+            def run(self, info):
+                downloader._reserve_staging(info)
+                return [], info
+
+        ydl.add_post_processor(StagingReservationPP(), when='before_dl')
+
+    def _reserve_staging(self, info_dict: Dict[str, Any]) -> None:
+        video_id = info_dict.get('id')
+        if not video_id or video_id in self._staged:
+            return
+        self._staged.add(video_id)
+        formats = info_dict.get('requested_formats') or [info_dict]
+        size = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in formats)
+        # The source and its converted file are staged at the same time
+        stem = os.path.splitext(info_dict['_filename'])[0] if info_dict.get('_filename') else None
+        self.staging.reserve(video_id, size * 2 if self.converted else size, self._job_url, stem)
+
+    def _publish(self, info_dict: Dict[str, Any], filename: str) -> str:
+        """Move a finished file from the staging directory into the output tree"""
+        if not self.staging:
+            return filename
+        target = self.staging.publish(Path(filename), info_dict.get('id'))
+        self._staged.discard(info_dict.get('id'))
+        return str(target)
+
+    def _release_staging(self) -> None:
+        """Delete the staged files of the downloads of a job that will not be published"""
+        if self.staging:
+            for video_id in self._staged:
+                self.staging.discard(video_id)
+        self._staged.clear()
+
+    def _thumbnail_progress_hook(self, d: Dict[str, Any]) -> None:
+        if d['status'] == 'downloading' and d.get('info_dict') and d['info_dict'].get('id') != self._thumbnail_id:
+            self._thumbnail_id = d['info_dict'].get('id')
+            self.thumbnails.prefetch(d['info_dict'])
+
+    def _metrics_progress_hook(self, d: Dict[str, Any]) -> None:
+        if d['status'] == 'finished':
+            self._timing['download'] += d.get('elapsed') or 0.0
+            self._timing['bytes'] += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+
+    def _metrics_postprocessor_hook(self, d: Dict[str, Any]) -> None:
+        if d['postprocessor'] != 'ExtractAudio':
+            return
+        if d['status'] == 'started':
+            self._encode_started = time.perf_counter()
+        elif d['status'] == 'finished' and self._encode_started is not None:
+            self._timing['encode'] += time.perf_counter() - self._encode_started
+            self._encode_started = None
+
+    def _stage(self, stage: str):
+        """Time a stage when metrics are enabled"""
+        return self.metrics.time(stage) if self.metrics else nullcontext()
+
+    def _run_job(self, url: str, prefetched: Optional[Dict[str, Any]] = None) -> Tuple[bool, Any]:
+        """Extract, download and encode a URL through the retry policy
+
+        yt-dlp runs these stages in one call, so download and encode are timed
+        from its hooks and the rest of the call is recorded as extract. A
+        prefetched info dict is only used by the first attempt.
+        """
+        self._timing = {'download': 0.0, 'encode': 0.0, 'bytes': 0}
+        started = time.perf_counter()
+
+        def attempt() -> Optional[Dict[str, Any]]:
+            nonlocal prefetched
+            info_dict, prefetched = prefetched, None
+            return self._extract(self._session(), url, info_dict)
+
+        ok, info_dict = self.retry.run(url, attempt, self.logger, self.close, self.cancelled)
+
+        if self.metrics:
+            outcome = 'ok' if ok else 'failed'
+            timing = self._timing
+            elapsed = time.perf_counter() - started
+            self.metrics.record('extract', max(0.0, elapsed - timing['download'] - timing['encode']), outcome=outcome)
+            if timing['bytes']:
+                self.metrics.record('download', timing['download'], timing['bytes'], outcome)
+            if timing['encode']:
+                self.metrics.record('encode', timing['encode'], outcome=outcome)
+
+        return ok, info_dict
+
+    def _process_metadata(self, info_dict: Dict[str, Any], filename: str) -> bool:
+        """Process metadata for the downloaded file, returns whether it was tagged"""
+        if not self.add_metadata:
+            return False
+
+        try:
+            audio_file = Path(filename)
+
+            if not audio_file.exists():
+                self.logger.warning(f"Audio file not found: {audio_file}")
+                return False
+
+            # Everything is taken from memory and written with a single save
+            title = info_dict.get('title', audio_file.stem)
+            artist = info_dict.get('uploader', 'YouTube')
+            album = info_dict.get('album', 'YouTube to MP3')
+            thumbnail = self.thumbnails.get(info_dict) if self.thumbnails else None
+
+            # Playlist entries are tagged as tracks of an album named after the playlist
+            track = None
+            entry = self.playlists.lookup(info_dict.get('id')) if self.playlists else None
+            if entry:
+                album, track = entry['album'], (entry['track'], entry['tracks'])
+            elif info_dict.get('playlist_title') and info_dict.get('playlist_index'):
+                album = info_dict['playlist_title']
+                track = (info_dict['playlist_index'], info_dict.get('n_entries') or 0)
+
+            if MetadataManager.add_metadata(audio_file, title, artist, album, info_dict.get('id'),
+                                            *(thumbnail or ()), track=track, settings=self.settings_key):
+                self.logger.info(f"Added metadata to {audio_file.name}")
+                return True
+
+        except Exception as e:
+            self.logger.error(f"Error processing metadata: {e}")
+        return False
+
+    def _output_file(self, info_dict: Dict[str, Any]) -> str:
+        """Get the path of the converted (or copied) file of a download"""
+        downloads = info_dict.get('requested_downloads')
+        if downloads and downloads[-1].get('filepath'):
+            return downloads[-1]['filepath']
+
+        filename = self._ydl.prepare_filename(info_dict)
+        if self.extract_audio and self.output_format.extension:
+            return f"{os.path.splitext(filename)[0]}.{self.output_format.extension}"
+        return filename
+
+    def _record_archive(self, info_dict: Dict[str, Any], filename: str) -> None:
+        """Add a converted video to the archive"""
+        if self.archive is None:
+            return
+
+        if info_dict.get('id'):
+            self.archive.add(info_dict['id'], self.settings_key, Path(filename))
+
+    def _stream_info(self, filename: str) -> Optional[Dict[str, Any]]:
+        """Read the manifest's stream info of a file before it is published, None without a manifest"""
+        if not self.manifest:
+            return None
+        try:
+            return Manifest.stream_info(Path(filename))
+        except OSError:
+            return None
+
+    def _record_manifest(self, info_dict: Dict[str, Any], filename: str, tagged: bool,
+                         stream: Optional[Dict[str, Any]] = None) -> None:
+        """Add a written file to the manifest"""
+        if not self.manifest or not info_dict.get('id'):
+            return
+        try:
+            self.manifest.add(info_dict['id'], Path(filename), self.settings_key, tagged, stream)
+        except OSError as e:
+            self.logger.warning(f"Could not add {filename} to the manifest: {e}")
+
+    def _journal(self, url: Optional[str], state: str, path: Optional[str] = None) -> None:
+        if not self.journal or not url:
+            return
+        # yt-dlp may report the same transition more than once
+        with self._journal_lock:
+            if self._journal_last.get(url) == (state, path):
+                return
+            if state in ('done', 'failed'):
+                self._journal_last.pop(url, None)
+            else:
+                self._journal_last[url] = (state, path)
+        self.journal.record(url, state, path)
+
+    def _journal_progress_hook(self, d: Dict[str, Any]) -> None:
+        """Record where the current job writes its files"""
+        if d['status'] == 'downloading' and d.get('filename') != self._journal_filename:
+            self._journal_filename = d.get('filename')
+            self._journal(self._job_url, 'downloading', os.path.splitext(d['filename'])[0])
+
+    def _journal_postprocessor_hook(self, d: Dict[str, Any]) -> None:
+        if d['status'] == 'started' and d['postprocessor'] == 'ExtractAudio':
+            path = d['info_dict'].get('filepath')
+            self._journal(self._job_url, 'encoding', os.path.splitext(path)[0] if path else None)
+
+    def _is_archived(self, url: str) -> bool:
+        """Check the archive and manifest for a URL without touching the network"""
+        video_id = URLExtractor.video_id(url)
+        if self.archive is not None and video_id and self.archive.contains(video_id, self.settings_key):
+            self.logger.info(f"Skipping {url}: already in archive")
+            return True
+        record = self.manifest.lookup(video_id) if self.manifest and video_id else None
+        if record and record['settings'] == self.settings_key and record['path'].exists():
+            self.logger.info(f"Skipping {url}: already written to {record['path']}")
+            return True
+        return False
+
+    def _downloaded_entries(self, ydl: yt_dlp.YoutubeDL, info_dict: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Flatten a (playlist) info dict into the entries that were downloaded"""
+        if info_dict.get('entries') is not None:
+            entries = []
+            for entry in info_dict['entries']:
+                if entry:
+                    entries.extend(self._downloaded_entries(ydl, entry))
+            return entries
+
+        downloads = info_dict.get('requested_downloads')
+        if not downloads:
+            return []
+
+        info_dict['filepath'] = downloads[-1].get('filepath') or self._output_file(info_dict)
+        return [info_dict]
+
+    def _cache_key(self, url: str) -> Optional[str]:
+        """Get the metadata cache key of a URL, None when it is not a single video"""
+        if not self.cache or (not self.skip_playlist and 'list=' in url):
+            return None
+        return URLExtractor.video_id(url)
+
+    def _cache_info(self, ydl: yt_dlp.YoutubeDL, info_dict: Dict[str, Any]) -> None:
+        """Store a resolved video (or the videos of a playlist) in the metadata cache"""
+        if info_dict.get('entries') is not None:
+            for entry in info_dict['entries']:
+                if entry:
+                    self._cache_info(ydl, entry)
+        elif info_dict.get('id') and info_dict.get('formats'):
+            self.cache.put(info_dict['id'], ydl.sanitize_info(info_dict))
+
+    def _resolve(self, ydl: yt_dlp.YoutubeDL, url: str) -> Optional[Dict[str, Any]]:
+        """Resolve the info dict of a URL, from the metadata cache when possible"""
+        key = self._cache_key(url)
+        if key:
+            info_dict = self.cache.get(key)
+            if info_dict and not MetadataPrefetcher.expires_soon(info_dict):
+                self.logger.debug(f"Using cached metadata for {key}")
+                return info_dict
+
+        info_dict = ydl.extract_info(url, download=False)
+        if info_dict and self.cache:
+            self._cache_info(ydl, info_dict)
+        return info_dict
+
+    def _extract(self, ydl: yt_dlp.YoutubeDL, url: str,
+                 info_dict: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Resolve and download a URL, skipping extraction when its info dict is given"""
+        if info_dict is not None:
+            return ydl.process_ie_result(info_dict, download=True)
+        if not self.cache:
+            return ydl.extract_info(url, download=True)
+
+        info_dict = self._resolve(ydl, url)
+        return ydl.process_ie_result(info_dict, download=True) if info_dict else None
+
+    def resolve(self, url: str) -> Optional[Dict[str, Any]]:
+        """Resolve the metadata of a URL without downloading it"""
+        import yt_dlp
+
+        try:
+            return self._resolve(self._session(), url)
+        except yt_dlp.utils.DownloadError as error:
+            self.logger.error(f"Extraction failed: {error}")
+            self.close()
+            return None
+
+    @classmethod
+    def create_ydl(cls, options: dict) -> yt_dlp.YoutubeDL:
+        """Create a YoutubeDL, with only INFO_EXTRACTORS registered when they are set"""
+        import yt_dlp
+
+        if cls.INFO_EXTRACTORS is None:
+            return yt_dlp.YoutubeDL(options)
+
+        ydl = yt_dlp.YoutubeDL(options, auto_init=False)
+        for extractor in cls.INFO_EXTRACTORS:
+            ydl.add_info_extractor(extractor())
+        return ydl
+
+    def _session(self) -> yt_dlp.YoutubeDL:
+        """Get the warm YoutubeDL of this downloader, starting a new one when due"""
+        if self._ydl is not None and self._jobs >= self.session_jobs:
+            self.logger.debug(f"Recycling download session after {self._jobs} jobs")
+            self.close()
+
+        if self._ydl is None:
+            self._ydl = self.create_ydl(self._get_download_options())
+            if self.staging:
+                self._add_staging_preprocessor(self._ydl)
+            self._jobs = 0
+
+        self._jobs += 1
+        return self._ydl
+
+    def close(self) -> None:
+        """Release the YoutubeDL instance and its connection pool"""
+        if self._ydl is not None:
+            self._ydl.close()
+            self._ydl = None
+
+    def _fetch(self, url: str) -> Optional[List[Dict[str, Any]]]:
+        """Download a URL and return the info dict of every downloaded file, None on failure
+
+        Jobs in the archive or manifest are skipped without touching the
+        network. A job without files is journalled as done here, the others
+        once their files are published.
+        """
+        prefetched = self.prefetcher.take(url) if self.prefetcher else None
+        if self._is_archived(url):
+            self._journal(url, 'done')
+            return []
+
+        self._job_url = url
+        self._journal(url, 'downloading')
+        self.logger.info(f"Processing URL: {url}")
+
+        ok, info_dict = self._run_job(url, prefetched)
+        if not ok:
+            self._journal(url, 'failed')
+            return None
+
+        entries = self._downloaded_entries(self._ydl, info_dict) if info_dict else []
+        if not entries:
+            self._journal(url, 'done')
+        return entries
+
+    def fetch(self, url: str) -> Optional[List[Dict[str, Any]]]:
+        """Download a URL for a later stage to encode and publish, None on failure"""
+        entries = self._fetch(url)
+        if entries is None:
+            self._release_staging()
+            return None
+
+        for entry in entries:
+            entry['job_url'] = url
+        # The staging space is released by whoever publishes the entries
+        self._staged.clear()
+        return entries
+
+    def download(self, url: str) -> bool:
+        """Download and convert a YouTube video to MP3"""
+        try:
+            succeeded = self._download(url)
+        finally:
+            self._release_staging()
+        if self.dashboard:
+            self.dashboard.job_finished(succeeded)
+        if self.metrics:
+            self.metrics.record_job('ok' if succeeded else 'failed')
+        return succeeded
+
+    def _download(self, url: str) -> bool:
+        self.files = []
+        entries = self._fetch(url)
+        if entries is None:
+            return False
+
+        for entry in entries:
+            filename = entry['filepath']
+            self._journal(url, 'tagging', os.path.splitext(filename)[0])
+            with self._stage('tag'):
+                tagged = self._process_metadata(entry, filename)
+            # Read from the staged copy, the output tree may be slow to read
+            stream = self._stream_info(filename)
+            try:
+                filename = self._publish(entry, filename)
+            except OSError as e:
+                self.logger.error(f"Could not publish {filename}: {e}")
+                self._journal(url, 'failed')
+                return False
+            self._record_archive(entry, filename)
+            self._record_manifest(entry, filename, tagged, stream)
+            self.files.append(filename)
+
+        if entries:
+            self._journal(url, 'done')
+        return True
+
+
+class MetadataPrefetcher:
+    """Resolves the info dicts of queued URLs while earlier jobs download
+
+    URLs are registered as they enter an engine's queue. Background workers
+    resolve them in order, keeping at most `lookahead` resolved dicts waiting
+    for a downloader to take them. A dict whose media URLs expire within
+    `expiry_margin` seconds is dropped when taken, so its job extracts afresh.
+    """
+
+    # YouTube signs media URLs with their expiry, as a query or path parameter
+    EXPIRE_PATTERN = re.compile(r'[?&/]expire[=/](\d+)')
+    EXPIRY_MARGIN = 600
+
+    def __init__(self, create_downloader: Callable[[], YouTubeDownloader], lookahead: int = 4,
+                 workers: int = 2, logger: Optional[Logger] = None,
+                 metrics: Optional[StageMetrics] = None, expiry_margin: int = EXPIRY_MARGIN):
+        self.create_downloader = create_downloader
+        self.lookahead = lookahead
+        self.workers = workers
+        self.logger = logger or Logger()
+        self.metrics = metrics
+        self.expiry_margin = expiry_margin
+        self._queued = collections.deque()
+        self._futures = {}
+        self._condition = threading.Condition()
+        self._threads = []
+        self._closed = False
+
+    @classmethod
+    def expires_soon(cls, info_dict: Dict[str, Any], margin: int = EXPIRY_MARGIN) -> bool:
+        """Check whether any media URL of an info dict expires within margin seconds"""
+        formats = info_dict.get('requested_formats') or info_dict.get('formats') or [info_dict]
+        expiries = []
+        for f in formats:
+            match = cls.EXPIRE_PATTERN.search(f.get('url') or '')
+            if match:
+                expiries.append(int(match.group(1)))
+        return bool(expiries) and min(expiries) - time.time() < margin
+
+    def watch(self, urls: Iterable[str]) -> Iterator[str]:
+        """Pass URLs through unchanged, queueing every single video for prefetching"""
+        self._start()
+        for url in urls:
+            if URLExtractor.video_id(url):
+                with self._condition:
+                    self._queued.append(url)
+                    self._condition.notify()
+            yield url
+
+    def take(self, url: str) -> Optional[Dict[str, Any]]:
+        """Claim the prefetched info dict of a URL, waiting if it is being resolved"""
+        with self._condition:
+            future = self._futures.pop(url, None)
+            if future is None:
+                # Not resolved yet, the downloader extracts it itself
+                try:
+                    self._queued.remove(url)
+                except ValueError:
+                    pass
+            self._condition.notify()
+
+        info_dict = future.result() if future else None
+        if info_dict and self.expires_soon(info_dict, self.expiry_margin):
+            self.logger.debug(f"Dropping prefetched metadata of {url}: media URLs expire soon")
+            return None
+        return info_dict
+
+    def _start(self) -> None:
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"prefetch-{i + 1}")
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def _worker(self) -> None:
+        from concurrent.futures import Future
+
+        # Each worker closes its own session, never while it is resolving
+        downloader = self.create_downloader()
+        try:
+            while True:
+                with self._condition:
+                    while not self._closed and (not self._queued or len(self._futures) >= self.lookahead):
+                        self._condition.wait()
+                    if self._closed:
+                        return
+                    url = self._queued.popleft()
+                    future = self._futures[url] = Future()
+
+                started = time.perf_counter()
+                info_dict = self._resolve(downloader, url)
+                if self.metrics:
+                    self.metrics.record('prefetch', time.perf_counter() - started,
+                                        outcome='ok' if info_dict else 'failed')
+                future.set_result(info_dict)
+        finally:
+            downloader.close()
+
+    def _resolve(self, downloader: YouTubeDownloader, url: str) -> Optional[Dict[str, Any]]:
+        """Resolve a URL quietly, failures are left to the download attempt"""
+        video_id = URLExtractor.video_id(url)
+        if downloader.archive is not None and downloader.archive.contains(video_id, downloader.settings_key):
+            return None
+        try:
+            return downloader._resolve(downloader._session(), url)
+        except Exception as e:
+            self.logger.debug(f"Prefetching {url} failed: {e}")
+            downloader.close()
+            return None
+
+    def close(self) -> None:
+        """Stop the workers and wait for them to close their sessions"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+class ConcurrencyController:
+    """Tunes the number of active download workers with AIMD
+
+    Every interval the controller looks at the aggregate download rate, the
+    number of files being encoded, the CPU load and the error rate. Errors or
+    an overloaded host halve the worker count, a rising download rate adds one
+    worker, anything else keeps it. Every decision is logged.
+    """
+
+    def __init__(self, minimum: int, maximum: int, logger: Optional[Logger] = None,
+                interval: float = 10.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.logger = logger or Logger()
+        self.interval = interval
+        self.limit = minimum
+
+        self._condition = threading.Condition()
+        self._active = 0
+        self._encoding = set()
+        self._bytes = 0
+        self._jobs = 0
+        self._failures = 0
+        self._last_rate = 0.0
+        self._cpus = os.cpu_count() or 1
+        self._stopped = threading.Event()
+
+    def acquire(self) -> None:
+        """Wait until the worker is allowed to start a job"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+
+    def release(self, succeeded: bool) -> None:
+        with self._condition:
+            self._encoding.discard(threading.get_ident())
+            self._active -= 1
+            self._jobs += 1
+            if not succeeded:
+                self._failures += 1
+            self._condition.notify()
+
+    def progress_hook(self):
+        """Create a yt-dlp progress hook that counts downloaded bytes"""
+        seen = {}
+
+        def hook(d: Dict[str, Any]) -> None:
+            if d['status'] != 'downloading':
+                seen.pop(d.get('filename'), None)
+                return
+            downloaded = d.get('downloaded_bytes') or 0
+            delta = downloaded - seen.get(d.get('filename'), 0)
+            seen[d.get('filename')] = downloaded
+            if delta > 0:
+                with self._condition:
+                    self._bytes += delta
+
+        return hook
+
+    def postprocessor_hook(self, d: Dict[str, Any]) -> None:
+        """Track the workers that are currently encoding"""
+        if d['postprocessor'] != 'ExtractAudio':
+            return
+        with self._condition:
+            if d['status'] == 'started':
+                self._encoding.add(threading.get_ident())
+            elif d['status'] == 'finished':
+                self._encoding.discard(threading.get_ident())
+
+    def _adjust(self) -> None:
+        with self._condition:
+            rate = self._bytes / self.interval
+            error_rate = self._failures / self._jobs if self._jobs else 0.0
+            encoding = len(self._encoding)
+            self._bytes = self._jobs = self._failures = 0
+
+        load = os.getloadavg()[0] / self._cpus if hasattr(os, 'getloadavg') else 0.0
+        limit = self.limit
+
+        if error_rate > 0.2:
+            limit, reason = max(self.minimum, limit // 2), f"error rate {error_rate:.0%}"
+        elif load > 1.5 or encoding > self._cpus:
+            limit, reason = max(self.minimum, limit // 2), "host overloaded"
+        elif rate > self._last_rate * 1.05 and limit < self.maximum:
+            limit, reason = limit + 1, "download rate rising"
+        else:
+            reason = "holding"
+
+        self.logger.info(
+            f"Concurrency {self.limit} -> {limit} ({reason}): {rate / 1024 / 1024:.2f} MB/s, "
+            f"errors {error_rate:.0%}, load {load:.2f}, encoding {encoding}"
+        )
+        self._last_rate = rate
+
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self._adjust()
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+class DownloadEngine:
+    """Job settings shared by the engines that run many downloads at once
+
+    Every worker gets its own YouTubeDownloader built from these settings by
+    create_downloader(), so a new job setting only has to be added here and
+    to YouTubeDownloader.
+    """
+
+    def __init__(self, output_dir: Path, skip_playlist: bool = True, logger: Optional[Logger] = None,
+                 rate_limit: Optional[int] = None, add_metadata: bool = True,
+                 archive: Optional[DownloadArchive] = None, limiter: Optional[BandwidthLimiter] = None,
+                 session_jobs: int = 50, cache: Optional[MetadataCache] = None,
+                 journal: Optional[JobJournal] = None,
+                 retry: Optional[RetryPolicy] = None, dashboard: Optional[ProgressDashboard] = None,
+                 metrics: Optional[StageMetrics] = None, extract_audio: bool = True,
+                 output_format: Optional[OutputFormat] = None,
+                 thumbnails: Optional[ThumbnailFetcher] = None,
+                 playlists: Optional[PlaylistExpander] = None,
+                 prefetcher: Optional[MetadataPrefetcher] = None,
+                 layout: str = 'id', manifest: Optional[Manifest] = None,
+                 staging: Optional[StagingArea] = None):
+        self.output_dir = output_dir
+        self.skip_playlist = skip_playlist
+        self.logger = logger or Logger()
+        self.rate_limit = rate_limit
+        self.limiter = limiter or (BandwidthLimiter(rate_limit * 1024, logger=self.logger) if rate_limit else None)
+        self.session_jobs = session_jobs
+        self.cache = cache
+        self.journal = journal
+        self.retry = retry
+        self.dashboard = dashboard
+        self.metrics = metrics
+        self.add_metadata = add_metadata
+        self.archive = archive
+        self.extract_audio = extract_audio
+        self.output_format = output_format
+        # Shared by every worker, so a prefetched thumbnail is found by the tagger
+        self.thumbnails = thumbnails or (ThumbnailFetcher(logger=self.logger) if add_metadata else None)
+        self.playlists = playlists
+        self.prefetcher = prefetcher
+        self.layout = layout
+        self.manifest = manifest
+        self.staging = staging
+
+    def create_downloader(self, **overrides) -> YouTubeDownloader:
+        """Create a downloader with the shared settings, overrides replace or add single ones"""
+        options = dict(
+            output_dir=self.output_dir,
+            skip_playlist=self.skip_playlist,
+            logger=self.logger,
+            rate_limit=self.rate_limit,
+            add_metadata=self.add_metadata,
+            archive=self.archive,
+            extract_audio=self.extract_audio,
+            limiter=self.limiter,
+            session_jobs=self.session_jobs,
+            cache=self.cache,
+            journal=self.journal,
+            retry=self.retry,
+            dashboard=self.dashboard,
+            metrics=self.metrics,
+            output_format=self.output_format,
+            thumbnails=self.thumbnails,
+            playlists=self.playlists,
+            prefetcher=self.prefetcher,
+            layout=self.layout,
+            manifest=self.manifest,
+            staging=self.staging
+        )
+        options.update(overrides)
+        return YouTubeDownloader(**options)
+
+
+class ThreadedDownloader(DownloadEngine):
+    """Handles multi-threaded downloading"""
+
+    def __init__(self, urls: Iterable[str], output_dir: Path, num_threads: int,
+                 controller: Optional[ConcurrencyController] = None, **options):
+        super().__init__(output_dir, **options)
+        self.urls = urls
+        self.num_threads = num_threads
+        self.controller = controller
+
+        # Bounded, so huge inputs are read only as fast as they are downloaded
+        self.url_queue = queue.Queue(maxsize=num_threads * 4)
+
+    @staticmethod
+    def feed_queue(urls: Iterable[str], url_queue: queue.Queue, workers: int) -> threading.Thread:
+        """Fill a bounded queue from an iterable in the background
+
+        One None is queued per worker after the last URL to tell it to stop.
+        """
+        def feed() -> None:
+            try:
+                for url in urls:
+                    url_queue.put(url)
+            finally:
+                for _ in range(workers):
+                    url_queue.put(None)
+
+        thread = threading.Thread(target=feed)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _worker(self) -> None:
+        """Worker function for threaded downloads"""
+        downloader = self.create_downloader(
+            progress_hooks=[self.controller.progress_hook()] if self.controller else None,
+            postprocessor_hooks=[self.controller.postprocessor_hook] if self.controller else None
+        )
+
+        try:
+            while True:
+                url = self.url_queue.get()
+                if url is None:
+                    return
+
+                if self.controller:
+                    self.controller.acquire()
+                succeeded = False
+                try:
+                    succeeded = downloader.download(url)
+                except Exception as e:
+                    # The job fails, the worker goes on with the next URL
+                    self.logger.error(f"Download of {url} failed: {e}")
+                    downloader.close()
+                    if self.dashboard:
+                        self.dashboard.job_finished(False)
+                    if self.metrics:
+                        self.metrics.record_job('failed')
+                finally:
+                    if self.controller:
+                        self.controller.release(succeeded)
+                self.url_queue.task_done()
+        finally:
+            downloader.close()
+
+    def start(self) -> None:
+        """Start the threaded download process"""
+        self.logger.info(f"Starting {self.num_threads} download threads")
+        self.feed_queue(self.urls, self.url_queue, self.num_threads)
+
+        threads = []
+        for i in range(self.num_threads):
+            target = self.metrics.profiled(self._worker, f"worker-{i + 1}") if self.metrics else self._worker
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            threads.append(thread)
+            thread.start()
+
+        if self.controller:
+            self.controller.start()
+        if self.dashboard:
+            self.dashboard.start()
+
+        # Wait for all threads to complete
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            if self.dashboard:
+                self.dashboard.stop()
+
+        if self.controller:
+            self.controller.stop()
+
+        self.logger.info("All downloads completed")
+
+
+class AsyncDownloader(DownloadEngine):
+    """Asyncio download engine
+
+    Jobs are awaitables limited by a semaphore, and the blocking yt-dlp and
+    ffmpeg work runs in an executor with one thread per concurrent job. The
+    thread count stays constant however many jobs are queued. It can be driven
+    from the command line with start() or embedded in async code:
+
+        async with AsyncDownloader([], output_dir, concurrency=8) as engine:
+            ok = await engine.download(url)
+    """
+
+    def __init__(self, urls: Iterable[str], output_dir: Path, concurrency: int, **options):
+        super().__init__(output_dir, **options)
+        self.urls = urls
+        self.concurrency = concurrency
+
+        self._cancelled = threading.Event()
+        self._local = threading.local()
+        self._downloaders = []
+        self._executor = None
+        self._semaphore = None
+
+    async def __aenter__(self) -> 'AsyncDownloader':
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._cancelled.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='youtube2mp3')
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.cancel()
+        self._executor.shutdown(wait=exc_type is None, cancel_futures=True)
+        self._executor = None
+
+        for downloader in self._downloaders:
+            downloader.close()
+        self._downloaders.clear()
+
+    def cancel(self) -> None:
+        """Abort the running downloads at their next progress update"""
+        self._cancelled.set()
+
+    def _check_cancelled(self, d: Dict[str, Any]) -> None:
+        if self._cancelled.is_set():
+            import yt_dlp
+            raise yt_dlp.utils.DownloadCancelled()
+
+    def _downloader(self) -> YouTubeDownloader:
+        """Get the downloader owned by the current executor thread"""
+        downloader = getattr(self._local, 'downloader', None)
+        if downloader is None:
+            downloader = self.create_downloader(progress_hooks=[self._check_cancelled], cancelled=self._cancelled)
+            self._local.downloader = downloader
+            self._downloaders.append(downloader)
+        return downloader
+
+    def _download_blocking(self, url: str) -> bool:
+        import yt_dlp
+
+        if self._cancelled.is_set():
+            return False
+        try:
+            return self._downloader().download(url)
+        except yt_dlp.utils.DownloadCancelled:
+            self.logger.warning(f"Download cancelled: {url}")
+            return False
+        except Exception:
+            # Start the next job of this thread on a fresh session
+            self._downloader().close()
+            raise
+
+    async def download(self, url: str) -> bool:
+        """Download and convert a single URL"""
+        import asyncio
+
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._download_blocking, url)
+
+    async def run(self) -> int:
+        """Download every URL and return the number of successful jobs"""
+        import asyncio
+
+        jobs = asyncio.Queue(maxsize=self.concurrency * 2)
+        succeeded = 0
+
+        async def worker() -> None:
+            nonlocal succeeded
+            while True:
+                url = await jobs.get()
+                try:
+                    if await self.download(url):
+                        succeeded += 1
+                except Exception as e:
+                    # The job fails, the worker goes on with the next URL
+                    self.logger.error(f"Download of {url} failed: {e}")
+                    if self.dashboard:
+                        self.dashboard.job_finished(False)
+                    if self.metrics:
+                        self.metrics.record_job('failed')
+                finally:
+                    jobs.task_done()
+
+        async with self:
+            workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+            try:
+                for url in self.urls:
+                    await jobs.put(url)
+                await jobs.join()
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+        return succeeded
+
+    def start(self) -> None:
+        """Start the download process and wait for it to finish"""
+        import asyncio
+
+        self.logger.info(f"Starting async engine with {self.concurrency} concurrent downloads")
+        if self.dashboard:
+            self.dashboard.start()
+        try:
+            succeeded = asyncio.run(self.run())
+        finally:
+            if self.dashboard:
+                self.dashboard.stop()
+        self.logger.info(f"All downloads completed ({succeeded} succeeded)")
+
+
+class DownloadService(DownloadEngine):
+    """Long-running job queue behind a local HTTP/JSON API
+
+    A pool of workers keeps warm YouTubeDownloader sessions and takes jobs from
+    a bounded queue. Submissions that do not fit the queue are refused with
+    503, and each client, told apart by its X-Client-Id header or address,
+    runs at most client_jobs jobs at a time so one batch cannot starve others.
+
+        POST   /jobs              {"url": URL} or {"urls": [URL, ...]}
+        GET    /jobs              every job, ?client=ID for those of one client
+        GET    /jobs/<id>         the state of a job
+        GET    /jobs/<id>/events  a JSON line per change of a job until it ends
+        DELETE /jobs/<id>         cancel a queued or running job
+        GET    /status            queue, worker and job totals
+    """
+
+    FINISHED = ('done', 'failed', 'cancelled')
+    MAX_BODY = 1024 * 1024
+
+    def __init__(self, output_dir: Path, workers: int = 4, max_queue: int = 1000,
+                 client_jobs: int = 2, history: int = 10000, **options):
+        super().__init__(output_dir, **options)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.client_jobs = client_jobs
+        self.history = history
+
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._queue = collections.deque()
+        self._finished = collections.deque()
+        self._running = {}
+        self._cancelled = {}  # running job ID -> event set once it is cancelled
+        self._ids = itertools.count(1)
+        self._version = 0
+        self._local = threading.local()
+        self._threads = []
+        self._stopped = False
+
+    # Job queue
+
+    def _update(self, job: Dict[str, Any], **changes) -> None:
+        """Change a job and wake up its event streams, called with the lock held"""
+        self._version += 1
+        job.update(changes, version=self._version)
+        self._condition.notify_all()
+
+    @staticmethod
+    def _snapshot(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in job.items() if key != 'version'}
+
+    def submit(self, urls: List[str], client: str) -> Optional[List[Dict[str, Any]]]:
+        """Queue a batch of URLs, None when it does not fit the queue"""
+        now = time.time()
+        with self._condition:
+            if self._stopped or len(self._queue) + len(urls) > self.max_queue:
+                return None
+
+            jobs = []
+            for url in urls:
+                job_id = str(next(self._ids))
+                job = self._jobs[job_id] = {
+                    'id': job_id, 'url': url, 'client': client, 'state': 'queued',
+                    'created': now, 'started': None, 'finished': None,
+                    'downloaded_bytes': 0, 'total_bytes': None, 'speed': None, 'files': [],
+                }
+                self._queue.append(job_id)
+                self._update(job)
+                jobs.append(self._snapshot(job))
+
+        for url in urls:
+            if self.journal:
+                self.journal.record(url, 'queued')
+        return jobs
+
+    def job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job else None
+
+    def jobs(self, client: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._condition:
+            return [self._snapshot(job) for job in self._jobs.values() if client in (None, job['client'])]
+
+    def status(self) -> Dict[str, Any]:
+        with self._condition:
+            states = {}
+            for job in self._jobs.values():
+                states[job['state']] = states.get(job['state'], 0) + 1
+            return {'workers': self.workers, 'queued': len(self._queue), 'max_queue': self.max_queue,
+                    'running': sum(self._running.values()), 'clients': dict(self._running), 'jobs': states}
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancel a job, a running one stops at its next progress update or retry"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['state'] == 'queued':
+                self._queue.remove(job_id)
+                self._finish(job, 'cancelled')
+            elif job['state'] == 'running':
+                self._cancelled[job_id].set()
+            return self._snapshot(job)
+
+    def events(self, job_id: str, heartbeat: float = 15.0) -> Iterator[Dict[str, Any]]:
+        """Yield the state of a job on every change until it has ended"""
+        version = 0
+        while True:
+            with self._condition:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return
+                self._condition.wait_for(lambda: job['version'] > version or self._stopped, heartbeat)
+                version = job['version']
+                snapshot = self._snapshot(job)
+            yield snapshot
+            if snapshot['state'] in self.FINISHED or self._stopped:
+                return
+
+    def _finish(self, job: Dict[str, Any], state: str) -> None:
+        """End a job and forget the oldest finished ones, called with the lock held"""
+        self._update(job, state=state, finished=time.time())
+        self._finished.append(job['id'])
+        while len(self._finished) > self.history:
+            self._jobs.pop(self._finished.popleft(), None)
+
+    def _next(self) -> Optional[Dict[str, Any]]:
+        """Wait for the oldest queued job of a client below its limit, None once stopped"""
+        with self._condition:
+            while not self._stopped:
+                for job_id in self._queue:
+                    job = self._jobs[job_id]
+                    if self._running.get(job['client'], 0) < self.client_jobs:
+                        self._queue.remove(job_id)
+                        self._running[job['client']] = self._running.get(job['client'], 0) + 1
+                        self._update(job, state='running', started=time.time())
+                        self._cancelled[job_id] = threading.Event()
+                        return job
+                self._condition.wait()
+            return None
+
+    # Workers
+
+    def _progress_hook(self, d: Dict[str, Any]) -> None:
+        import yt_dlp
+
+        job = self._local.job
+        if self._cancelled[job['id']].is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+
+        # Progress arrives for every block, streams only need a few updates per second
+        if d['status'] == 'downloading' and time.monotonic() - self._local.reported < 0.5:
+            return
+        self._local.reported = time.monotonic()
+        with self._condition:
+            self._update(job, downloaded_bytes=d.get('downloaded_bytes') or 0,
+                         total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+                         speed=d.get('speed'))
+
+    def _worker(self) -> None:
+        """Run queued jobs on a warm downloader until the service stops"""
+        import yt_dlp
+
+        downloader = self.create_downloader(progress_hooks=[self._progress_hook])
+
+        try:
+            while True:
+                job = self._next()
+                if job is None:
+                    return
+
+                self._local.job = job
+                self._local.reported = 0.0
+                with self._condition:
+                    downloader.cancelled = self._cancelled[job['id']]
+                succeeded = False
+                try:
+                    succeeded = downloader.download(job['url'])
+                except yt_dlp.utils.DownloadCancelled:
+                    self.logger.warning(f"Download cancelled: {job['url']}")
+                    downloader.close()
+                    if self.dashboard:
+                        self.dashboard.job_finished(False)
+                except Exception as e:
+                    # The job fails, the worker and its client's slot stay available
+                    self.logger.error(f"Job {job['id']} failed: {e}")
+                    downloader.close()
+                    if self.dashboard:
+                        self.dashboard.job_finished(False)
+
+                with self._condition:
+                    self._running[job['client']] -= 1
+                    if not self._running[job['client']]:
+                        del self._running[job['client']]
+                    if self._cancelled.pop(job['id']).is_set():
+                        self._finish(job, 'cancelled')
+                    else:
+                        job['files'] = [str(path) for path in downloader.files]
+                        self._finish(job, 'done' if succeeded else 'failed')
+        finally:
+            downloader.close()
+
+    def start(self) -> None:
+        """Start the worker pool"""
+        for i in range(self.workers):
+            target = self.metrics.profiled(self._worker, f"worker-{i + 1}") if self.metrics else self._worker
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self) -> None:
+        """Cancel every queued and running job and wait for the workers"""
+        with self._condition:
+            self._stopped = True
+            while self._queue:
+                self._finish(self._jobs[self._queue.popleft()], 'cancelled')
+            for cancelled in self._cancelled.values():
+                cancelled.set()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    # HTTP API
+
+    def handle(self, method: str, path: str, query: Dict[str, List[str]], body: Optional[bytes],
+               client: str) -> Tuple[int, Any]:
+        """Answer an API request with a status code and a JSON-serializable body"""
+        parts = path.strip('/').split('/')
+
+        if parts == ['status'] and method == 'GET':
+            return 200, self.status()
+
+        if parts == ['jobs'] and method == 'GET':
+            return 200, {'jobs': self.jobs(query.get('client', [None])[0])}
+
+        if parts == ['jobs'] and method == 'POST':
+            try:
+                request = json.loads(body or b'{}')
+                urls = request['urls'] if 'urls' in request else [request['url']]
+            except (ValueError, KeyError, TypeError):
+                return 400, {'error': 'expected {"url": URL} or {"urls": [URL, ...]}'}
+            if not urls or not all(isinstance(url, str) and 'youtu' in url for url in urls):
+                return 400, {'error': 'expected YouTube URLs'}
+
+            jobs = self.submit([URLExtractor.canonicalize(url)[1] for url in urls], client)
+            if jobs is None:
+                return 503, {'error': 'queue is full', 'status': self.status()}
+            return 202, {'jobs': jobs}
+
+        if len(parts) == 2 and parts[0] == 'jobs':
+            if method == 'GET':
+                job = self.job(parts[1])
+            elif method == 'DELETE':
+                job = self.cancel(parts[1])
+            else:
+                return 405, {'error': f"{method} not allowed"}
+            return (200, job) if job else (404, {'error': f"no job {parts[1]}"})
+
+        return 404, {'error': f"no such endpoint: {method} {path}"}
+
+    def listen(self, host: str = '127.0.0.1', port: int = 8080):
+        """Bind the API to an address and return its (not yet serving) HTTP server"""
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlsplit, parse_qs
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args) -> None:
+                service.logger.debug(f"{self.address_string()} {format % args}")
+
+            def _send(self, status: int, data: Any) -> None:
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if status == 503:
+                    self.send_header('Retry-After', '5')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, job_id: str) -> None:
+                if service.job(job_id) is None:
+                    return self._send(404, {'error': f"no job {job_id}"})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                try:
+                    for snapshot in service.events(job_id):
+                        self.wfile.write(json.dumps(snapshot).encode('utf-8') + b'\n')
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _dispatch(self, method: str) -> None:
+                url = urlsplit(self.path)
+                parts = url.path.strip('/').split('/')
+                if method == 'GET' and len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+                    return self._stream(parts[1])
+
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > service.MAX_BODY:
+                    return self._send(413, {'error': 'request body too large'})
+                body = self.rfile.read(length) if length else None
+                client = self.headers.get('X-Client-Id') or self.client_address[0]
+                self._send(*service.handle(method, url.path, parse_qs(url.query), body, client))
+
+            def do_GET(self) -> None:
+                self._dispatch('GET')
+
+            def do_POST(self) -> None:
+                self._dispatch('POST')
+
+            def do_DELETE(self) -> None:
+                self._dispatch('DELETE')
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        return server
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8080) -> None:
+        """Serve the API until interrupted"""
+        server = self.listen(host, port)
+        self.start()
+        if self.dashboard:
+            self.dashboard.start()
+        self.logger.info(f"Serving the job API on http://{host}:{server.server_address[1]} "
+                         f"with {self.workers} workers")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.stop()
+            if self.dashboard:
+                self.dashboard.stop()
+
+
+class AudioEncoder:
+    """Converts downloaded media to the output audio format with ffmpeg"""
+
+    def __init__(self, logger: Logger, output_format: Optional[OutputFormat] = None,
+                 postprocessor_hooks: Optional[List] = None):
+        import yt_dlp
+        from yt_dlp.postprocessor import FFmpegExtractAudioPP
+
+        options = dict((output_format or OutputFormat()).postprocessor)
+        del options['key']
+        self.ydl = yt_dlp.YoutubeDL({'logger': logger.logger, 'postprocessor_hooks': postprocessor_hooks or []})
+        self.postprocessor = FFmpegExtractAudioPP(self.ydl, **options)
+
+    def encode(self, info_dict: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert the file in info_dict['filepath'] and remove the source"""
+        info_dict = self.ydl.run_pp(self.postprocessor, info_dict)
+        info_dict.pop('__files_to_move', None)
+        return info_dict
+
+
+class PipelinedDownloader(DownloadEngine):
+    """Runs downloading, encoding and tagging as separate stages
+
+    Download workers only fetch the source media, encode workers run one ffmpeg
+    process each and a single tagging thread writes the metadata. The stages
+    are connected by bounded queues so a slow stage applies back-pressure
+    instead of piling up files on disk.
+    """
+
+    _SENTINEL = None
+
+    def __init__(self, urls: Iterable[str], output_dir: Path, download_workers: int,
+                 encode_workers: int, **options):
+        super().__init__(output_dir, **options)
+        self.download_workers = download_workers
+        self.encode_workers = encode_workers
+
+        self.urls = urls
+        self.url_queue = queue.Queue(maxsize=download_workers * 4)
+        self.encode_queue = queue.Queue(maxsize=encode_workers * 2)
+        self.tag_queue = queue.Queue(maxsize=encode_workers * 2)
+
+        # Used by the tagging stage for metadata and archive bookkeeping
+        self.tagger = self._create_downloader()
+
+        # Entries of every job still in the pipeline, a playlist job is only
+        # journalled as finished after its last entry
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+
+    def _create_downloader(self) -> YouTubeDownloader:
+        """Downloader that only fetches the source media, the encode stage converts it"""
+        return self.create_downloader(extract_audio=False, converted=True)
+
+    def _download_worker(self) -> None:
+        """Fetch source media and hand it to the encoders"""
+        downloader = self._create_downloader()
+
+        try:
+            while True:
+                url = self.url_queue.get()
+                if url is None:
+                    return
+
+                entries = downloader.fetch(url)
+                if entries:
+                    # Each file is counted once it is tagged or fails
+                    if self.dashboard:
+                        self.dashboard.job_finished(None)
+                else:
+                    # Failed, or finished with nothing to encode, e.g. skipped by the archive
+                    succeeded = entries is not None
+                    if self.dashboard:
+                        self.dashboard.job_finished(succeeded)
+                    if self.metrics:
+                        self.metrics.record_job('ok' if succeeded else 'failed')
+                if entries:
+                    with self._jobs_lock:
+                        self._jobs[url] = {'left': len(entries), 'failed': False}
+                for info_dict in entries or []:
+                    self.encode_queue.put(info_dict)
+        finally:
+            downloader.close()
+
+    def _entry_finished(self, info_dict: Dict[str, Any], ok: bool) -> None:
+        """Journal the job of an entry once its last entry is tagged or failed"""
+        job_url = info_dict.get('job_url')
+        with self._jobs_lock:
+            job = self._jobs.get(job_url)
+            if job is None:
+                return
+            job['left'] -= 1
+            job['failed'] = job['failed'] or not ok
+            if job['left']:
+                return
+            del self._jobs[job_url]
+        self.tagger._journal(job_url, 'failed' if job['failed'] else 'done')
+
+    def _fail(self, info_dict: Dict[str, Any]) -> None:
+        """Record a file that could not be encoded or tagged, so its stage keeps draining"""
+        try:
+            self._entry_finished(info_dict, False)
+        except Exception as e:
+            self.logger.error(f"Could not record the failure in the journal: {e}")
+        if self.staging:
+            self.staging.discard(info_dict.get('id'))
+        if self.dashboard:
+            self.dashboard.job_finished(False)
+        if self.metrics:
+            self.metrics.record_job('failed')
+
+    def _encode_worker(self) -> None:
+        """Convert downloaded media and hand it to the tagger"""
+        encoder = AudioEncoder(self.logger, self.output_format,
+                               [self.dashboard.postprocessor_hook] if self.dashboard else None)
+
+        while True:
+            info_dict = self.encode_queue.get()
+            if info_dict is self._SENTINEL:
+                return
+
+            job_url = info_dict.get('job_url')
+            try:
+                self.tagger._journal(job_url, 'encoding', os.path.splitext(info_dict['filepath'])[0])
+                with self.tagger._stage('encode'):
+                    ok, encoded = self.tagger.retry.run(job_url, lambda: encoder.encode(info_dict), self.logger)
+            except Exception as e:
+                self.logger.error(f"Encoding failed for {info_dict.get('filepath')}: {e}")
+                ok = False
+            if ok:
+                # The file is counted by the tagger, this worker is idle again
+                if self.dashboard:
+                    self.dashboard.job_finished(None)
+                self.tag_queue.put(encoded)
+            else:
+                self._fail(info_dict)
+
+    def _tag(self, info_dict: Dict[str, Any]) -> None:
+        """Tag, publish and record one encoded file"""
+        self.tagger._journal(info_dict.get('job_url'), 'tagging', os.path.splitext(info_dict['filepath'])[0])
+        with self.tagger._stage('tag'):
+            tagged = self.tagger._process_metadata(info_dict, info_dict['filepath'])
+        stream = self.tagger._stream_info(info_dict['filepath'])
+        info_dict['filepath'] = self.tagger._publish(info_dict, info_dict['filepath'])
+        self.tagger._record_archive(info_dict, info_dict['filepath'])
+        self.tagger._record_manifest(info_dict, info_dict['filepath'], tagged, stream)
+        self._entry_finished(info_dict, True)
+        if self.dashboard:
+            self.dashboard.job_finished(True)
+        if self.metrics:
+            self.metrics.record_job('ok')
+
+    def _tag_worker(self) -> None:
+        """Write metadata and record finished files in the archive"""
+        while True:
+            info_dict = self.tag_queue.get()
+            if info_dict is self._SENTINEL:
+                return
+
+            try:
+                self._tag(info_dict)
+            except Exception as e:
+                self.logger.error(f"Tagging failed for {info_dict.get('filepath')}: {e}")
+                self._fail(info_dict)
+
+    def _start_threads(self, target, count: int) -> List[threading.Thread]:
+        threads = []
+        for i in range(count):
+            if self.metrics:
+                target_i = self.metrics.profiled(target, f"{target.__name__.strip('_')}-{i + 1}")
+            else:
+                target_i = target
+            thread = threading.Thread(target=target_i)
+            thread.daemon = True
+            threads.append(thread)
+            thread.start()
+        return threads
+
+    def start(self) -> None:
+        """Start the pipeline and wait for every stage to drain"""
+        self.logger.info(
+            f"Starting pipeline with {self.download_workers} download and "
+            f"{self.encode_workers} encode workers"
+        )
+
+        ThreadedDownloader.feed_queue(self.urls, self.url_queue, self.download_workers)
+        if self.dashboard:
+            self.dashboard.queue_depth = self.encode_queue.qsize
+            self.dashboard.start()
+
+        downloaders = self._start_threads(self._download_worker, self.download_workers)
+        encoders = self._start_threads(self._encode_worker, self.encode_workers)
+        taggers = self._start_threads(self._tag_worker, 1)
+
+        # Shut the stages down in order, each one after its producers finished
+        for thread in downloaders:
+            thread.join()
+        for _ in encoders:
+            self.encode_queue.put(self._SENTINEL)
+        for thread in encoders:
+            thread.join()
+        self.tag_queue.put(self._SENTINEL)
+        for thread in taggers:
+            thread.join()
+
+        if self.dashboard:
+            self.dashboard.stop()
+
+        self.logger.info("All downloads completed")
+
+
+class URLExtractor:
+    """Extracts YouTube URLs from a file"""
+
+    URL_PATTERN = re.compile(
+        r"(http|https)://([\w_-]+(?:(?:\.[\w_-]+)+))([\w.,@?^=%&:\/~+#-]*[\w@?^=%&\/~+#-])?"
+    )
+
+    VIDEO_ID_PATTERN = re.compile(
+        r"(?:youtu\.be/|[?&]v=|/(?:embed|shorts|live|v)/)([\w-]{11})(?![\w-])"
+    )
+
+    PLAYLIST_ID_PATTERN = re.compile(r"[?&]list=([\w-]+)")
+
+    # Base64 characters whose value has its low 2 bits clear
+    PACKABLE_LAST = frozenset('AEIMQUYcgkosw048')
+
+    # The priority column, an integer right after a URL separated by
+    # whitespace, a comma or a semicolon, e.g. "https://youtu.be/... 5"
+    PRIORITY_PATTERN = re.compile(r"(?:\s*[,;]\s*|\s+)(-?\d+)(?=$|[\s,;])")
+
+    # URL_PATTERN takes a ",5" column into the URL, it is split off again
+    TRAILING_PRIORITY_PATTERN = re.compile(r"[,;](-?\d+)$")
+
+    @staticmethod
+    def extract_from_file(file_path: Path, prefer_playlist: bool = False) -> Set[str]:
+        """Extract YouTube URLs from a file"""
+        return set(URLExtractor.iter_from_file(file_path, prefer_playlist))
+
+    @staticmethod
+    def iter_from_file(file_path: Path, prefer_playlist: bool = False,
+                       priorities: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        """Stream the canonical YouTube URLs of a file, each video or playlist once
+
+        The file is read line by line, so its size does not matter. A path of
+        '-' reads from stdin and gzip compressed input is detected automatically.
+        When priorities is given, every non-zero priority column is stored in
+        it by URL, for JobScheduler, which removes each entry again once its
+        URL is dispatched. Integers anywhere else on a line are ignored.
+        """
+        seen = set()
+
+        with URLExtractor._open(file_path) as f:
+            for line in f:
+                if 'youtu' not in line:
+                    continue
+
+                for match in URLExtractor.URL_PATTERN.finditer(line):
+                    if 'youtu' not in match.group():
+                        continue
+
+                    url, priority = URLExtractor._split_priority(line, match)
+                    key, url = URLExtractor.canonicalize(url, prefer_playlist)
+                    key = URLExtractor._compact(key)
+                    if key not in seen:
+                        seen.add(key)
+                        if priority and priorities is not None:
+                            priorities[url] = priority
+                        yield url
+
+    @staticmethod
+    def _split_priority(line: str, match: re.Match) -> Tuple[str, int]:
+        """Get a matched URL without a trailing priority column, and the priority"""
+        url = match.group()
+        trailing = URLExtractor.TRAILING_PRIORITY_PATTERN.search(url)
+        if trailing:
+            return url[:trailing.start()], int(trailing.group(1))
+        column = URLExtractor.PRIORITY_PATTERN.match(line, match.end())
+        return url, int(column.group(1)) if column else 0
+
+    @staticmethod
+    @contextmanager
+    def _open(file_path: Path) -> Iterator[io.TextIOWrapper]:
+        """Open a URL file as text, handling stdin and gzip compression
+
+        stdin is detached from the wrapper instead of closed, so it stays
+        usable for the rest of the process.
+        """
+        stdin = str(file_path) == '-'
+        raw = sys.stdin.buffer if stdin else open(file_path, 'rb')
+        if raw.peek(2)[:2] == b'\x1f\x8b':
+            # GzipFile leaves a file object it was given open
+            raw = gzip.GzipFile(fileobj=raw)
+        f = io.TextIOWrapper(raw, encoding='utf-8', errors='replace')
+        try:
+            yield f
+        finally:
+            if stdin:
+                f.detach()
+            else:
+                f.close()
+
+    @staticmethod
+    def _compact(key: str) -> Union[int, str]:
+        """Pack an 11 character video ID into a 64 bit integer to save memory"""
+        # 11 characters carry 66 bits, packing drops the low 2 bits of the
+        # last one. They are zero in real IDs, other keys are kept as they are
+        if len(key) == 11 and key[-1] in URLExtractor.PACKABLE_LAST:
+            try:
+                return int.from_bytes(base64.urlsafe_b64decode(key + '='), 'big')
+            except ValueError:
+                pass
+        return key
+
+    @staticmethod
+    def canonicalize(url: str, prefer_playlist: bool = False) -> Tuple[str, str]:
+        """Get the dedupe key and canonical form of a YouTube URL
+
+        youtu.be links, mobile links and extra parameters such as timestamps
+        all map to the same watch URL. Playlist links map to the playlist, and
+        watch links inside a playlist only do so when prefer_playlist is set.
+        URLs without a video or playlist ID are returned unchanged.
+        """
+        video_id = URLExtractor.video_id(url)
+        match = URLExtractor.PLAYLIST_ID_PATTERN.search(url)
+        playlist_id = match.group(1) if match else None
+
+        if playlist_id and (prefer_playlist or not video_id):
+            return f"list={playlist_id}", f"https://www.youtube.com/playlist?list={playlist_id}"
+        if video_id:
+            return video_id, f"https://www.youtube.com/watch?v={video_id}"
+        return url, url
+
+    @staticmethod
+    def video_id(url: str) -> Optional[str]:
+        """Get the video ID from a YouTube URL without contacting YouTube"""
+        match = URLExtractor.VIDEO_ID_PATTERN.search(url)
+        return match.group(1) if match else None
+
+
+class PlaylistExpander:
+    """Fans playlists out into one job per entry
+
+    Playlists are listed with a flat extraction, which does not resolve the
+    videos, and every entry becomes a job of its own so that all workers share
+    a playlist. The position of each entry and the playlist title are kept for
+    tagging. Entries already in the download archive are left out, so syncing
+    a playlist again only downloads what was added since the last run.
+    """
+
+    def __init__(self, logger: Optional[Logger] = None, archive: Optional[DownloadArchive] = None,
+                 settings_key: Optional[str] = None):
+        self.logger = logger or Logger()
+        self.archive = archive
+        self.settings_key = settings_key
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def lookup(self, video_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Get the album, track number, duration and playlist URL of a playlist entry"""
+        with self._lock:
+            return self._entries.get(video_id)
+
+    def remember(self, video_id: Optional[str], entry: Dict[str, Any]) -> None:
+        """Add an entry listed elsewhere, e.g. by the worker that filled a job store"""
+        with self._lock:
+            self._entries[video_id] = entry
+
+    def _list(self, url: str) -> Optional[Dict[str, Any]]:
+        """List the entries of a playlist without resolving them, None if it fails"""
+        import yt_dlp
+
+        options = {
+            'quiet': True,
+            'extract_flat': 'in_playlist',
+            'noplaylist': False,
+            'logger': self.logger.logger,
+        }
+        try:
+            with YouTubeDownloader.create_ydl(options) as ydl:
+                info_dict = ydl.extract_info(url, download=False)
+        except yt_dlp.utils.DownloadError as e:
+            self.logger.warning(f"Could not list playlist {url}: {e}")
+            return None
+
+        if not info_dict or info_dict.get('entries') is None:
+            return None
+        info_dict['entries'] = [entry for entry in info_dict['entries'] if entry]
+        return info_dict
+
+    def expand(self, urls: Iterable[str]) -> Iterator[str]:
+        """Yield every URL, with each playlist replaced by its entries"""
+        seen = set()
+        for url in urls:
+            if not URLExtractor.PLAYLIST_ID_PATTERN.search(url):
+                yield url
+                continue
+
+            playlist = self._list(url)
+            if playlist is None:
+                # Download it as a whole, the downloader reports what went wrong
+                yield url
+                continue
+
+            album = playlist.get('title') or playlist.get('id') or 'YouTube to MP3'
+            total = len(playlist['entries'])
+            queued = 0
+            for track, entry in enumerate(playlist['entries'], 1):
+                entry_url = entry.get('url') or entry.get('webpage_url')
+                if not entry_url:
+                    continue
+                _, entry_url = URLExtractor.canonicalize(entry_url)
+                video_id = entry.get('id') or URLExtractor.video_id(entry_url)
+
+                with self._lock:
+                    self._entries[video_id] = {'album': album, 'track': track, 'tracks': total,
+                                               'duration': entry.get('duration'), 'playlist': url}
+                if video_id in seen:
+                    continue
+                seen.add(video_id)
+                if self.archive is not None and video_id and self.archive.contains(video_id, self.settings_key):
+                    continue
+
+                queued += 1
+                yield entry_url
+
+            self.logger.info(f"Playlist {album}: {queued} new of {total} entries")
+
+
+class JobScheduler:
+    """Orders jobs by priority, then by estimated duration
+
+    Priorities come from the input file and higher ones run first, playlist
+    entries inherit the priority of their playlist. Within a priority the
+    policy decides: 'shortest' finishes many jobs early, 'longest' starts long
+    jobs first so they do not stretch the tail of the batch while the other
+    workers idle, and 'fifo' keeps the input order. Durations are estimated
+    from the flat playlist listing and the metadata cache only, so a video
+    that was neither listed in a playlist nor resolved by an earlier run has
+    no estimate; jobs without one keep their input order after the estimated
+    ones. Jobs are reordered within a window, so huge inputs are still
+    streamed. With 'fifo', jobs pass straight through until the first one
+    with a priority arrives.
+    """
+
+    POLICIES = ('fifo', 'shortest', 'longest')
+
+    def __init__(self, policy: str = 'fifo', window: int = 1000,
+                 priorities: Optional[Dict[str, int]] = None,
+                 playlists: Optional[PlaylistExpander] = None,
+                 cache: Optional[MetadataCache] = None):
+        self.policy = policy
+        self.window = window
+        self.priorities = priorities if priorities is not None else {}
+        self.playlists = playlists
+        self.cache = cache
+
+    def priority(self, url: str) -> int:
+        """Get the priority of a URL, or of the playlist it came from"""
+        priority = self.priorities.get(url)
+        if priority is None and self.playlists:
+            entry = self.playlists.lookup(URLExtractor.video_id(url))
+            priority = self.priorities.get(entry['playlist']) if entry else None
+        return priority or 0
+
+    def estimate(self, url: str) -> Optional[float]:
+        """Estimate the duration of a job in seconds without contacting YouTube"""
+        video_id = URLExtractor.video_id(url)
+        if not video_id:
+            return None
+        if self.playlists:
+            entry = self.playlists.lookup(video_id)
+            if entry and entry.get('duration'):
+                return entry['duration']
+        if self.cache:
+            return self.cache.duration(video_id) or None
+        return None
+
+    def _key(self, url: str) -> Tuple[int, int, float]:
+        if self.policy == 'fifo':
+            return -self.priority(url), 0, 0
+        duration = self.estimate(url)
+        if duration is None:
+            return -self.priority(url), 1, 0
+        return -self.priority(url), 0, duration if self.policy == 'shortest' else -duration
+
+    def _pop(self, heap: List[Tuple[Tuple[int, int, float], int, str]]) -> str:
+        url = heapq.heappop(heap)[2]
+        # Forget the priority of a dispatched URL, so memory stays flat
+        self.priorities.pop(url, None)
+        return url
+
+    def schedule(self, urls: Iterable[str]) -> Iterator[str]:
+        """Yield the URLs in scheduled order"""
+        heap = []
+        for seq, url in enumerate(urls):
+            key = self._key(url)
+            # Nothing to reorder yet, do not hold back the first dispatch
+            if not heap and self.policy == 'fifo' and key == (0, 0, 0):
+                yield url
+                continue
+            heapq.heappush(heap, (key, seq, url))
+            if len(heap) >= self.window:
+                yield self._pop(heap)
+        while heap:
+            yield self._pop(heap)
+
+
+class LibraryRetagger:
+    """Corrects the tags of the audio files already in an output tree
+
+    Tags are read and written in batches on a process pool, so the mutagen
+    parsing of a large library uses every core. Video IDs come from the tags,
+    or from the [ID] in the file names of the id and sharded layouts. The
+    info of a batch is taken from the metadata cache, where expired media URLs
+    don't matter, and the rest is resolved on a thread pool. Files whose
+    title, artist, album and video ID match and that have album art are not
+    touched. The album of a playlist entry is kept, since the playlist is not
+    known anymore.
+    """
+
+    NAME_ID_PATTERN = re.compile(r'\[([\w-]{11})\]$')
+    DEFAULT_ALBUM = 'YouTube to MP3'
+
+    def __init__(self, directory: Path, processes: Optional[int] = None, threads: int = 4,
+                 batch_size: int = 256, cache: Optional[MetadataCache] = None,
+                 thumbnails: Optional[ThumbnailFetcher] = None,
+                 create_downloader: Optional[Callable[[], YouTubeDownloader]] = None,
+                 logger: Optional[Logger] = None, metrics: Optional[StageMetrics] = None,
+                 dry_run: bool = False):
+        self.directory = directory
+        self.processes = processes or os.cpu_count() or 1
+        self.threads = threads
+        self.batch_size = batch_size
+        self.cache = cache
+        self.thumbnails = thumbnails
+        self.create_downloader = create_downloader
+        self.logger = logger or Logger()
+        self.metrics = metrics
+        self.dry_run = dry_run
+        self._local = threading.local()
+        self._downloaders = []
+        self._lock = threading.Lock()
+
+    def files(self) -> Iterator[str]:
+        """Walk the output tree for audio files"""
+        for root, dirs, names in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(names):
+                if os.path.splitext(name)[1].lstrip('.').lower() in OutputFormat.EXTENSIONS:
+                    yield os.path.join(root, name)
+
+    def batches(self) -> Iterator[List[str]]:
+        files = self.files()
+        while True:
+            batch = list(itertools.islice(files, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    @staticmethod
+    def read_batch(paths: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """Read the tags of a batch of files, runs in a worker process"""
+        return [MetadataManager.read_tags(Path(path)) for path in paths]
+
+    @staticmethod
+    def write_batch(changes: List[Tuple[str, Dict[str, Any]]]) -> List[bool]:
+        """Write the tags of a batch of files, runs in a worker process"""
+        return [MetadataManager.add_metadata(Path(path), tags['title'], tags['artist'], tags['album'],
+                                             tags['video_id'], *(tags['cover'] or ()))
+                for path, tags in changes]
+
+    def video_id(self, path: str, tags: Dict[str, Any]) -> Optional[str]:
+        """Get the video ID of a file from its tags, or from its name"""
+        if tags['video_id']:
+            return tags['video_id']
+        match = self.NAME_ID_PATTERN.search(os.path.splitext(os.path.basename(path))[0])
+        return match.group(1) if match else None
+
+    def _downloader(self) -> YouTubeDownloader:
+        downloader = getattr(self._local, 'downloader', None)
+        if downloader is None:
+            downloader = self._local.downloader = self.create_downloader()
+            with self._lock:
+                self._downloaders.append(downloader)
+        return downloader
+
+    def _resolve_one(self, video_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            return self._downloader().resolve(f"https://www.youtube.com/watch?v={video_id}")
+        except Exception as e:
+            self.logger.warning(f"Could not resolve {video_id}: {e}")
+            return None
+
+    def resolve(self, video_ids: Iterable[str], executor) -> Dict[str, Dict[str, Any]]:
+        """Get the info of a batch of videos, from the cache or resolved concurrently"""
+        infos = {}
+        missing = []
+        for video_id in dict.fromkeys(video_ids):
+            info_dict = self.cache.get(video_id) if self.cache else None
+            if info_dict:
+                infos[video_id] = info_dict
+            else:
+                missing.append(video_id)
+
+        if missing and self.create_downloader:
+            for video_id, info_dict in zip(missing, executor.map(self._resolve_one, missing)):
+                if info_dict:
+                    infos[video_id] = info_dict
+        return infos
+
+    def plan(self, path: str, tags: Dict[str, Any], video_id: str,
+             info_dict: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+        """Get the corrected tags of a file and the names of the fields that change"""
+        wanted = {
+            'title': info_dict.get('title') or tags['title'] or Path(path).stem,
+            'artist': info_dict.get('uploader') or tags['artist'] or 'YouTube',
+            'album': info_dict.get('album') or tags['album'] or self.DEFAULT_ALBUM,
+            'video_id': video_id,
+            'cover': None,
+        }
+        changed = [field for field in ('title', 'artist', 'album', 'video_id') if wanted[field] != tags[field]]
+        if not tags['cover'] and self.thumbnails:
+            changed.append('cover')
+        return wanted, changed
+
+    def _count(self, stats: Dict[str, int], outcome: str) -> None:
+        stats[outcome] += 1
+        if self.metrics:
+            self.metrics.record_job(outcome)
+
+    def _apply(self, paths: List[str], states: List[Optional[Dict[str, Any]]], resolver,
+               stats: Dict[str, int]) -> List[Tuple[str, Dict[str, Any], List[str]]]:
+        """Work out the changes of a batch, fetching the album art they need"""
+        ids = {}
+        for path, tags in zip(paths, states):
+            if tags is None:
+                self.logger.warning(f"Could not read the tags of {path}")
+                self._count(stats, 'failed')
+                continue
+            video_id = self.video_id(path, tags)
+            if video_id is None:
+                self._count(stats, 'unresolved')
+                continue
+            ids[path] = video_id
+
+        started = time.perf_counter()
+        infos = self.resolve(ids.values(), resolver)
+        if self.metrics:
+            self.metrics.record('resolve', time.perf_counter() - started)
+
+        changes = []
+        for path, tags in zip(paths, states):
+            video_id = ids.get(path)
+            if video_id is None:
+                continue
+            info_dict = infos.get(video_id)
+            if info_dict is None:
+                self._count(stats, 'unresolved')
+                continue
+            wanted, changed = self.plan(path, tags, video_id, info_dict)
+            if not changed:
+                self._count(stats, 'unchanged')
+                continue
+            if 'cover' in changed and not self.dry_run:
+                self.thumbnails.prefetch(info_dict)
+            changes.append((path, wanted, changed, info_dict))
+
+        # Album art is fetched for the whole batch at once, a failed fetch only drops the art
+        result = []
+        for path, wanted, changed, info_dict in changes:
+            if 'cover' in changed and not self.dry_run:
+                wanted['cover'] = self.thumbnails.get(info_dict)
+                if wanted['cover'] is None:
+                    changed.remove('cover')
+                    if not changed:
+                        self._count(stats, 'unchanged')
+                        continue
+            result.append((path, wanted, changed))
+        return result
+
+    def _report(self, changes: List[Tuple[str, Dict[str, Any], List[str]]], written: List[bool],
+                stats: Dict[str, int]) -> None:
+        for (path, _, changed), ok in zip(changes, written):
+            name = os.path.relpath(path, self.directory)
+            if ok:
+                self.logger.info(f"{'Would retag' if self.dry_run else 'Retagged'} {name}: {', '.join(changed)}")
+            else:
+                self.logger.error(f"Could not retag {name}")
+            self._count(stats, 'changed' if ok else 'failed')
+
+    def run(self) -> Dict[str, Any]:
+        """Retag the tree, returns the counts of files per outcome and the elapsed seconds"""
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        stats = {'files': 0, 'changed': 0, 'unchanged': 0, 'unresolved': 0, 'failed': 0}
+        started = time.perf_counter()
+        batches = list(self.batches())
+
+        # The worker processes are forked before any thread of this class starts
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            reads = pool.map(self.read_batch, batches)
+            writes = collections.deque()
+            with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='youtube2mp3-retag') as resolver:
+                for paths, states in zip(batches, reads):
+                    stats['files'] += len(paths)
+                    changes = self._apply(paths, states, resolver, stats)
+                    if not changes:
+                        continue
+                    if self.dry_run:
+                        self._report(changes, [True] * len(changes), stats)
+                        continue
+                    writes.append((changes, pool.submit(self.write_batch,
+                                                        [(path, wanted) for path, wanted, _ in changes])))
+                    while writes and writes[0][1].done():
+                        changes, future = writes.popleft()
+                        self._report(changes, future.result(), stats)
+
+            while writes:
+                changes, future = writes.popleft()
+                self._report(changes, future.result(), stats)
+
+        for downloader in self._downloaders:
+            downloader.close()
+
+        stats['elapsed'] = time.perf_counter() - started
+        return stats
+
+
+class ArgumentValidator:
+    """Validates command line arguments"""
+    
+    @staticmethod
+    def validate_url(url: str) -> str:
+        """Validate a YouTube URL"""
+        import validators
+
+        if not validators.url(url):
+            raise ArgumentTypeError(f"Invalid URL: {url}")
+        
+        if 'youtu' not in url:
+            raise ArgumentTypeError(f"Not a YouTube URL: {url}")
+        
+        return url
+    
+    @staticmethod
+    def validate_file(file_path: str) -> Path:
+        """Validate that a file exists and is readable ('-' is stdin)"""
+        path = Path(file_path)
+
+        if file_path == '-':
+            return path
+        
+        if not path.is_file():
+            raise ArgumentTypeError(f"File does not exist: {file_path}")
+        
+        if not os.access(path, os.R_OK):
+            raise ArgumentTypeError(f"File is not readable: {file_path}")
+        
+        return path
+    
+    @staticmethod
+    def validate_directory(dir_path: str) -> Path:
+        """Validate that a directory exists and is writable"""
+        path = Path(dir_path)
+        
+        if not path.is_dir():
+            raise ArgumentTypeError(f"Directory does not exist: {dir_path}")
+        
+        if not os.access(path, os.W_OK):
+            raise ArgumentTypeError(f"Directory is not writable: {dir_path}")
+        
+        return path
+    
+    @staticmethod
+    def validate_threads(threads: str) -> Union[int, str]:
+        """Validate a thread count or 'auto'"""
+        if threads == 'auto':
+            return threads
+        try:
+            threads_int = int(threads)
+        except ValueError:
+            raise ArgumentTypeError("Threads must be a positive integer or 'auto'")
+        if threads_int <= 0:
+            raise ArgumentTypeError("Threads must be a positive integer or 'auto'")
+        return threads_int
+
+    @staticmethod
+    def validate_address(address: str) -> Tuple[str, int]:
+        """Validate a [HOST:]PORT address, the host defaults to localhost"""
+        host, _, port = address.rpartition(':')
+        try:
+            port_int = int(port)
+        except ValueError:
+            raise ArgumentTypeError(f"Invalid address: {address}")
+        if not 0 <= port_int <= 65535:
+            raise ArgumentTypeError(f"Invalid port: {port}")
+        return host or '127.0.0.1', port_int
+
+    @staticmethod
+    def validate_rate_limit(rate: str) -> int:
+        """Validate rate limit (in KB/s)"""
+        try:
+            rate_int = int(rate)
+            if rate_int <= 0:
+                raise ArgumentTypeError("Rate limit must be a positive integer")
+            return rate_int
+        except ValueError:
+            raise ArgumentTypeError("Rate limit must be a positive integer")
+
+
+class YouTubeToMP3:
+    """Main application class"""
+    
+    def __init__(self):
+        self.logger = Logger()
+        self.args = self._parse_arguments()
+        self.archive = None
+        self.limiter = None
+        self.cache = None
+        self.journal = None
+        self.retry = None
+        self.metrics = None
+        self.output_format = None
+        self.thumbnails = None
+        self.playlists = None
+        self.prefetcher = None
+        self.store = None
+        self.manifest = None
+        self.staging = None
+    
+    def _parse_arguments(self):
+        """Parse command line arguments"""
+        parser = ArgumentParser(
+            description=f"{Fore.RED}YouTube{Style.RESET_ALL} to {Fore.GREEN}MP3{Style.RESET_ALL} Converter",
+            formatter_class=RawTextHelpFormatter
+        )
+        
+        input_group = parser.add_mutually_exclusive_group(required=True)
+        input_group.add_argument(
+            '-u', '--url',
+            type=ArgumentValidator.validate_url,
             help='Specify a YouTube URL',
             metavar='URL'
         )
         input_group.add_argument(
             '-f', '--file',
             type=ArgumentValidator.validate_file,
-            help='Specify a file containing YouTube URLs',
+            help='Specify a file containing YouTube URLs (plain or gzip, - for stdin)',
             metavar='FILE'
         )
         input_group.add_argument(
@@ -505,15 +4131,195 @@ class YouTubeToMP3:
             help='Search for YouTube videos',
             metavar='QUERY'
         )
+        input_group.add_argument(
+            '--resume',
+            type=ArgumentValidator.validate_file,
+            help='Resume the unfinished jobs recorded in a job journal',
+            metavar='JOURNAL'
+        )
+        input_group.add_argument(
+            '--worker',
+            action='store_true',
+            help='Work on the jobs of --job-store that other processes added'
+        )
+        input_group.add_argument(
+            '--serve',
+            type=ArgumentValidator.validate_address,
+            help='Run as a daemon that takes jobs over a local HTTP/JSON API\n'
+                 '(POST/GET /jobs, GET /jobs/ID[/events], DELETE /jobs/ID)',
+            metavar='[HOST:]PORT'
+        )
+        input_group.add_argument(
+            '--rebuild-archive',
+            type=ArgumentValidator.validate_directory,
+            help='Rebuild the download archive from the MP3 files in a directory',
+            metavar='DIR'
+        )
+        input_group.add_argument(
+            '--retag',
+            type=ArgumentValidator.validate_directory,
+            help='Correct the title, artist, album and album art of the audio files\n'
+                 'in a directory, from cached or freshly resolved metadata',
+            metavar='DIR'
+        )
         
         parser.add_argument(
             '-t', '--threads',
+            type=ArgumentValidator.validate_threads,
+            help='Number of download threads to use, or "auto" to tune it\n'
+                 'between --min-threads and --max-threads',
+            default=1,
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--min-threads',
             type=int,
-            help='Number of download threads to use',
             default=1,
+            help='Lower bound for -t auto (default: 1)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--max-threads',
+            type=int,
+            default=32,
+            help='Upper bound for -t auto (default: 32)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--processes',
+            type=int,
+            help='Worker processes reading and writing tags for --retag\n'
+                 '(default: one per CPU)',
             metavar='N'
         )
         
+        parser.add_argument(
+            '--max-queue',
+            type=int,
+            default=1000,
+            help='Jobs --serve queues before refusing new ones (default: 1000)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--client-jobs',
+            type=int,
+            default=2,
+            help='Jobs a --serve client may run at the same time (default: 2)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--engine',
+            choices=['threads', 'async'],
+            default='threads',
+            help='Download engine used with -t (default: threads)'
+        )
+
+        parser.add_argument(
+            '--download-workers',
+            type=int,
+            help='Use the pipelined engine with N download workers',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--encode-workers',
+            type=int,
+            help='Number of parallel ffmpeg encoders in the pipelined engine\n'
+                 '(default: number of CPUs)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--session-jobs',
+            type=int,
+            default=50,
+            help='Jobs a worker runs before its yt-dlp session is recycled (default: 50)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--schedule',
+            choices=JobScheduler.POLICIES,
+            default='fifo',
+            help='Order of the jobs within a priority: input order, shortest or\n'
+                 'longest estimated duration first (default: fifo). Durations\n'
+                 'are known for playlist entries (-p) and for videos in the\n'
+                 'metadata cache, other jobs run after them. Priorities are\n'
+                 'read from an integer right after a URL of a file, separated\n'
+                 'by whitespace, a comma or a semicolon, higher first'
+        )
+
+        parser.add_argument(
+            '--schedule-window',
+            type=int,
+            default=1000,
+            help='Number of queued jobs the scheduler reorders at a time (default: 1000)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--prefetch',
+            type=int,
+            default=0,
+            help='Resolve the metadata of up to N queued URLs while earlier\n'
+                 'ones download (default: 0, disabled)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--layout',
+            choices=list(YouTubeDownloader.LAYOUTS),
+            default='id',
+            help='File naming: "title.mp3", "title [ID].mp3" or\n'
+                 '"ab/title [ID].mp3" in directories named after the first\n'
+                 'two characters of the video ID (default: id)'
+        )
+
+        parser.add_argument(
+            '--staging-dir',
+            type=Path,
+            help='Write partial, source and converted files to DIR (e.g. tmpfs)\n'
+                 'and only move finished, tagged files into the output directory',
+            metavar='DIR'
+        )
+
+        parser.add_argument(
+            '--staging-max-mb',
+            type=int,
+            help='Staging space downloads may use together before new ones\n'
+                 'wait (default: unlimited)',
+            metavar='MB'
+        )
+
+        parser.add_argument(
+            '--manifest',
+            type=Path,
+            help='Append a JSON line per written file (ID, path, size, duration,\n'
+                 'bitrate, tag state) to FILE, also used by --rebuild-archive',
+            metavar='FILE'
+        )
+
+        parser.add_argument(
+            '--audio-format',
+            choices=[*OutputFormat.CODECS, OutputFormat.COPY],
+            default='mp3',
+            help='Output audio codec, or "copy" to keep the source audio\n'
+                 'stream without transcoding (default: mp3)'
+        )
+
+        parser.add_argument(
+            '--audio-quality',
+            default='192',
+            help='Output bitrate in kbps, or 0 (best) to 10 (worst) for VBR\n'
+                 '(default: 192)',
+            metavar='Q'
+        )
+
         parser.add_argument(
             '-p', '--playlist',
             action='store_true',
@@ -536,15 +4342,48 @@ class YouTubeToMP3:
         parser.add_argument(
             '-r', '--rate-limit',
             type=ArgumentValidator.validate_rate_limit,
-            help='Limit download rate (KB/s)',
+            help='Limit the total download rate of all threads (KB/s)',
             metavar='RATE'
         )
+
+        parser.add_argument(
+            '--rate-burst',
+            type=float,
+            default=1.0,
+            help='Seconds of bandwidth that may be used in one burst (default: 1)',
+            metavar='SECONDS'
+        )
+
+        parser.add_argument(
+            '--rate-limit-file',
+            type=Path,
+            help='File holding a rate limit (KB/s) that is re-read while running',
+            metavar='FILE'
+        )
         
         parser.add_argument(
             '-n', '--no-metadata',
             action='store_true',
             help='Skip adding metadata to MP3 files'
         )
+
+        parser.add_argument(
+            '--thumbnail-size',
+            type=int,
+            default=300,
+            help='Embed the smallest thumbnail at least this many pixels high,\n'
+                 'downscaled to it when Pillow is installed (default: 300)',
+            metavar='PX'
+        )
+
+        parser.add_argument(
+            '--thumbnail-max-kb',
+            type=int,
+            default=100,
+            help='Re-encode embedded thumbnails to JPEGs of at most this size\n'
+                 'when Pillow is installed (default: 100)',
+            metavar='KB'
+        )
         
         parser.add_argument(
             '--search-results',
@@ -553,8 +4392,132 @@ class YouTubeToMP3:
             help='Number of search results to display',
             metavar='N'
         )
-        
-        return parser.parse_args()
+
+        parser.add_argument(
+            '--archive',
+            type=Path,
+            help='Download archive used to skip already converted videos',
+            metavar='FILE'
+        )
+
+        parser.add_argument(
+            '--journal',
+            type=Path,
+            help='Record the state of every job in a journal for --resume',
+            metavar='FILE'
+        )
+
+        parser.add_argument(
+            '--job-store',
+            type=Path,
+            help='Share the jobs with other processes through a SQLite store:\n'
+                 'the URLs of -u/-f/-s are added to it, and every process\n'
+                 'started with it (or with --worker) works on its jobs',
+            metavar='FILE'
+        )
+
+        parser.add_argument(
+            '--shared-store',
+            action='store_true',
+            help='The job store is used from several hosts over a shared\n'
+                 'filesystem (uses a rollback journal instead of WAL)'
+        )
+
+        parser.add_argument(
+            '--lease',
+            type=int,
+            default=300,
+            help='Seconds a job stays claimed by a worker that stopped\n'
+                 'renewing it (default: 300)',
+            metavar='SECONDS'
+        )
+
+        parser.add_argument(
+            '--retries',
+            type=int,
+            default=3,
+            help='Retries for throttled, network and ffmpeg failures (default: 3)',
+            metavar='N'
+        )
+
+        parser.add_argument(
+            '--dead-letter',
+            type=Path,
+            help='Append URLs that finally failed to FILE (usable with -f)',
+            metavar='FILE'
+        )
+
+        parser.add_argument(
+            '--metrics-json',
+            type=Path,
+            help='Write per-stage timings as a JSON report at the end of the run',
+            metavar='FILE'
+        )
+
+        parser.add_argument(
+            '--metrics-prom',
+            type=Path,
+            help='Keep per-stage metrics up to date in a Prometheus textfile',
+            metavar='FILE'
+        )
+
+        parser.add_argument(
+            '--profile',
+            type=Path,
+            help='Run under cProfile and dump the stats of each worker to DIR',
+            metavar='DIR'
+        )
+
+        parser.add_argument(
+            '--cache-dir',
+            type=Path,
+            help='Directory for the metadata cache (default: no cache)',
+            metavar='DIR'
+        )
+
+        parser.add_argument(
+            '--cache-ttl',
+            type=int,
+            default=4 * 3600,
+            help='Seconds before cached metadata expires (default: 14400)',
+            metavar='SECONDS'
+        )
+
+        parser.add_argument(
+            '--cache-size',
+            type=int,
+            default=128,
+            help='Maximum size of the metadata cache in MB (default: 128)',
+            metavar='MB'
+        )
+
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only resolve and list the videos, do not download them'
+        )
+
+        args = parser.parse_args()
+
+        if args.rebuild_archive and not args.archive:
+            parser.error('--rebuild-archive requires --archive')
+        if args.retag and args.no_metadata:
+            parser.error('--retag cannot be used with --no-metadata')
+
+        if args.worker and not args.job_store:
+            parser.error('--worker requires --job-store')
+        if args.job_store and (args.journal or args.resume or args.serve or args.dry_run):
+            parser.error('--job-store cannot be used with --journal, --resume, --serve or --dry-run')
+
+        # With -t auto the threads engine starts max_threads workers and the
+        # controller decides how many of them run, other engines use the maximum
+        args.auto_threads = args.threads == 'auto'
+        if args.auto_threads:
+            if not 1 <= args.min_threads <= args.max_threads:
+                parser.error('--min-threads must be between 1 and --max-threads')
+            args.threads = args.max_threads
+
+        return args
     
     def _get_output_directory(self) -> Path:
         """Get the output directory"""
@@ -569,8 +4532,11 @@ class YouTubeToMP3:
     
     def _handle_search(self) -> Optional[str]:
         """Handle search functionality with interactive selection"""
+        import inquirer
+        from inquirer import themes
+
         self.logger.info(f"Searching for: {self.args.search}")
-        results = YouTubeSearcher.search(self.args.search, self.args.search_results)
+        results = YouTubeSearcher.search(self.args.search, self.args.search_results, self.cache)
         
         if not results:
             self.logger.error("No search results found")
@@ -615,72 +4581,372 @@ class YouTubeToMP3:
         if self.args.verbose:
             self.logger = Logger(level=logging.DEBUG)
 
-        # Get output directory
-        output_dir = self._get_output_directory()
-        self.logger.info(f"Output directory: {output_dir}")
-
-        # Process based on input type
-        if self.args.search:
-            url = self._handle_search()
-            if url:
-                self._process_url(url, output_dir)
-        elif self.args.file:
-            self._process_file(self.args.file, output_dir)
+        if self.args.archive:
+            self.archive = DownloadArchive(self.args.archive)
+
+        if self.args.manifest:
+            self.manifest = Manifest(self.args.manifest)
+
+        if self.args.cache_dir:
+            self.cache = MetadataCache(
+                self.args.cache_dir,
+                ttl=self.args.cache_ttl,
+                max_size=self.args.cache_size * 1024 * 1024
+            )
+
+        self.retry = RetryPolicy(max_retries=self.args.retries, dead_letter=self.args.dead_letter)
+        self.output_format = OutputFormat(self.args.audio_format, self.args.audio_quality)
+        if not self.args.no_metadata:
+            self.thumbnails = ThumbnailFetcher(
+                size=self.args.thumbnail_size,
+                max_bytes=self.args.thumbnail_max_kb * 1024,
+                logger=self.logger
+            )
+
+        self.metrics = StageMetrics(profile_dir=self.args.profile)
+        if self.args.metrics_prom:
+            self.metrics.start_export(self.args.metrics_prom)
+
+        # One bandwidth budget for every download of this run
+        if self.args.rate_limit or self.args.rate_limit_file:
+            self.limiter = BandwidthLimiter(
+                rate=(self.args.rate_limit or 0) * 1024,
+                burst=self.args.rate_burst,
+                control_file=self.args.rate_limit_file,
+                logger=self.logger
+            )
+
+        try:
+            if self.args.rebuild_archive:
+                self._rebuild_archive(self.args.rebuild_archive)
+                return
+            if self.args.retag:
+                self._retag(self.args.retag)
+                return
+
+            if self.args.resume:
+                journal_output_dir, jobs = JobJournal.load(self.args.resume)
+                if not self.args.output and journal_output_dir:
+                    self.args.output = journal_output_dir
+
+            # Get output directory
+            output_dir = self._get_output_directory()
+            self.logger.info(f"Output directory: {output_dir}")
+
+            if self.args.staging_dir:
+                self.staging = StagingArea(
+                    self.args.staging_dir,
+                    output_dir,
+                    max_bytes=self.args.staging_max_mb * 1024 * 1024 if self.args.staging_max_mb else None,
+                    logger=self.logger
+                )
+
+            journal_path = self.args.resume or self.args.journal
+            if journal_path:
+                self.journal = JobJournal(journal_path)
+                self.journal.start(output_dir)
+
+            # The store takes the place of the journal, every worker reports to it
+            if self.args.job_store:
+                self.store = JobStore(self.args.job_store, lease=self.args.lease, shared=self.args.shared_store)
+                self.store.start(output_dir)
+                self.journal = self.store
+
+            # Process based on input type
+            if self.args.resume:
+                self._resume(jobs, output_dir)
+            elif self.args.serve:
+                self._serve(output_dir)
+            elif self.args.worker:
+                self._process_urls(iter([]), output_dir)
+            elif self.args.search:
+                url = self._handle_search()
+                if url:
+                    self._process_url(url, output_dir)
+            elif self.args.file:
+                self._process_file(self.args.file, output_dir)
+            else:
+                self._process_url(self.args.url, output_dir)
+        finally:
+            if self.archive is not None:
+                self.archive.close()
+            if self.manifest:
+                self.manifest.close()
+            if self.cache:
+                self.cache.close()
+            if self.store:
+                summary = ', '.join(f"{count} {state}" for state, count in sorted(self.store.summary().items()))
+                self.logger.info(f"Job store: {summary or 'empty'}")
+            if self.journal:
+                self.journal.close()
+            if self.thumbnails:
+                self.thumbnails.close()
+            if self.prefetcher:
+                self.prefetcher.close()
+            self._finish_metrics()
+
+    def _finish_metrics(self) -> None:
+        """Print the stage summary and write the metrics files"""
+        self.metrics.stop_export()
+
+        report = self.metrics.report()
+        if report['jobs']:
+            for line in self.metrics.summary():
+                self.logger.info(line)
+
+        if self.args.metrics_json:
+            self.metrics.write_json(self.args.metrics_json)
+        if self.args.metrics_prom:
+            self.metrics.write_prometheus(self.args.metrics_prom)
+
+    def _rebuild_archive(self, directory: Path) -> None:
+        """Rebuild the download archive from a directory of tagged MP3 files, or its manifest"""
+        if self.manifest:
+            self.logger.info(f"Rebuilding archive {self.args.archive} from {self.args.manifest}")
+            count = self.archive.rebuild_from(self.manifest)
         else:
-            self._process_url(self.args.url, output_dir)
+            self.logger.info(f"Rebuilding archive {self.args.archive} from {directory}")
+            count = self.archive.rebuild(directory, self.output_format.settings_key)
+        self.logger.info(f"Archive now contains {count} videos")
+
+    def _retag(self, directory: Path) -> None:
+        """Correct the tags of the audio files in a directory"""
+        self.logger.info(f"Retagging the audio files in {directory}")
+        retagger = LibraryRetagger(
+            directory,
+            processes=self.args.processes,
+            threads=self.args.threads,
+            cache=self.cache,
+            thumbnails=self.thumbnails,
+            create_downloader=lambda: YouTubeDownloader(
+                directory,
+                logger=self.logger,
+                add_metadata=False,
+                cache=self.cache,
+                limiter=self.limiter
+            ),
+            logger=self.logger,
+            metrics=self.metrics,
+            dry_run=self.args.dry_run
+        )
+        stats = retagger.run()
+        self.logger.info(
+            f"{'Would retag' if self.args.dry_run else 'Retagged'} {stats['changed']} of {stats['files']} files "
+            f"in {stats['elapsed']:.1f}s ({stats['files'] / max(stats['elapsed'], 1e-6):.0f} files/s): "
+            f"{stats['unchanged']} already matched, {stats['unresolved']} without metadata, "
+            f"{stats['failed']} failed"
+        )
 
     def _process_file(self, file_path: Path, output_dir: Path) -> None:
         """Process a file containing URLs"""
-        urls = URLExtractor.extract_from_file(file_path)
+        priorities = {}
+        urls = URLExtractor.iter_from_file(file_path, prefer_playlist=self.args.playlist, priorities=priorities)
 
-        if not urls:
+        # Peek at the first URL, the rest is streamed into the downloaders
+        first = next(urls, None)
+        if first is None:
             self.logger.error("No YouTube URLs found in the file")
             return
 
-        self.logger.info(f"Found {len(urls)} YouTube URLs")
+        urls = itertools.chain([first], urls)
+        self.logger.info(f"Reading YouTube URLs from {file_path}")
+        self._process_urls(urls, output_dir, priorities)
 
+    def _resume(self, jobs: Dict[str, Dict[str, Any]], output_dir: Path) -> None:
+        """Requeue the unfinished jobs of a journal"""
+        pending = [url for url, job in jobs.items() if job['state'] != 'done']
+        self.logger.info(f"Resuming {len(pending)} of {len(jobs)} jobs from {self.args.resume}")
+
+        for url in pending:
+            JobJournal.clean_partial(jobs[url])
+
+            # Playlist entries keep their album and track number
+            if jobs[url].get('entry'):
+                self.playlists = self.playlists or PlaylistExpander(
+                    self.logger, self.archive, self.output_format.settings_key)
+                self.playlists.remember(URLExtractor.video_id(url), jobs[url]['entry'])
+
+        if pending:
+            self._process_urls(iter(pending), output_dir)
+
+    def _process_urls(self, urls: Iterator[str], output_dir: Path,
+                      priorities: Optional[Dict[str, int]] = None) -> None:
+        """Download a stream of URLs with the configured engine"""
+        if self.args.dry_run:
+            self._dry_run(urls, output_dir)
+            return
+
+        # Every playlist entry becomes a job of its own
+        if self.args.playlist:
+            self.playlists = self.playlists or PlaylistExpander(
+                self.logger, self.archive, self.output_format.settings_key)
+            urls = self.playlists.expand(urls)
+
+        if priorities is not None or self.args.schedule != 'fifo':
+            scheduler = JobScheduler(self.args.schedule, self.args.schedule_window, priorities,
+                                     self.playlists, self.cache)
+            urls = scheduler.schedule(urls)
+
+        # Queue the jobs in the store, then work on whatever it hands out
+        if self.store:
+            added = self.store.add(urls, self.playlists)
+            if added:
+                self.logger.info(f"Added {added} jobs to {self.args.job_store}")
+            self.playlists = self.playlists or PlaylistExpander(
+                self.logger, self.archive, self.output_format.settings_key)
+            urls = self.store.claims(self.playlists)
+
+        if self.journal:
+            urls = self.journal.track(urls, self.playlists)
+
+        if self.args.prefetch > 0:
+            self.prefetcher = MetadataPrefetcher(
+                lambda: YouTubeDownloader(
+                    output_dir=output_dir,
+                    skip_playlist=not self.args.playlist,
+                    logger=self.logger,
+                    add_metadata=False,
+                    archive=self.archive,
+                    session_jobs=self.args.session_jobs,
+                    cache=self.cache,
+                    output_format=self.output_format
+                ),
+                lookahead=self.args.prefetch,
+                workers=min(self.args.prefetch, 4),
+                logger=self.logger,
+                metrics=self.metrics
+            )
+            urls = self.prefetcher.watch(urls)
+
+        dashboard = ProgressDashboard()
+        options = self._job_options(dashboard=dashboard)
+
+        # Use the pipelined engine if any of its stages was sized
+        if self.args.download_workers or self.args.encode_workers:
+            downloader = PipelinedDownloader(
+                urls=urls,
+                output_dir=output_dir,
+                download_workers=self.args.download_workers or self.args.threads,
+                encode_workers=self.args.encode_workers or os.cpu_count() or 1,
+                **options
+            )
+            downloader.start()
+        elif self.args.engine == 'async':
+            downloader = AsyncDownloader(
+                urls=urls,
+                output_dir=output_dir,
+                concurrency=self.args.threads,
+                **options
+            )
+            downloader.start()
         # Use threaded downloader if more than one thread requested
-        if self.args.threads > 1:
+        elif self.args.threads > 1:
             self.logger.info(f"Using {self.args.threads} download threads")
             downloader = ThreadedDownloader(
-                urls=list(urls),
+                urls=urls,
                 output_dir=output_dir,
                 num_threads=self.args.threads,
-                skip_playlist=not self.args.playlist,
-                logger=self.logger,
-                rate_limit=self.args.rate_limit,
-                add_metadata=not self.args.no_metadata
+                controller=ConcurrencyController(
+                    self.args.min_threads, self.args.max_threads, self.logger
+                ) if self.args.auto_threads else None,
+                **options
             )
             downloader.start()
         else:
             self.logger.info("Using single-threaded mode")
-            downloader = YouTubeDownloader(
-                output_dir=output_dir,
-                skip_playlist=not self.args.playlist,
-                logger=self.logger,
-                rate_limit=self.args.rate_limit,
-                add_metadata=not self.args.no_metadata
-            )
+            downloader = YouTubeDownloader(output_dir=output_dir, **options)
 
-            for url in urls:
-                downloader.download(url)
+            dashboard.start()
+            try:
+                for url in urls:
+                    downloader.download(url)
+            finally:
+                dashboard.stop()
+                downloader.close()
 
-    def _process_url(self, url: str, output_dir: Path) -> None:
-        """Process a single URL"""
+    def _job_options(self, dashboard: Optional[ProgressDashboard] = None) -> Dict[str, Any]:
+        """Settings of the download jobs shared by every engine"""
+        return dict(
+            skip_playlist=not self.args.playlist,
+            logger=self.logger,
+            rate_limit=self.args.rate_limit,
+            add_metadata=not self.args.no_metadata,
+            archive=self.archive,
+            limiter=self.limiter,
+            session_jobs=self.args.session_jobs,
+            cache=self.cache,
+            journal=self.journal,
+            retry=self.retry,
+            dashboard=dashboard,
+            metrics=self.metrics,
+            output_format=self.output_format,
+            thumbnails=self.thumbnails,
+            playlists=self.playlists,
+            prefetcher=self.prefetcher,
+            layout=self.args.layout,
+            manifest=self.manifest,
+            staging=self.staging
+        )
+
+    def _dry_run(self, urls, output_dir: Path) -> None:
+        """Resolve and list the videos that would be downloaded"""
         downloader = YouTubeDownloader(
             output_dir=output_dir,
             skip_playlist=not self.args.playlist,
             logger=self.logger,
-            rate_limit=self.args.rate_limit,
-            add_metadata=not self.args.no_metadata
+            session_jobs=self.args.session_jobs,
+            cache=self.cache
+        )
+
+        for url in urls:
+            info_dict = downloader.resolve(url)
+            if info_dict:
+                entries = info_dict.get('entries') or [info_dict]
+                for entry in entries:
+                    if entry:
+                        self.logger.info(f"{entry.get('title')} ({entry.get('duration_string', '?')}) {url}")
+        downloader.close()
+
+    def _serve(self, output_dir: Path) -> None:
+        """Take jobs over the HTTP API until interrupted"""
+        host, port = self.args.serve
+        service = DownloadService(
+            output_dir=output_dir,
+            workers=self.args.threads,
+            max_queue=self.args.max_queue,
+            client_jobs=self.args.client_jobs,
+            **self._job_options(dashboard=ProgressDashboard())
         )
+        service.serve(host, port)
+
+    def _process_url(self, url: str, output_dir: Path) -> None:
+        """Process a single URL"""
+        if self.args.dry_run:
+            self._dry_run([url], output_dir)
+            return
+
+        # Playlists are fanned out over the configured engine, shared jobs go through the store
+        if self.store or (self.args.playlist and URLExtractor.PLAYLIST_ID_PATTERN.search(url)):
+            self._process_urls(iter([url]), output_dir)
+            return
+
+        if self.journal:
+            self.journal.record(url, 'queued')
+
+        downloader = YouTubeDownloader(output_dir=output_dir, **self._job_options())
         downloader.download(url)
+        downloader.close()
 
 
 def main():
     try:
         app = YouTubeToMP3()
-        app.run()
+        if app.args.profile:
+            # Worker threads are profiled separately, see StageMetrics.profiled
+            app.args.profile.mkdir(parents=True, exist_ok=True)
+            cProfile.runctx('app.run()', globals(), {'app': app}, str(app.args.profile / 'main.prof'))
+        else:
+            app.run()
     except KeyboardInterrupt:
         print(f"\n{Fore.RED}Process interrupted by user{Style.RESET_ALL}")
         sys.exit(1)